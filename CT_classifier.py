@@ -25,7 +25,7 @@ def classify_CT(df, dcm_metadata, acquisition):
     classification = {}
     info_object = {}
     
-    if common_utils.is_localizer(acquisition.label) or common_utils.is_localizer(series_description) or len(df) < 10:
+    if common_utils.is_localizer(acquisition.label) or common_utils.is_localizer(series_description) or common_utils.get_slice_count(df) < 10:
         classification['Scan Type'] = ['Localizer']
     else:
         classification['Scan Type'] = \
@@ -103,7 +103,7 @@ def classify_CT(df, dcm_metadata, acquisition):
 
         # # Scan Coverage
         if scan_coverage:
-            spacing_between_slices = scan_coverage / len(df)
+            spacing_between_slices = scan_coverage / common_utils.get_slice_count(df)
             info_object['SpacingBetweenSlices'] = round(spacing_between_slices, 2)
         
         info_object['ClassificationSource'] = classification_source
@@ -1,88 +1,97 @@
 """MR classification"""
 import os
+import contextvars
+import copy
 import json
 import re
+from collections import Counter
+from contextlib import contextmanager
 from fnmatch import fnmatch
+from functools import lru_cache
 import dicom_processor
 import common_utils
+import rule_engine
+import safe_regex
 import logging
 
 log = logging.getLogger(__name__)
 
+# Gear config holding the custom classifications
+CONFIG_FILE = '/flywheel/v0/config.json'
+
+
+FEATURES = ['2D', 'AAscout', 'Spin-Echo', 'Gradient-Echo',
+            'EPI', 'WASSR', 'FAIR', 'FAIREST', 'PASL', 'EPISTAR',
+            'PICORE', 'pCASL', 'MPRAGE', 'MP2RAGE', 'FLAIR',
+            'SWI', 'QSM', 'RMS', 'DTI', 'DSI', 'DKI', 'HARDI',
+            'NODDI', 'Water-Reference', 'Transmit-Reference',
+            'SBRef', 'Uniform', 'Singlerep', 'QC', 'TRACE',
+            'FA', 'MIP', 'Navigator', 'Contrast-Agent',
+            'Phase-Contrast', 'TOF', 'VASO', 'iVASO', 'DSC',
+            'DCE', 'Task', 'Resting-State', 'PRESS', 'STEAM',
+            'M0', 'Phase-Reversed', 'Spiral', 'SPGR',
+            'Quantitative', 'Multi-Shell', 'Multi-Echo', 'Multi-Flip',
+            'Multi-Band', 'Steady-State', '3D', 'Compressed-Sensing',
+            'Eddy-Current-Corrected', 'Fieldmap-Corrected',
+            'Gradient-Unwarped', 'Motion-Corrected', 'Physio-Corrected',
+            'Derived', 'In-Plane', 'Phase', 'Magnitude']
+
+MEASUREMENTS = ['MRA', 'CEST', 'T1rho', 'SVS', 'CSI', 'EPSI', 'BOLD',
+                'Phoenix', 'B0', 'B1', 'T1', 'T2', 'T2*', 'PD', 'MT',
+                'Perfusion', 'Diffusion', 'Susceptibility', 'Fingerprinting']
+
+INTENTS = ['Localizer',
+           'Shim',
+           'Calibration',
+           'Fieldmap',
+           'Structural',
+           'Functional',
+           'Screenshot',
+           'Non-Image',
+           'Spectroscopy']
+
 
 def feature_check(label):
     """Check the label for a list of features.
 
     Args:
-        label (str): String to regexp match with element of feature_list
+        label (str): String to regexp match with element of FEATURES
 
     Returns:
-        list: List of feature_list elements that regex matched with label
+        list: List of FEATURES elements that regex matched with label
     """
-
-    feature_list = ['2D', 'AAscout', 'Spin-Echo', 'Gradient-Echo',
-                   'EPI', 'WASSR', 'FAIR', 'FAIREST', 'PASL', 'EPISTAR',
-                   'PICORE', 'pCASL', 'MPRAGE', 'MP2RAGE', 'FLAIR',
-                   'SWI', 'QSM', 'RMS', 'DTI', 'DSI', 'DKI', 'HARDI',
-                   'NODDI', 'Water-Reference', 'Transmit-Reference',
-                   'SBRef', 'Uniform', 'Singlerep', 'QC', 'TRACE',
-                   'FA', 'MIP', 'Navigator', 'Contrast-Agent',
-                   'Phase-Contrast', 'TOF', 'VASO', 'iVASO', 'DSC',
-                   'DCE', 'Task', 'Resting-State', 'PRESS', 'STEAM',
-                   'M0', 'Phase-Reversed', 'Spiral', 'SPGR',
-                   'Quantitative', 'Multi-Shell', 'Multi-Echo', 'Multi-Flip',
-                   'Multi-Band', 'Steady-State', '3D', 'Compressed-Sensing',
-                   'Eddy-Current-Corrected', 'Fieldmap-Corrected',
-                   'Gradient-Unwarped', 'Motion-Corrected', 'Physio-Corrected',
-                   'Derived', 'In-Plane', 'Phase', 'Magnitude']
-
-    return _find_matches(label, feature_list)
+    return _find_matches(label, FEATURES)
 
 
 def measurement_check(label):
     """Check the label for a list of measurements.
 
     Args:
-        label (str): String to regexp match with element of measurement_list
+        label (str): String to regexp match with element of MEASUREMENTS
 
     Returns:
-        list: List of measurement_list elements that regex matched with label
+        list: List of MEASUREMENTS elements that regex matched with label
     """
-
-    measurement_list = ['MRA', 'CEST', 'T1rho', 'SVS', 'CSI', 'EPSI', 'BOLD',
-                        'Phoenix','B0', 'B1', 'T1', 'T2', 'T2*', 'PD', 'MT',
-                        'Perfusion','Diffusion', 'Susceptibility', 'Fingerprinting']
-
-    return _find_matches(label, measurement_list)
+    return _find_matches(label, MEASUREMENTS)
 
 
 def intent_check(label):
     """Check the label for a list of intents.
 
     Args:
-        label (str): String to regexp match with element of intent_list
+        label (str): String to regexp match with element of INTENTS
 
     Returns:
-        list: List of intent_list elements that regex matched with label
+        list: List of INTENTS elements that regex matched with label
     """
-
-    intent_list = [ 'Localizer',
-                    'Shim',
-                    'Calibration',
-                    'Fieldmap',
-                    'Structural',
-                    'Functional',
-                    'Screenshot',
-                    'Non-Image',
-                    'Spectroscopy' ]
-
-    return _find_matches(label, intent_list)
+    return _find_matches(label, INTENTS)
 
 
 def _find_matches(label, in_list):
     """For a given list find those entries that match a given label."""
 
     matches = []
+    label = common_utils.truncate_label(label)
 
     for l in in_list:
         regex = _compile_regex(l)
@@ -92,8 +101,9 @@ def _find_matches(label, in_list):
     return matches
 
 
+@lru_cache(maxsize=None)
 def _compile_regex(string):
-    """Generate the regex for label checking"""
+    """Generate the regex for label checking, compiled once per string"""
     # Escape * for T2*
     if string == 'T2*':
         string = 'T2\*'
@@ -109,222 +119,116 @@ def _compile_regex(string):
 
 # Anatomy, T1
 def is_anatomy_t1(label):
-    regexes = [
-        re.compile('t1', re.IGNORECASE),
-        re.compile('t1w', re.IGNORECASE),
-        re.compile('(?=.*3d anat)(?![inplane])', re.IGNORECASE),
-        re.compile('(?=.*3d)(?=.*bravo)(?![inplane])', re.IGNORECASE),
-        re.compile('spgr', re.IGNORECASE),
-        re.compile('tfl', re.IGNORECASE),
-        re.compile('mprage', re.IGNORECASE),
-        re.compile('(?=.*mm)(?=.*iso)', re.IGNORECASE),
-        re.compile('(?=.*mp)(?=.*rage)', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('anatomy_t1', label)
 
 # Anatomy, T2
 def is_anatomy_t2(label):
-    regexes = [
-        re.compile('t2', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('anatomy_t2', label)
 
 # Aanatomy, Inplane
 def is_anatomy_inplane(label):
-    regexes = [
-        re.compile('inplane', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('anatomy_inplane', label)
 
 # Anatomy, other
 def is_anatomy(label):
-    regexes = [
-        re.compile('(?=.*IR)(?=.*EPI)', re.IGNORECASE),
-        re.compile('flair', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('anatomy', label)
 
 # Diffusion
 def is_diffusion(label):
-    regexes = [
-        re.compile('dti', re.IGNORECASE),
-        re.compile('dwi', re.IGNORECASE),
-        re.compile('diff_', re.IGNORECASE),
-        re.compile('diffusion', re.IGNORECASE),
-        re.compile('(?=.*diff)(?=.*dir)', re.IGNORECASE),
-        re.compile('hardi', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('diffusion', label)
 
 # Diffusion - Derived
 def is_diffusion_derived(label):
-    regexes = [
-        re.compile('_ADC$', re.IGNORECASE),
-        re.compile('_TRACEW$', re.IGNORECASE),
-        re.compile('_ColFA$', re.IGNORECASE),
-        re.compile('_FA$', re.IGNORECASE),
-        re.compile('_EXP$', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('diffusion_derived', label)
 
 # Functional
 def is_functional(label):
-    regexes = [
-        re.compile('functional', re.IGNORECASE),
-        re.compile('fmri', re.IGNORECASE),
-        re.compile('func', re.IGNORECASE),
-        re.compile('bold', re.IGNORECASE),
-        re.compile('resting', re.IGNORECASE),
-        re.compile('(?=.*rest)(?=.*state)', re.IGNORECASE),
-        # NON-STANDARD
-        re.compile('(?=.*ret)(?=.*bars)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*wedges)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*rings)', re.IGNORECASE),
-        re.compile('(?=.*ret)(?=.*check)', re.IGNORECASE),
-        re.compile('go-no-go', re.IGNORECASE),
-        re.compile('words', re.IGNORECASE),
-        re.compile('checkers', re.IGNORECASE),
-        re.compile('retinotopy', re.IGNORECASE),
-        re.compile('faces', re.IGNORECASE),
-        re.compile('rings', re.IGNORECASE),
-        re.compile('wedges', re.IGNORECASE),
-        re.compile('emoreg', re.IGNORECASE),
-        re.compile('conscious', re.IGNORECASE),
-        re.compile('^REST$'),
-        re.compile('ep2d', re.IGNORECASE),
-        re.compile('task', re.IGNORECASE),
-        re.compile('rest', re.IGNORECASE),
-        re.compile('fBIRN', re.IGNORECASE),
-        re.compile('^Curiosity', re.IGNORECASE),
-        re.compile('^DD_', re.IGNORECASE),
-        re.compile('^Poke', re.IGNORECASE),
-        re.compile('^Effort', re.IGNORECASE),
-        re.compile('emotion|conflict', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('functional', label)
 
 # Functional, Derived
 def is_functional_derived(label):
-    regexes = [
-        re.compile('mocoseries', re.IGNORECASE),
-        re.compile('GLM$', re.IGNORECASE),
-        re.compile('t-map', re.IGNORECASE),
-        re.compile('design', re.IGNORECASE),
-        re.compile('StartFMRI', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('functional_derived', label)
 
 # Shim
 def is_shim(label):
-    regexes = [
-        re.compile('(?=.*HO)(?=.*shim)', re.IGNORECASE), # Contians 'ho' and 'shim'
-        re.compile(r'\bHOS\b', re.IGNORECASE),
-        re.compile('_HOS_', re.IGNORECASE),
-        re.compile('.*shim', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('shim', label)
 
 # Fieldmap
 def is_fieldmap(label):
-    regexes = [
-        re.compile('(?=.*field)(?=.*map)', re.IGNORECASE),
-        re.compile('(?=.*bias)(?=.*ch)', re.IGNORECASE),
-        re.compile('field', re.IGNORECASE),
-        re.compile('fmap', re.IGNORECASE),
-        re.compile('topup', re.IGNORECASE),
-        re.compile('DISTORTION', re.IGNORECASE),
-        re.compile('se[-_][aprl]{2}$', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('fieldmap', label)
 
 # Calibration
 def is_calibration(label):
-    regexes = [
-        re.compile('(?=.*asset)(?=.*cal)', re.IGNORECASE),
-        re.compile('^asset$', re.IGNORECASE),
-        re.compile('calibration', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('calibration', label)
 
 # Coil Survey
 def is_coil_survey(label):
-    regexes = [
-        re.compile('(?=.*coil)(?=.*survey)', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('coil_survey', label)
 
 # Perfusion: Arterial Spin Labeling
 def is_perfusion(label):
-    regexes = [
-        re.compile('asl', re.IGNORECASE),
-        re.compile('(?=.*blood)(?=.*flow)', re.IGNORECASE),
-        re.compile('(?=.*art)(?=.*spin)', re.IGNORECASE),
-        re.compile('tof', re.IGNORECASE),
-        re.compile('perfusion', re.IGNORECASE),
-        re.compile('angio', re.IGNORECASE),
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('perfusion', label)
 
 # Proton Density
 def is_proton_density(label):
-    regexes = [
-        re.compile('^PD$'),
-        re.compile('(?=.*proton)(?=.*density)', re.IGNORECASE),
-        re.compile('pd_'),
-        re.compile('_pd')
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('proton_density', label)
 
 # Phase Map
 def is_phase_map(label):
-    regexes = [
-        re.compile('(?=.*phase)(?=.*map)', re.IGNORECASE),
-        re.compile('^phase$', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('phase_map', label)
 
 # Screen Save / Screenshot
 def is_screenshot(label):
-    regexes = [
-        re.compile('(?=.*screen)(?=.*save)', re.IGNORECASE),
-        re.compile('.*screenshot', re.IGNORECASE),
-        re.compile('.*screensave', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('screenshot', label)
 
 # Spectroscopy
 def is_spectroscopy(label):
-    regexes = [
-        re.compile('mip', re.IGNORECASE),
-        re.compile('mrs', re.IGNORECASE),
-        re.compile('svs', re.IGNORECASE),
-        re.compile('gaba', re.IGNORECASE),
-        re.compile('csi', re.IGNORECASE),
-        re.compile('nfl', re.IGNORECASE),
-        re.compile('mega', re.IGNORECASE),
-        re.compile('press', re.IGNORECASE),
-        re.compile('spect', re.IGNORECASE)
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('spectroscopy', label)
 
 # Post in Series Description
 def is_post(label):
-    found = False
-    if type(label) == str:
-        if re.search('POST', label, flags=re.IGNORECASE):
-            found = True
-    elif isinstance(label, list):
-        if any(is_post(item) for item in label):
-            found = True
-    return found
+    return common_utils.match_label('post', label)
 
 # Susceptibility Weighted
 def is_swi(label):
-    regexes = [
-        re.compile('swi', re.IGNORECASE),
-        re.compile('susceptibility', re.IGNORECASE),
-        ]
-    return common_utils.regex_search_label(regexes, label)
+    return common_utils.match_label('swi', label)
+
+
+# Label rules of infer_classification (rule_engine.Rule), by priority: the
+# classification is set by the output of the first rule matching the label
+LABEL_RULES = rule_engine.RULES.tables['mr_label'].rules
+
+
+# Hits of LABEL_RULES by rule name, and of unknown labels, counted in the current
+# context (thread) by count_rule_hits, None when not counting
+_rule_hits = contextvars.ContextVar('rule_hits', default=None)
+
+
+@contextmanager
+def count_rule_hits():
+    """Count the labels classified by each LABEL_RULES rule, and the unknown ones, in the enclosed block
+
+    Hits are counted in the current context only, so that concurrent
+    classifications neither share nor race on their counters.
+
+    Yields:
+        collections.Counter: Hits by rule name, and of 'unknown' labels
+    """
+    hits = Counter()
+    token = _rule_hits.set(hits)
+    try:
+        yield hits
+    finally:
+        _rule_hits.reset(token)
+
+
+def match_label_rule(label):
+    """Return the index in LABEL_RULES of the highest priority rule matching label, or None"""
+    matcher = rule_engine.RULES.matcher(label, common_utils.MAX_LABEL_LENGTH)
+    for idx, rule in enumerate(LABEL_RULES):
+        if matcher.matches_rule(rule):
+            return idx
+    return None
 
 
 def infer_classification(label):
@@ -335,58 +239,12 @@ def infer_classification(label):
         return {}
     else:
         classification = {}
-        if is_anatomy_inplane(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T1']
-            classification['Features'] = ['In-Plane']
-        elif is_fieldmap(label):
-            classification['Intent'] = ['Fieldmap']
-            classification['Measurement'] = ['B0']
-        elif is_diffusion_derived(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['Diffusion']
-            classification['Features'] = ['Derived']
-        elif is_diffusion(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['Diffusion']
-        elif is_functional_derived(label):
-            classification['Intent'] = ['Functional']
-            classification['Features'] = ['Derived']
-        elif is_functional(label):
-            classification['Intent'] = ['Functional']
-            classification['Measurement'] = ['T2*']
-        elif is_anatomy_t1(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T1']
-        elif is_anatomy_t2(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['T2']
-        elif is_anatomy(label):
-            classification['Intent'] = ['Structural']
-        elif is_swi(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['Susceptibility']
-        elif common_utils.is_localizer(label):
-            classification['Intent'] = ['Localizer']
-            classification['Measurement'] = ['T2']
-        elif is_shim(label):
-            classification['Intent'] = ['Shim']
-        elif is_calibration(label):
-            classification['Intent'] = ['Calibration']
-        elif is_coil_survey(label):
-            classification['Intent'] = ['Calibration']
-            classification['Measurement'] = ['B1']
-        elif is_proton_density(label):
-            classification['Intent'] = ['Structural']
-            classification['Measurement'] = ['PD']
-        elif is_perfusion(label):
-            classification['Measurement'] = ['Perfusion']
-        elif is_spectroscopy(label):
-            classification['Intent'] = ['Spectroscopy']
-        elif is_phase_map(label):
-            classification['Custom'] = ['Phase Map']
-        elif is_screenshot(label):
-            classification['Intent'] = ['Screenshot']
+        rule = match_label_rule(label)
+        hits = _rule_hits.get()
+        if hits is not None:
+            hits[LABEL_RULES[rule].name if rule is not None else 'unknown'] += 1
+        if rule is not None:
+            classification = copy.deepcopy(LABEL_RULES[rule].output)
         else:
             print(label.strip('\n') + ' --->>>> unknown')
 
@@ -414,7 +272,6 @@ def infer_classification(label):
     return classification
 
 
-
 def get_param_classification(dcm, slice_number, unique_iop):
     """
     Get classification based on imaging parameters in DICOM header.
@@ -493,7 +350,6 @@ def get_param_classification(dcm, slice_number, unique_iop):
     return classification_dict
 
 
-
 def get_classification_from_string(value):
     result = {}
 
@@ -521,7 +377,6 @@ def get_classification_from_string(value):
     return result
 
 
-
 def get_custom_classification(label, config_file):
     """
     Get custom (context) based classification.
@@ -545,6 +400,7 @@ def get_custom_classification(label, config_file):
             
             return None
 
+        label = common_utils.truncate_label(label)
         for k in classifications.keys():
             val = classifications[k]
 
@@ -554,14 +410,18 @@ def get_custom_classification(label, config_file):
                 continue
 
             if len(k) > 2 and k[0] == '/' and k[-1] == '/':
-                # Regex
+                # Regex, time-bounded since it comes from the user
                 try:
-                    if re.search(k[1:-1], label, re.I):
+                    regex = re.compile(k[1:-1], re.I)
+                    safe_regex.lint_rules({k: [regex]})
+                    if safe_regex.search_with_timeout(regex, label):
                         log.debug('Matched custom classification for key: %s', k)
                         
                         return get_classification_from_string(val)
                 except re.error:
                     log.exception('Invalid regular expression: %s', k)
+                except TimeoutError:
+                    log.warning('Custom classification key %s timed out on label %r, skipping it', k, label)
                     
             elif fnmatch(label.lower(), k.lower()):
                 log.debug('Matched custom classification for key: %s', k)
@@ -574,7 +434,7 @@ def get_custom_classification(label, config_file):
     return None
 
 
-def classify_dicom(dcm, slice_number, acquisition_label, unique_iop=None):
+def classify_dicom(dcm, slice_number, acquisition_label, unique_iop=None, config_file=CONFIG_FILE):
     """
     Generate a classification dict from DICOM header info.
 
@@ -591,9 +451,9 @@ def classify_dicom(dcm, slice_number, acquisition_label, unique_iop=None):
 
     if acquisition_label or series_desc:
         # 1. Custom classification from context
-        classification_dict = get_custom_classification(acquisition_label, '/flywheel/v0/config.json')
+        classification_dict = get_custom_classification(acquisition_label, config_file)
         if not classification_dict and series_desc:    # acquisition_label gets precedence
-            classification_dict = get_custom_classification(series_desc, '/flywheel/v0/config.json')
+            classification_dict = get_custom_classification(series_desc, config_file)
         if classification_dict:
             log.info('Custom classification from config: %s', classification_dict)
 
@@ -635,13 +495,13 @@ def iop_is_unique(iop_series):
     return is_unique
 
 
-def classify_MR(df, dcm, dcm_metadata, acquisition):
+def classify_MR(df, dcm, dcm_metadata, acquisition, config_file=CONFIG_FILE):
     """
     Classifies a MR dicom series
     """
     
     # Determine how many DICOM files are in directory
-    slice_number = len(df)
+    slice_number = common_utils.get_slice_count(df)
 
     # Determine whether ImageOrientationPatient is unique for each image represented in the df
     if hasattr(df, 'ImageOrientationPatient') and len(df) > 1:
@@ -651,7 +511,8 @@ def classify_MR(df, dcm, dcm_metadata, acquisition):
     # Classification (# Only set classification if the modality is MR)
     if dcm_metadata['modality'] == 'MR':
         log.info("Determining MR Classification...")
-        classification = classify_dicom(dcm, slice_number, acquisition.get('label'), unique_iop=uniqueiop)
+        classification = classify_dicom(dcm, slice_number, acquisition.label, unique_iop=uniqueiop,
+                                        config_file=config_file)
         
         if classification:
             dcm_metadata['classification'] = classification
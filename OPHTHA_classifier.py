@@ -1,5 +1,6 @@
-import re
+from collections import namedtuple
 import common_utils
+import rule_engine
 import logging
 
 log = logging.getLogger(__name__)
@@ -25,15 +26,7 @@ def is_left(description):
     False
 
     """
-
-    regexes = [
-        re.compile('(^|[^a-zA-Z])(L|LE)([^a-zA-Z]|$)', re.IGNORECASE),
-        # L or LE not surrounded by any other letters
-        re.compile('(^|[^a-zA-Z])(OS)([^a-zA-Z]|$)', re.IGNORECASE),
-        # OS not surrounded by any other letters
-        re.compile('LEFT', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, description)
+    return common_utils.match_label('left', description)
 
 # Laterality, Right
 def is_right(description):
@@ -56,42 +49,22 @@ def is_right(description):
     False
 
     """
-    regexes = [
-        re.compile('(^|[^a-zA-Z])(R|RE)([^a-zA-Z]|$)', re.IGNORECASE),
-        # R or RE not surrounded by any other letters
-        re.compile('(^|[^a-zA-Z])(OD)([^a-zA-Z]|$)', re.IGNORECASE),
-        # OD not surrounded by any other letters
-        re.compile('RIGHT', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, description)
+    return common_utils.match_label('right', description)
 
 # Modality, OCT
 def is_OCT(description):
-    regexes = [
-        re.compile('OCT', re.IGNORECASE),
-        #for Eyecor - Start with OP_ or OPT_ or OT_
-        re.compile('^OP?T?_', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, description)
+    return common_utils.match_label('oct', description)
 
 # Modality, OCT-OP
+# The oct_op pattern of the label rules matches SD, then OCT, then OP on a line.
+# Matching the first SD of the line, then the first OCT after it, is the same as
+# SD.*OCT.*OP without the cubic backtracking.
 def is_OCT_OP(description):
-    regexes = [
-        # match ...OP, but not ...OPT
-        re.compile('SD.*OCT.*OP(?!T)', re.IGNORECASE),
-        #for Eyecor - Start with OP_
-        re.compile('^OP_', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, description)
+    return common_utils.match_label('oct_op', description)
 
 # Modality, OCT-OPT
 def is_OCT_OPT(description):
-    regexes = [
-        re.compile('SD.*OCT.*OPT', re.IGNORECASE),
-        #for Eyecor - Start with OPT_
-        re.compile('^OPT_', re.IGNORECASE)
-    ]
-    return common_utils.regex_search_label(regexes, description)
+    return common_utils.match_label('oct_opt', description)
 
 # # Modality, OCT-OT
 # def is_OCT_OT(description):
@@ -101,14 +74,6 @@ def is_OCT_OPT(description):
 #     ]
 #     return common_utils.regex_search_label(regexes, description)
 
-# For EyeKore
-# Determine Procedure Name
-def getProtocolName(single_header_object):
-    protocolName = None
-    if 'ProtocolName' in single_header_object.keys():
-            protocolName = single_header_object['ProtocolName']
-    return protocolName
-
 # The commented blocks below are for Future development
 # def is_FA(dicom_filepath):
 #     regexes = [
@@ -160,6 +125,100 @@ def getProtocolName(single_header_object):
 #         modalityType = ['Indocyanine Green']
 #     return modality, modalityType    
 
+# Header fields of the classification, read in a single pass by read_header_fields
+HeaderFields = namedtuple('HeaderFields', ['has_columns', 'protocol_name', 'study_description', 'device_code',
+                                           'image_laterality'])
+# Laterality classification by ImageLaterality
+IMAGE_LATERALITY = {'R': ['RIGHT'], 'OD': ['RIGHT'], 'L': ['LEFT'], 'OS': ['LEFT']}
+
+
+def read_header_fields(single_header_object):
+    """Return the HeaderFields of a dicom header
+
+    The device code is the CodeValue of the AcquisitionDeviceTypeCodeSequence,
+    or of its first item.
+    """
+    device_sequence = single_header_object.get('AcquisitionDeviceTypeCodeSequence')
+    if isinstance(device_sequence, list):
+        device_sequence = device_sequence[0] if device_sequence else None
+    return HeaderFields(
+        has_columns='Columns' in single_header_object,
+        protocol_name=single_header_object.get('ProtocolName'),
+        study_description=single_header_object.get('StudyDescription'),
+        device_code=device_sequence.get('CodeValue') if isinstance(device_sequence, dict) else None,
+        image_laterality=single_header_object.get('ImageLaterality'))
+
+
+def get_OPHTHA_update(fields, label):
+    """Return the file metadata update of an ophthalmic file
+
+    The modality, type and sub-type come from the ophtha_protocol lookup of the
+    label rules by ProtocolName (used in EyeKor) or, without one, from the
+    device code or the label. Laterality comes from ImageLaterality or the
+    label, the OCT Type from the protocol, the device code or the label.
+
+    Args:
+        fields (HeaderFields): The read_header_fields of the dicom header
+        label (str): The acquisition label
+
+    Returns:
+        dict: Some of 'classification', 'modality', 'type' and 'Sub-Type';
+            empty for a file with no Columns and no OCT label
+    """
+    if not fields.has_columns and not is_OCT(label):
+        log.debug("Updtate Flag is false... Not processing this file")
+        return {}
+    lookups = rule_engine.RULES.lookups
+    device = lookups['ophtha_device'].get(fields.device_code) if fields.device_code else None
+
+    # Get Modality
+    protocol = {}
+    if fields.protocol_name:
+        log.debug("Got protocolName: %s", fields.protocol_name)
+        protocol = lookups['ophtha_protocol'].get(fields.protocol_name) or {}
+    elif device and device.get('modality'):
+        protocol = {'modality': device['modality']}
+    elif fields.device_code and fields.study_description == 'CF':
+        protocol = {'modality': 'FP', 'type': 'Color'}
+    elif is_OCT(label):
+        protocol = {'modality': 'OCT'}
+    modality, modality_type, sub_type = protocol.get('modality'), protocol.get('type'), protocol.get('sub_type')
+
+    classifications = {}
+    if modality:
+        if modality_type:
+            classifications['Type'] = [modality_type]
+        if sub_type:
+            classifications['Sub-Type'] = [sub_type]
+
+    # Get Laterality
+    if fields.image_laterality:
+        laterality = IMAGE_LATERALITY.get(fields.image_laterality) if isinstance(fields.image_laterality, str) else None
+    else:
+        laterality = next(iter(common_utils.get_label_outputs('ophtha_laterality', label)), None)
+    if laterality:
+        classifications['Laterality'] = list(laterality)
+
+    # Get OCT Type
+    oct_type = protocol.get('oct_type') or (device or {}).get('oct_type')
+    if oct_type:
+        oct_type = [oct_type]
+    else:
+        oct_type = next(iter(common_utils.get_label_outputs('ophtha_oct_type', label)), None)
+    if modality == 'OCT' and oct_type:
+        classifications['OCT Type'] = list(oct_type)
+
+    update = {}
+    if classifications:
+        update['classification'] = classifications
+    if modality:
+        update['modality'] = modality
+        update['type'] = modality_type
+        if sub_type:
+            update['Sub-Type'] = [sub_type]
+    return update
+
+
 ######################################################################################
 ######################################################################################
 def classify_OPHTHA(dcm_metadata, acquisition):
@@ -173,166 +232,48 @@ def classify_OPHTHA(dcm_metadata, acquisition):
     """
 
     log.info("Determining OPHTHA Classification...")
-    single_header_object = dcm_metadata['info']['header']['dicom']
-    updateFlag = False
-    protocolName = None
-    octType = None
-    subType = None
-    modality = None
-    modalityType = None
-    protocolNameMessage = None
-
-
-    if 'Columns' in single_header_object.keys():
-        updateFlag = True
-    elif is_OCT(acquisition.label):
-        updateFlag = True
-
-    if updateFlag:
-        study_description = None
-        if 'StudyDescription' in single_header_object.keys():
-            study_description = single_header_object['StudyDescription']
-        device_code_sequence = None
-        if 'AcquisitionDeviceTypeCodeSequence' in single_header_object.keys():
-            if 'CodeValue' in single_header_object['AcquisitionDeviceTypeCodeSequence']:
-                device_code_sequence = single_header_object['AcquisitionDeviceTypeCodeSequence']['CodeValue']
-            elif 'CodeValue' in single_header_object['AcquisitionDeviceTypeCodeSequence'][0]:
-                device_code_sequence = single_header_object['AcquisitionDeviceTypeCodeSequence'][0]['CodeValue']
-        classifications = {}
-        
-        # Get ProtocolName - used in EyeCore
-        protocolName = getProtocolName(single_header_object)
-
-        # Get Modality
-        if protocolName:
-            protocolNameMessage = "Got protocolName:" + protocolName
-            log.debug(protocolNameMessage)
-
-            if protocolName == 'FA':
-                modality = 'FP'
-                modalityType = 'Fluorescein Angiography'
-                subType = 'Standard Field'
-            elif protocolName == 'FA-4W Sweep':
-                modality = 'FP'
-                modalityType = 'Fluorescein Angiography'
-                subType = 'Wide Field'
-            elif protocolName == 'FA: UltraWidefield':
-                modality = 'FP'
-                modalityType = 'Fluorescein Angiography'
-                subType = 'Ultra-wide Field' 
-            elif protocolName == 'FA6':
-                modality = 'FP'
-                modalityType = 'Fluorescein Angiography'
-            elif protocolName == 'FAF':
-                modality = 'FP'
-                modalityType = 'Autofluorescence'
-            elif protocolName in ['FP','FP-2','FP-3M','FP-4W','FP-7M','FP-7Std','FP-9','FP-ROP']:
-                log.debug("Inside logic for ColorFundus using IN [FP, FP-2, and so on]")
-                modality = 'FP'
-                modalityType = 'Color' 
-                if protocolName == 'FP-4W': 
-                    subType = 'Wide Field' 
-                else:
-                    subType = 'Standard'    
-            elif protocolName == 'ICG':
-                modality = 'FP'
-                modalityType = 'Indocyanine Green'
-            elif protocolName == 'OCT Angiography':
-                modality = 'OCT'
-                octType = ['Angiography']
-            elif protocolName == 'SD-OCT':
-                modality = 'OCT'
-                octType = ['Standard']
-            elif protocolName == 'UWF-AF':
-                modality = 'FP'
-                modalityType = 'Autofluorescence' 
-                subType = 'Ultra-wide Field'  
-            elif protocolName == 'UWF-C':
-                modality = 'FP'
-                modalityType = 'Color' 
-                subType = 'Ultra-wide Field' 
-            elif protocolName == 'UWF-ICG':
-                modality = 'FP'
-                modalityType = 'Indocyanine Green' 
-                subType = 'Ultra-wide Field'
-            elif protocolName == 'Widefield OCT':
-                modality = 'OCT'
-                octType = ['Standard'] 
-                # octSubType = 'Wide Field'
-
-        elif device_code_sequence and device_code_sequence == 'A-00FBE':
-            modality = 'OCT'
-        elif device_code_sequence and study_description and study_description == 'CF':
-            modality = 'FP'
-            modalityType = 'Color'
-        elif is_OCT(acquisition.label):
-            modality = 'OCT'
-            # updateFlag = True
-
-        if modality:
-            log.debug('In Modality... Got:')
-            log.debug(modality)
-            updateFlag = True 
-            if modalityType:
-                classifications['Type']=[modalityType]
-            if subType:
-                classifications['Sub-Type'] = [subType]
-  
-        # Get Laterality
-        laterality = None
-        if single_header_object.get('ImageLaterality'):
-            if single_header_object.get('ImageLaterality') in ('R','OD'):
-                laterality = ['RIGHT']
-            elif single_header_object.get('ImageLaterality') in ('L','OS'):
-                laterality = ['LEFT']
-        elif is_right(acquisition.label):
-            laterality = ['RIGHT']
-        elif is_left(acquisition.label):
-            laterality = ['LEFT']
-        
-        if laterality:  # set classification laterality
-            classifications['Laterality'] = laterality
-            # classifications.update({"Laterality": laterality}) update later using Dictionary
-        
-        # Get OCT Type
-        if octType is None:
-            if device_code_sequence and device_code_sequence == 'A-00FBE':
-                octType = ['Standard']
-                log.debug("Found match for Standard OCT from AcquisitionDeviceTypeCodeSequence match")
-            elif device_code_sequence and device_code_sequence == 'A-00E8A':
-                octType = ['Fundus']
-                log.debug("Found match for Fundus OCT from AcquisitionDeviceTypeCodeSequence match")
-            elif is_OCT_OP(acquisition.label):
-                octType = ['Fundus']
-                log.debug("Found match for Fundus OCT from is_OCT_OP match")
-            elif is_OCT_OPT(acquisition.label):
-                octType = ['Standard']
-                log.debug("Found match for Standard OCT from is_OCT_OPT match")
-        
-        if modality == 'OCT' and octType:
-            classifications.update({"OCT Type": octType})
-
-        if classifications:
-            dcm_metadata['classification'] = classifications
-
-        if modality:
-            dcm_metadata['modality'] = modality
-            dcm_metadata['type'] = modalityType
-            if subType:
-                dcm_metadata['Sub-Type'] = [subType]
-            log.debug("In Modality last block -> have dcm_metadata:")
-            log.debug(dcm_metadata)  
-        else:
-            log.debug("missing modality last block")      
-    else:
-        log.debug("Updtate Flag is false... Not processing this file")
-        pass
+    fields = read_header_fields(dcm_metadata['info']['header']['dicom'])
+    dcm_metadata.update(get_OPHTHA_update(fields, acquisition.label))
 
     log.debug("Sending dcm_metadata to run module:")
-    log.debug(dcm_metadata)    
+    log.debug(dcm_metadata)
 
     return dcm_metadata
 
+
+def classify_OPHTHA_batch(dcm_metadata_list, acquisition_labels):
+    """Classify many ophthalmic files at once, as classify_OPHTHA
+
+    The files of a study mostly share their header fields and label, so each
+    distinct (HeaderFields, label) is classified once.
+
+    Args:
+        dcm_metadata_list (list): File metadata, with the info.header.dicom of each file
+        acquisition_labels (list): The acquisition label of each file
+
+    Returns:
+        list: dcm_metadata_list, each updated as by classify_OPHTHA
+    """
+    updates = {}
+    for dcm_metadata, label in zip(dcm_metadata_list, acquisition_labels):
+        key = (read_header_fields(dcm_metadata['info']['header']['dicom']), label)
+        try:
+            update = updates.get(key)
+            if update is None:
+                update = updates[key] = get_OPHTHA_update(*key)
+        except TypeError:
+            # Header values that are not hashable, e.g. multi-valued
+            update = get_OPHTHA_update(*key)
+        dcm_metadata.update(_copy_update(update))
+    return dcm_metadata_list
+
+
+def _copy_update(update):
+    """Return a copy of a get_OPHTHA_update, sharing none of its lists"""
+    return {key: ({name: list(values) for name, values in value.items()} if isinstance(value, dict)
+                  else list(value) if isinstance(value, list) else value)
+            for key, value in update.items()}
+
 ## Perform test if run directly
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Sharded, resumable batch classification of the archives of a work manifest
+
+The work manifest is a JSON Lines file with one item per archive:
+
+    {"id": "5e...", "path": "/data/series.zip", "name": "series.zip", "modality": "CT",
+     "label": "CHEST W CONTRAST", "metadata": {"info": {"header": {"dicom": {...}}}}}
+
+metadata (the file metadata, as found in the gear config) is optional: when
+missing, the dicom header of the representative file is used.
+
+Items without a label but with an acquisition_id get the label of their
+acquisition, prefetched for the whole shard when an API URL is given (see
+bulk_client.BulkClient). The metadata updates are then also written to the
+API, in batches, before being checkpointed.
+
+Items are assigned to shards by a hash of their id, so workers need no
+coordination. Each shard appends its results to its own checkpoint file
+in the output folder; a restarted worker skips the items already classified
+in it and retries the failed ones.
+
+The hits of the MR label rules (see MR_classifier.count_rule_hits) are
+checkpointed with the metadata of each item and summed by merge, so that
+an item is counted once it is committed, however often it was retried.
+
+Usage:
+    python batch_classify.py run MANIFEST OUTPUT_DIR --shards 8 --shard 3
+    python batch_classify.py run MANIFEST OUTPUT_DIR --shards 8 --workers 8
+    python batch_classify.py run MANIFEST OUTPUT_DIR --api-url https://flywheel.example.com/api --api-key KEY
+    python batch_classify.py merge MANIFEST OUTPUT_DIR merged.json
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import MR_classifier
+import bulk_client
+import classification
+import dicom_processor
+import run
+
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_PATTERN = 'shard-%04d-of-%04d.jsonl'
+# Number of items whose metadata updates are written to the API at once
+WRITE_BATCH_SIZE = 100
+
+
+def read_manifest(manifest_path):
+    """Return the items of a work manifest"""
+    with open(manifest_path) as manifest_file:
+        return [json.loads(line) for line in manifest_file if line.strip()]
+
+
+def get_shard(item_id, n_shards):
+    """Return the shard of an item, stable across processes and machines
+
+    Examples
+    --------
+    >>> get_shard('5e8f0c', 4)
+    3
+    """
+    return int(hashlib.sha1(item_id.encode('utf-8')).hexdigest(), 16) % n_shards
+
+
+def read_checkpoint(checkpoint_path):
+    """Return the results of a checkpoint file by item id
+
+    A truncated last line, left by a worker killed while writing, is ignored.
+    """
+    results = {}
+    if not os.path.exists(checkpoint_path):
+        return results
+    with open(checkpoint_path) as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                log.warning('Ignoring truncated checkpoint line in %s', checkpoint_path)
+                continue
+            results[result['id']] = result
+    return results
+
+
+def classify_item(item, config_file_path=None):
+    """Classify the archive of a manifest item and return its file metadata update
+
+    Args:
+        item (dict): A work manifest item
+        config_file_path (str): Gear config with the custom classifications, if any
+
+    Returns:
+        dict: The file entry of run.update_metadata
+    """
+    df, dcm = dicom_processor.process_dicom(item['path'])
+    dicom_metadata = copy.deepcopy(item.get('metadata') or {})
+    dicom_metadata.setdefault('modality', item['modality'])
+    header = dicom_metadata.setdefault('info', {}).setdefault('header', {})
+    if 'dicom' not in header:
+        header['dicom'] = dicom_processor.get_pydicom_header(dcm)
+    acquisition = classification.Acquisition(label=item.get('label'))
+    dicom_metadata = classification.classify(df, dcm, dicom_metadata, acquisition, item['modality'],
+                                             config_file_path=config_file_path)
+    output_metadata = run.update_metadata(dicom_metadata, item.get('name', os.path.basename(item['path'])),
+                                          item['modality'])
+    files = output_metadata['acquisition'].get('files')
+    return files[0] if files else {}
+
+
+def write_updates(client, results, counts):
+    """Write the metadata updates of classified items, recording the failed writes as errors
+
+    The updates are written in a single update_files call or, if it fails
+    once its retries are exhausted, one item at a time. The result of an
+    item whose update could not be written becomes an error, so that it is
+    retried by the next run of the shard.
+
+    Args:
+        client (bulk_client.BulkClient): The API client
+        results (list): (item, result) tuples of the classified items
+        counts (dict): The shard counts, items failing to write are moved from 'done' to 'failed'
+    """
+    try:
+        client.update_files([(item['acquisition_id'], result['metadata']) for item, result in results])
+        return
+    except Exception:
+        log.exception('Failed to write %s updates, writing them one at a time', len(results))
+    for item, result in results:
+        try:
+            client.update_files([(item['acquisition_id'], result['metadata'])])
+        except Exception as exc:
+            log.exception('Failed to write the update of %s', item['id'])
+            del result['metadata'], result['rule_hits']
+            result['error'] = 'update failed: %r' % exc
+            counts['done'] -= 1
+            counts['failed'] += 1
+
+
+def run_shard(manifest_path, output_dir, n_shards, shard, config_file_path=None, api_url=None, api_key=None):
+    """Classify the items of a shard that are not in its checkpoint yet
+
+    Results are appended to the shard checkpoint as {"id": ..., "metadata": ...,
+    "rule_hits": ...} or {"id": ..., "error": ...} lines, one item at a time
+    or, when api_url is given, WRITE_BATCH_SIZE items at a time once their
+    updates are written.
+
+    Returns:
+        dict: Number of 'done', 'skipped' and 'failed' items
+    """
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_PATTERN % (shard, n_shards))
+    completed = read_checkpoint(checkpoint_path)
+    items = [item for item in read_manifest(manifest_path)
+             if get_shard(item['id'], n_shards) == shard and 'metadata' not in completed.get(item['id'], {})]
+    counts = {'done': 0, 'skipped': sum(1 for result in completed.values() if 'metadata' in result), 'failed': 0}
+    client = None
+    if api_url:
+        client = bulk_client.BulkClient(api_url, api_key=api_key)
+        client.prefetch_labels([item['acquisition_id'] for item in items
+                                if not item.get('label') and item.get('acquisition_id')])
+    pending = []
+
+    def write_pending():
+        if client:
+            write_updates(client, [(item, result) for item, result in pending
+                                   if 'metadata' in result and item.get('acquisition_id')], counts)
+        for _, result in pending:
+            checkpoint_file.write(json.dumps(result, sort_keys=True) + '\n')
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+        pending.clear()
+
+    with open(checkpoint_path, 'a') as checkpoint_file:
+        for item in items:
+            try:
+                if client and not item.get('label') and item.get('acquisition_id'):
+                    # Acquisitions missed by the prefetch are fetched one at a time
+                    item['label'] = client.get_label(item['acquisition_id'])
+                with MR_classifier.count_rule_hits() as rule_hits:
+                    result = {'id': item['id'], 'metadata': classify_item(item, config_file_path)}
+                result['rule_hits'] = dict(rule_hits)
+                counts['done'] += 1
+            except Exception as exc:
+                log.exception('Failed to classify %s', item['path'])
+                result = {'id': item['id'], 'error': repr(exc)}
+                counts['failed'] += 1
+            pending.append((item, result))
+            if len(pending) >= (WRITE_BATCH_SIZE if client else 1):
+                write_pending()
+        if pending:
+            write_pending()
+    log.info('Shard %s/%s: %s', shard, n_shards, counts)
+    return counts
+
+
+def _run_shard_star(args):
+    return run_shard(*args)
+
+
+def run_shards(manifest_path, output_dir, n_shards, shards=None, workers=1, config_file_path=None, api_url=None,
+               api_key=None):
+    """Run shards (all by default) with a pool of local worker processes
+
+    The workers are not daemon processes (unlike those of multiprocessing.Pool),
+    so that they can search the custom classification regexes in a worker
+    process bounded in time (see safe_regex.search_with_timeout).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shards = range(n_shards) if shards is None else shards
+    tasks = [(manifest_path, output_dir, n_shards, shard, config_file_path, api_url, api_key)
+             for shard in shards]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            return list(executor.map(_run_shard_star, tasks))
+    return [_run_shard_star(task) for task in tasks]
+
+
+def merge(manifest_path, output_dir):
+    """Combine the shard checkpoints of output_dir, in manifest order
+
+    Returns:
+        dict: 'files' (metadata updates), 'errors' (id: error),
+            'missing' (ids with no result yet) and 'rule_hits' (MR label rule
+            hits of the classified items)
+    """
+    results = {}
+    for checkpoint_path in sorted(glob.glob(os.path.join(output_dir, 'shard-*-of-*.jsonl'))):
+        results.update(read_checkpoint(checkpoint_path))
+    rule_hits = Counter()
+    merged = {'files': [], 'errors': {}, 'missing': []}
+    for item in read_manifest(manifest_path):
+        result = results.get(item['id'])
+        if result is None:
+            merged['missing'].append(item['id'])
+        elif 'error' in result:
+            merged['errors'][item['id']] = result['error']
+        else:
+            merged['files'].append(dict(result['metadata'], id=item['id']))
+            rule_hits.update(result.get('rule_hits', {}))
+    merged['rule_hits'] = dict(rule_hits)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='Classify the items of one or all shards')
+    run_parser.add_argument('manifest')
+    run_parser.add_argument('output_dir')
+    run_parser.add_argument('--shards', type=int, default=1, help='Total number of shards')
+    run_parser.add_argument('--shard', type=int, action='append', help='Shard to run, all by default')
+    run_parser.add_argument('--workers', type=int, default=1, help='Local worker processes')
+    run_parser.add_argument('--config', help='Gear config.json with custom classifications')
+    run_parser.add_argument('--api-url', help='Flywheel API URL to fetch labels from and write the updates to')
+    run_parser.add_argument('--api-key', default=os.environ.get('FW_API_KEY'), help='Flywheel API key')
+    merge_parser = subparsers.add_parser('merge', help='Combine the shard checkpoints')
+    merge_parser.add_argument('manifest')
+    merge_parser.add_argument('output_dir')
+    merge_parser.add_argument('merged', help='Merged JSON output')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        counts = run_shards(args.manifest, args.output_dir, args.shards, shards=args.shard, workers=args.workers,
+                            config_file_path=args.config, api_url=args.api_url, api_key=args.api_key)
+        return 1 if any(shard_counts['failed'] for shard_counts in counts) else 0
+    merged = merge(args.manifest, args.output_dir)
+    with open(args.merged, 'w') as merged_file:
+        json.dump(merged, merged_file, sort_keys=True, indent=4)
+    log.info('Merged %s files, %s errors, %s missing', len(merged['files']), len(merged['errors']),
+             len(merged['missing']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
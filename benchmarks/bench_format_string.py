@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Micro-benchmark of dicom_processor.format_string over realistic header strings
+
+Usage:
+    PYTHONPATH=. python benchmarks/bench_format_string.py [--number N]
+"""
+import argparse
+import re
+import string
+import timeit
+
+import dicom_processor
+
+
+def legacy_format_string(in_string):
+    """format_string implementation prior to the translate-table fast path"""
+    formatted = re.sub(r'[^\x00-\x7f]', r'', str(in_string))
+    formatted = ''.join(filter(lambda x: x in string.printable, formatted))
+    if len(formatted) == 1 and formatted == '?':
+        formatted = None
+    return formatted
+
+
+# Values shaped like the strings found in a typical MR/CT/PT header
+HEADER_STRINGS = {
+    'short_ascii': ['MR', 'ORIGINAL', 'HFS', 'SIEMENS', 'T1_MPRAGE_SAG', '1.3.12.2.1107.5.2.32.35177'],
+    'person_name': ['Doe^John', 'Müller^Jürgen', 'Øster^Åse'],
+    'long_comment': ['Patient moved during acquisition, repeat scan advised. ' * 40],
+    'long_non_ascii': ['Kontrastmittel: ja; Bewegungsartefakte möglich. ' * 40],
+    'private_lt': ['ASCCONV BEGIN\n\tsKSpace.lBaseResolution = 256\n\tsTXSPEC.asNucleusInfo[0].tNucleus = "1H"\n' * 200],
+}
+
+
+def run(number):
+    results = {}
+    for case, values in HEADER_STRINGS.items():
+        for name, func in (('legacy', legacy_format_string), ('current', dicom_processor.format_string)):
+            for value in values:
+                assert legacy_format_string(value) == dicom_processor.format_string(value)
+            seconds = timeit.timeit(lambda: [func(v) for v in values], number=number)
+            results[(case, name)] = seconds / (number * len(values))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=2000, help='Repetitions per case')
+    args = parser.parse_args()
+
+    results = run(args.number)
+    print(f'{"case":<16}{"legacy (us)":>14}{"current (us)":>14}{"speedup":>10}')
+    for case in HEADER_STRINGS:
+        legacy = results[(case, 'legacy')] * 1e6
+        current = results[(case, 'current')] * 1e6
+        print(f'{case:<16}{legacy:>14.2f}{current:>14.2f}{legacy / current:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
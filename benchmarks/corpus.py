@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""Deterministic generator of synthetic zipped DICOM series for benchmarks
+
+The same arguments always produce the same archive, byte for byte, so that
+timings of dicom_processor and the classifiers can be compared across changes
+on production-like shapes, without patient data.
+
+Usage:
+    PYTHONPATH=. python benchmarks/corpus.py OUTPUT.zip [--modality CT] [--slices 10000] ...
+    PYTHONPATH=. python benchmarks/corpus.py OUTPUT_DIR --preset all
+"""
+import argparse
+import os
+import random
+import zipfile
+from io import BytesIO
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+SOP_CLASS_UIDS = {
+    'MR': '1.2.840.10008.5.1.4.1.1.4',
+    'CT': '1.2.840.10008.5.1.4.1.1.2',
+    'PT': '1.2.840.10008.5.1.4.1.1.128',
+    'OP': '1.2.840.10008.5.1.4.1.1.77.1.5.1',
+}
+ENHANCED_SOP_CLASS_UIDS = {
+    'MR': '1.2.840.10008.5.1.4.1.1.4.1',
+    'CT': '1.2.840.10008.5.1.4.1.1.2.1',
+    'PT': '1.2.840.10008.5.1.4.1.1.130',
+}
+# Series descriptions cycled through the series of an archive
+SERIES_DESCRIPTIONS = {
+    'MR': ['T1 MPRAGE SAG', 'AX T2 FLAIR', 'ep2d_bold_rest', 'DTI 64 dir', 'Localizer'],
+    'CT': ['CAP W CONTRAST 3.0 B31f', 'TOPOGRAM', 'HEAD WO 5.0 H30s'],
+    'PT': ['PET WB AC', 'PET WB NAC'],
+    'OP': ['Color Fundus OD', 'Color Fundus OS'],
+}
+PRIVATE_GROUP = 0x0029
+PRIVATE_CREATOR = 'SYNTHETIC BLOAT %d'
+# Fixed timestamp of the zip members, for reproducible archives
+ZIP_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+SLICE_SPACING = 1.5
+
+# Archive shapes used by the benchmark suite
+PRESETS = {
+    'small': {'modality': 'MR', 'n_slices': 32, 'rows': 64, 'columns': 64},
+    'medium': {'modality': 'CT', 'n_slices': 512, 'rows': 128, 'columns': 128, 'private_tags': 20,
+               'sequence_items': 50, 'corrupted': 2, 'empty': 2},
+    'huge': {'modality': 'CT', 'n_slices': 10000, 'rows': 64, 'columns': 64},
+    'enhanced': {'modality': 'MR', 'n_slices': 256, 'rows': 64, 'columns': 64, 'enhanced': True},
+    'multi_series': {'modality': 'PT', 'n_slices': 400, 'rows': 64, 'columns': 64, 'n_series': 2},
+    'ophtha': {'modality': 'OP', 'n_slices': 2, 'rows': 64, 'columns': 64, 'n_series': 2},
+}
+
+# Fragments of the acquisition labels and series descriptions found in the wild
+LABEL_FRAGMENTS = [
+    'T1', 'T2', 'FLAIR', 'MPRAGE', 'ep2d_bold', 'rest', 'task', 'DTI', 'DWI', 'ADC', 'SWI', 'localizer',
+    '3-plane loc', 'fieldmap', 'B0 map', 'ASL', 'PD', 'STIR', 'MIP', 'post gad', 'pre', 'AX', 'SAG', 'COR',
+    'CAP', 'W CONTRAST', 'WO CONTRAST', 'HEAD', 'NECK', 'CHEST', 'ABD', 'PEL', 'WB', 'TOPOGRAM', 'LUNG',
+    'BONE', 'arterial', 'portal venous', 'delayed', 'PET AC', 'PET NAC', 'Fundus OD', 'Fundus OS', 'OCT',
+    'macula', 'spine', 'knee', 'shoulder', 'brain', 'vertex to thighs', 'skull base to mid thigh', 'calibration',
+    'shim', 'perfusion', 'MoCoSeries', 'phase', 'mag', 'ND', 'NORM', 'screen save',
+]
+LABEL_SUFFIXES = ['', '', ' 3.0 B31f', ' 5.0 H30s', ' 1mm', ' iso', ' RR', ' (2)', ' SENSE', ' p2']
+
+
+def generate_labels(n_labels=10000, seed=0):
+    """Return n_labels deterministic labels made of LABEL_FRAGMENTS"""
+    rng = random.Random(seed)
+    labels = []
+    for _ in range(n_labels):
+        fragments = rng.sample(LABEL_FRAGMENTS, rng.randint(1, 4))
+        labels.append(rng.choice([' ', '_', '-']).join(fragments) + rng.choice(LABEL_SUFFIXES))
+    return labels
+
+
+def _uid(seed, *parts):
+    return generate_uid(entropy_srcs=[str(seed)] + [str(part) for part in parts])
+
+
+def _series_dataset(modality, seed, series_idx, rows, columns, private_tags, private_tag_size, sequence_items):
+    """Return the attributes shared by all the slices of a series"""
+    dataset = Dataset()
+    dataset.PatientName = 'Synthetic^Patient'
+    dataset.PatientID = 'SYNTHETIC-%d' % seed
+    dataset.StudyInstanceUID = _uid(seed, 'study')
+    dataset.SeriesInstanceUID = _uid(seed, 'series', series_idx)
+    dataset.SeriesNumber = series_idx + 1
+    dataset.AcquisitionNumber = 1
+    dataset.SeriesDescription = SERIES_DESCRIPTIONS[modality][series_idx % len(SERIES_DESCRIPTIONS[modality])]
+    dataset.Modality = modality
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+    dataset.Rows = rows
+    dataset.Columns = columns
+    dataset.SamplesPerPixel = 1
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelSpacing = [0.5, 0.5]
+    dataset.SliceThickness = SLICE_SPACING
+    dataset.BitsAllocated = 8 if modality == 'OP' else 16
+    dataset.BitsStored = 8 if modality == 'OP' else 12
+    dataset.HighBit = dataset.BitsStored - 1
+    dataset.PixelRepresentation = 0
+    if modality == 'MR':
+        dataset.MagneticFieldStrength = 3
+        dataset.RepetitionTime = 2300
+        dataset.EchoTime = 2.98
+        dataset.InversionTime = 900
+        dataset.ScanningSequence = ['GR', 'IR']
+    elif modality == 'CT':
+        dataset.KVP = 120
+        dataset.ConvolutionKernel = 'B31f'
+    elif modality == 'PT':
+        dataset.CorrectedImage = ['DECY', 'ATTN'] if series_idx % 2 == 0 else ['DECY']
+        radiopharmaceutical = Dataset()
+        radiopharmaceutical.Radiopharmaceutical = 'Fluorodeoxyglucose'
+        radiopharmaceutical.RadionuclideTotalDose = 370000000
+        dataset.RadiopharmaceuticalInformationSequence = Sequence([radiopharmaceutical])
+    elif modality == 'OP':
+        dataset.ImageLaterality = 'R' if series_idx % 2 == 0 else 'L'
+    for block_idx in range(0, private_tags, 0xF0):
+        block = dataset.private_block(PRIVATE_GROUP, PRIVATE_CREATOR % block_idx, create=True)
+        for element_offset in range(min(0xF0, private_tags - block_idx)):
+            block.add_new(element_offset, 'OB', bytes(private_tag_size))
+    if sequence_items:
+        items = []
+        for item_idx in range(sequence_items):
+            item = Dataset()
+            item.ReferencedSOPClassUID = SOP_CLASS_UIDS[modality]
+            item.ReferencedSOPInstanceUID = _uid(seed, 'reference', series_idx, item_idx)
+            items.append(item)
+        dataset.ReferencedImageSequence = Sequence(items)
+    return dataset
+
+
+def _dicom_bytes(dataset, sop_class_uid, sop_instance_uid):
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_dataset = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    file_dataset.update(dataset)
+    file_dataset.SOPClassUID = sop_class_uid
+    file_dataset.SOPInstanceUID = sop_instance_uid
+    file_dataset.is_little_endian = True
+    file_dataset.is_implicit_VR = False
+    fp = BytesIO()
+    pydicom.dcmwrite(fp, file_dataset, write_like_original=False)
+    return fp.getvalue()
+
+
+def _plane_item(keyword, value):
+    item = Dataset()
+    setattr(item, keyword, value)
+    return item
+
+
+def iter_series_members(modality='MR', n_slices=64, rows=256, columns=256, enhanced=False, private_tags=0,
+                        private_tag_size=1024, sequence_items=0, n_series=1, corrupted=0, empty=0, seed=0):
+    """Yield the (name, data) zip members of a synthetic archive
+
+    See write_series_zip for the arguments.
+    """
+    rng = np.random.RandomState(seed)
+    dtype = np.uint8 if modality == 'OP' else np.uint16
+    orientation = [1, 0, 0, 0, 1, 0]
+    slices_per_series = [len(chunk) for chunk in np.array_split(np.arange(n_slices), n_series)]
+    for series_idx, series_slices in enumerate(slices_per_series):
+        dataset = _series_dataset(modality, seed, series_idx, rows, columns, private_tags, private_tag_size,
+                                  sequence_items)
+        # A single noise image per series keeps generation fast while compressing like real data
+        pixels = rng.randint(0, 2 ** dataset.BitsStored, size=(rows, columns)).astype(dtype).tobytes()
+        if enhanced:
+            dataset.NumberOfFrames = series_slices
+            shared = Dataset()
+            shared.PlaneOrientationSequence = Sequence([_plane_item('ImageOrientationPatient', orientation)])
+            dataset.SharedFunctionalGroupsSequence = Sequence([shared])
+            frames = []
+            for slice_idx in range(series_slices):
+                frame = Dataset()
+                frame.PlanePositionSequence = Sequence([_plane_item('ImagePositionPatient',
+                                                                    [0, 0, slice_idx * SLICE_SPACING])])
+                frames.append(frame)
+            dataset.PerFrameFunctionalGroupsSequence = Sequence(frames)
+            dataset.PixelData = pixels * series_slices
+            yield ('%02d/00000.dcm' % series_idx,
+                   _dicom_bytes(dataset, ENHANCED_SOP_CLASS_UIDS[modality], _uid(seed, 'image', series_idx)))
+            continue
+        dataset.PixelData = pixels
+        for slice_idx in range(series_slices):
+            dataset.InstanceNumber = slice_idx + 1
+            if modality != 'OP':
+                dataset.ImageOrientationPatient = orientation
+                dataset.ImagePositionPatient = [0, 0, slice_idx * SLICE_SPACING]
+                dataset.SliceLocation = slice_idx * SLICE_SPACING
+            yield ('%02d/%05d.dcm' % (series_idx, slice_idx),
+                   _dicom_bytes(dataset, SOP_CLASS_UIDS[modality], _uid(seed, 'image', series_idx, slice_idx)))
+    for idx in range(corrupted):
+        # Passes the DICOM magic check but fails to parse
+        yield 'corrupted_%03d.dcm' % idx, b'\0' * 128 + b'DICM' + rng.bytes(256)
+    for idx in range(empty):
+        yield 'empty_%03d.dcm' % idx, b''
+
+
+def write_series_zip(zip_path, modality='MR', n_slices=64, rows=256, columns=256, enhanced=False, private_tags=0,
+                     private_tag_size=1024, sequence_items=0, n_series=1, corrupted=0, empty=0, seed=0):
+    """Write a synthetic zipped DICOM series
+
+    Args:
+        zip_path (str): Path of the zip archive to write
+        modality (str): 'MR', 'CT', 'PT' or 'OP'
+        n_slices (int): Total number of slices (frames if enhanced) over all the series
+        rows (int): Number of rows of the images
+        columns (int): Number of columns of the images
+        enhanced (bool): If True, each series is written as a single enhanced
+            multi-frame file (not available for 'OP')
+        private_tags (int): Number of private OB elements added to each slice
+        private_tag_size (int): Size in bytes of each private element
+        sequence_items (int): Number of items of the ReferencedImageSequence of each slice
+        n_series (int): Number of series the slices are split into
+        corrupted (int): Number of members that look like DICOM but fail to parse
+        empty (int): Number of empty members
+        seed (int): Seed of the UIDs and pixel data
+
+    Returns:
+        int: Number of members written
+    """
+    n_members = 0
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        for name, data in iter_series_members(modality=modality, n_slices=n_slices, rows=rows, columns=columns,
+                                              enhanced=enhanced, private_tags=private_tags,
+                                              private_tag_size=private_tag_size, sequence_items=sequence_items,
+                                              n_series=n_series, corrupted=corrupted, empty=empty, seed=seed):
+            zip_info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+            zip_info.compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(zip_info, data)
+            n_members += 1
+    return n_members
+
+
+def write_preset(output_folder, preset, seed=0):
+    """Write the archive of a PRESETS shape to output_folder/<preset>.zip and return its path"""
+    zip_path = os.path.join(output_folder, '%s.zip' % preset)
+    write_series_zip(zip_path, seed=seed, **PRESETS[preset])
+    return zip_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help='Zip archive to write, or folder with --preset')
+    parser.add_argument('--preset', choices=sorted(PRESETS) + ['all'], help='Write a benchmark preset archive')
+    parser.add_argument('--modality', choices=sorted(SOP_CLASS_UIDS), default='MR')
+    parser.add_argument('--slices', type=int, default=64, help='Total number of slices')
+    parser.add_argument('--rows', type=int, default=256)
+    parser.add_argument('--columns', type=int, default=256)
+    parser.add_argument('--enhanced', action='store_true', help='Write enhanced multi-frame files')
+    parser.add_argument('--private-tags', type=int, default=0, help='Private elements per slice')
+    parser.add_argument('--private-tag-size', type=int, default=1024, help='Bytes per private element')
+    parser.add_argument('--sequence-items', type=int, default=0, help='Items of a ReferencedImageSequence')
+    parser.add_argument('--series', type=int, default=1, help='Number of series in the archive')
+    parser.add_argument('--corrupted', type=int, default=0, help='Number of corrupted members')
+    parser.add_argument('--empty', type=int, default=0, help='Number of empty members')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.preset:
+        os.makedirs(args.output, exist_ok=True)
+        for preset in sorted(PRESETS) if args.preset == 'all' else [args.preset]:
+            print(write_preset(args.output, preset, seed=args.seed))
+        return
+    n_members = write_series_zip(args.output, modality=args.modality, n_slices=args.slices, rows=args.rows,
+                                 columns=args.columns, enhanced=args.enhanced, private_tags=args.private_tags,
+                                 private_tag_size=args.private_tag_size, sequence_items=args.sequence_items,
+                                 n_series=args.series, corrupted=args.corrupted, empty=args.empty, seed=args.seed)
+    print('Wrote %s members to %s' % (n_members, args.output))
+
+
+if __name__ == '__main__':
+    main()
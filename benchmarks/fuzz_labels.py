@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Fuzz benchmark of the label rules on worst-case labels
+
+Every pattern of the label rules (rule_engine.RULES) is linted with
+safe_regex.lint_regex and searched in labels built to make its regexes
+backtrack: the literals of the pattern repeated, truncated so that they never
+complete, out of order, split over lines, and random mixes of them. Labels are searched untruncated, at
+MAX_LABEL_LENGTH and at --scale times that length, to expose super-linear
+regexes. The exit code is 1 if the linter reports a regex or if a search
+takes more than --budget-ms.
+
+Usage:
+    PYTHONPATH=. python benchmarks/fuzz_labels.py [--scale 10] [--budget-ms 5] [--seed 0]
+"""
+import argparse
+import random
+import re
+import sys
+import time
+
+import common_utils
+import rule_engine
+import safe_regex
+
+DEFAULT_SCALE = 10
+DEFAULT_BUDGET_MS = 5.0
+N_RANDOM_LABELS = 20
+SEPARATORS = ['', ' ', '_', '\n']
+
+
+def get_rule_sets():
+    """Return the compiled regexes of every pattern of the label rules, by pattern name"""
+    return {name: pattern.regexes for name, pattern in sorted(rule_engine.RULES.patterns.items())}
+
+
+def generate_labels(regexes, length, rng):
+    """Return worst-case labels of about length characters for a rule set"""
+    literals = sorted({literal for regex in regexes for literal in re.findall('[A-Za-z0-9]{2,}', regex.pattern)})
+    literals = literals or ['x']
+    labels = []
+    for literal in literals:
+        for separator in SEPARATORS:
+            for fragment in (literal, literal[:-1]):
+                labels.append(((fragment + separator) * length)[:length])
+    for separator in SEPARATORS:
+        labels.append(''.join((literal + separator) * (length // (len(literals) * (len(literal) + 1)) + 1)
+                              for literal in reversed(literals))[:length])
+    for _ in range(N_RANDOM_LABELS):
+        label = ''
+        while len(label) < length:
+            label += rng.choice(literals)[:rng.randint(1, 8)] + rng.choice(SEPARATORS)
+        labels.append(label[:length])
+    return labels
+
+
+def fuzz(rule_sets, length, rng):
+    """Return the slowest search of each rule set, as (milliseconds, pattern, label)"""
+    slowest = {}
+    for name, regexes in rule_sets.items():
+        worst = (0.0, None, None)
+        for label in generate_labels(regexes, length, rng):
+            for regex in regexes:
+                start = time.perf_counter()
+                regex.search(label)
+                elapsed = (time.perf_counter() - start) * 1000
+                if elapsed > worst[0]:
+                    worst = (elapsed, regex.pattern, label)
+        slowest[name] = worst
+    return slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=int, default=DEFAULT_SCALE,
+                        help='Longest labels, in multiples of MAX_LABEL_LENGTH')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum milliseconds of a single search')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rule_sets = get_rule_sets()
+    failed = bool(safe_regex.lint_rules(rule_sets))
+    max_length = common_utils.MAX_LABEL_LENGTH or 256
+    for length in (max_length, max_length * args.scale):
+        print('Labels of %s characters' % length)
+        for name, (elapsed, pattern, label) in fuzz(rule_sets, length, random.Random(args.seed)).items():
+            over = elapsed > args.budget_ms
+            failed = failed or over
+            print('  %-50s %8.3f ms  %r%s' % (name, elapsed, pattern, '  OVER BUDGET' if over else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
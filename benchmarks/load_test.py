@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Offline load test of the full run.py entry point against a fake gear context
+
+Runs --jobs gear jobs as separate processes, --concurrency at a time, on a
+synthetic archive. The Flywheel API is replaced by a gear_context.FakeGearContext
+fixture injecting --latency seconds and --failure-rate failures per call.
+
+Usage:
+    PYTHONPATH=. python benchmarks/load_test.py [--jobs 200] [--concurrency 16] [--preset small]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import corpus
+
+RUN_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run.py')
+ACQUISITION_ID = '000000000000000000000000'
+
+
+def write_job(job_dir, zip_path, modality, label, latency, failure_rate, seed):
+    """Write the config and fake context fixture of a job and return their paths"""
+    os.makedirs(os.path.join(job_dir, 'output'))
+    config = {
+        'config': {},
+        'inputs': {'dicom': {
+            'location': {'path': zip_path, 'name': os.path.basename(zip_path)},
+            'object': {'modality': modality, 'info': {'header': {'dicom': {'SeriesDescription': label}}}},
+        }},
+    }
+    fixture = {'acquisition': {'id': ACQUISITION_ID, 'label': label}, 'latency': latency,
+               'failure_rate': failure_rate, 'seed': seed}
+    config_path = os.path.join(job_dir, 'config.json')
+    fixture_path = os.path.join(job_dir, 'context.json')
+    with open(config_path, 'w') as config_file:
+        json.dump(config, config_file)
+    with open(fixture_path, 'w') as fixture_file:
+        json.dump(fixture, fixture_file)
+    return config_path, fixture_path
+
+
+def run_job(job_dir, config_path, fixture_path):
+    """Run run.py for a job and return (success, wall seconds)"""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, RUN_PY, '--config', config_path, '--output',
+                              os.path.join(job_dir, 'output'), '--fake-context', fixture_path],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process.returncode == 0, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=os.cpu_count())
+    parser.add_argument('--preset', choices=sorted(corpus.PRESETS), default='small')
+    parser.add_argument('--label', default='T1 MPRAGE SAG', help='Acquisition label of the fake acquisition')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of latency of each API call')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of an API call failure')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        zip_path = corpus.write_preset(work_dir, args.preset)
+        modality = corpus.PRESETS[args.preset]['modality']
+        jobs = []
+        for job_idx in range(args.jobs):
+            job_dir = os.path.join(work_dir, 'job_%05d' % job_idx)
+            jobs.append((job_dir,) + write_job(job_dir, zip_path, modality, args.label, args.latency,
+                                               args.failure_rate, seed=job_idx))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda job: run_job(*job), jobs))
+        wall_seconds = time.perf_counter() - start
+
+    timings = sorted(seconds for _, seconds in results)
+    n_failed = sum(1 for success, _ in results if not success)
+    print('%s jobs (%s failed) in %.1fs: %.1f jobs/s' % (len(results), n_failed, wall_seconds,
+                                                         len(results) / wall_seconds))
+    print('job wall time: p50 %.2fs, p95 %.2fs, max %.2fs' % (
+        statistics.median(timings), timings[int(0.95 * (len(timings) - 1))], timings[-1]))
+
+
+if __name__ == '__main__':
+    main()
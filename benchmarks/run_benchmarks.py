@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""End-to-end benchmark suite of dicom_processor and the classifiers
+
+Archives are generated once with benchmarks/corpus.py into --corpus-dir.
+Results are written to --output as JSON and compared to --baseline: a
+benchmark whose median got slower than the baseline by more than --threshold
+is reported as a regression and the exit code is 1.
+
+Usage:
+    PYTHONPATH=. python benchmarks/run_benchmarks.py [--huge] [--filter classify] [--threshold 0.2]
+    PYTHONPATH=. python benchmarks/run_benchmarks.py --save-baseline
+"""
+import argparse
+import contextlib
+import copy
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import timeit
+import zipfile
+from io import BytesIO
+
+import flywheel
+import pandas as pd
+import pydicom
+
+import corpus
+import CT_classifier
+import MR_classifier
+import OPHTHA_classifier
+import PT_classifier
+import common_utils
+import dicom_processor
+import label_classifier
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPUS_DIR = os.path.join(BENCHMARKS_DIR, '.corpus')
+DEFAULT_OUTPUT = os.path.join(BENCHMARKS_DIR, 'results.json')
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline.json')
+DEFAULT_THRESHOLD = 0.2
+N_LABELS = 10000
+# Acquisition label and archive preset of the fixed classifier inputs
+CLASSIFIER_INPUTS = {
+    'MR': ('T1 MPRAGE SAG', 'small'),
+    'CT': ('CAP W CONTRAST', 'medium'),
+    'PT': ('PET WB AC', 'multi_series'),
+    'OP': ('Color Fundus OD', 'ophtha'),
+}
+
+
+def get_corpus(corpus_dir, presets):
+    """Return the archive path of each preset, generating the missing ones"""
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = {}
+    for preset in presets:
+        paths[preset] = os.path.join(corpus_dir, '%s.zip' % preset)
+        if not os.path.exists(paths[preset]):
+            print('Generating %s' % paths[preset], file=sys.stderr)
+            corpus.write_preset(corpus_dir, preset)
+    return paths
+
+
+def _classifier_input(zip_path, modality, label):
+    df, dcm = dicom_processor.process_dicom(zip_path)
+    dcm_metadata = {'modality': modality, 'info': {'header': {'dicom': dicom_processor.get_pydicom_header(dcm)}}}
+    return df, dcm, dcm_metadata, flywheel.Acquisition(label=label)
+
+
+def get_benchmarks(paths, labels):
+    """Return the benchmarks as a dict of name: (func, number of calls per round)
+
+    Classifier inputs are deep copied on each call since the classifiers
+    update dcm_metadata in place.
+    """
+    benchmarks = {}
+    for preset in ('small', 'medium', 'huge'):
+        if preset in paths:
+            benchmarks['process_dicom[%s]' % preset] = (
+                lambda zip_path=paths[preset]: dicom_processor.process_dicom(zip_path), 1)
+
+    with zipfile.ZipFile(paths['medium']) as zip_file:
+        dcm = pydicom.dcmread(BytesIO(zip_file.read(zip_file.infolist()[0])), stop_before_pixels=True)
+    benchmarks['get_pydicom_header'] = (lambda: dicom_processor.get_pydicom_header(dcm), 10)
+
+    inputs = {modality: _classifier_input(paths[preset], modality, label)
+              for modality, (label, preset) in CLASSIFIER_INPUTS.items()}
+    df, dcm, dcm_metadata, acquisition = inputs['MR']
+    benchmarks['classify_MR'] = (
+        lambda: MR_classifier.classify_MR(df, dcm, copy.deepcopy(dcm_metadata), acquisition), 10)
+    ct_df, _, ct_metadata, ct_acquisition = inputs['CT']
+    benchmarks['classify_CT'] = (
+        lambda: CT_classifier.classify_CT(ct_df, copy.deepcopy(ct_metadata), ct_acquisition), 10)
+    pt_df, _, pt_metadata, pt_acquisition = inputs['PT']
+    benchmarks['classify_PT'] = (
+        lambda: PT_classifier.classify_PT(pt_df, copy.deepcopy(pt_metadata), pt_acquisition), 10)
+    _, _, op_metadata, op_acquisition = inputs['OP']
+    benchmarks['classify_OPHTHA'] = (
+        lambda: OPHTHA_classifier.classify_OPHTHA(copy.deepcopy(op_metadata), op_acquisition), 10)
+
+    benchmarks['infer_classification[%s labels]' % len(labels)] = (
+        lambda: [MR_classifier.infer_classification(label) for label in labels], 1)
+    benchmarks['get_anatomy_from_label[%s labels]' % len(labels)] = (
+        lambda: [common_utils.get_anatomy_from_label(label) for label in labels], 1)
+    label_series = pd.Series(labels, dtype=object)
+    benchmarks['classify_labels[%s labels]' % len(labels)] = (
+        lambda: label_classifier.classify_labels(label_series), 1)
+    return benchmarks
+
+
+def run(benchmarks, rounds):
+    """Time each benchmark and return a dict of name: stats (seconds per call)
+
+    The stdout of the benchmarked functions (e.g. infer_classification
+    prints every label) is discarded.
+    """
+    results = {}
+    for name, (func, number) in benchmarks.items():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            func()  # Warm up regex and import caches
+            timings = [seconds / number for seconds in timeit.repeat(func, repeat=rounds, number=number)]
+        results[name] = {'min': min(timings), 'median': statistics.median(timings),
+                         'mean': statistics.mean(timings), 'rounds': rounds, 'number': number}
+        print('%-45s %12.3f ms' % (name, results[name]['median'] * 1e3), file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compare the medians of results to the baseline ones
+
+    Returns:
+        dict: name: ratio of the current to the baseline median, for the
+            benchmarks slower than the baseline by more than threshold
+    """
+    regressions = {}
+    for name, stats in sorted(results.items()):
+        baseline_stats = baseline.get(name)
+        if baseline_stats is None:
+            print('%-45s %12s' % (name, 'new'))
+            continue
+        ratio = stats['median'] / baseline_stats['median']
+        status = 'REGRESSION' if ratio > 1 + threshold else 'faster' if ratio < 1 - threshold else 'ok'
+        print('%-45s %11.2fx %s' % (name, ratio, status))
+        if status == 'REGRESSION':
+            regressions[name] = ratio
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR, help='Folder of the generated archives')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON results file')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='Write the results to --baseline')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Relative slowdown of the median reported as a regression')
+    parser.add_argument('--rounds', type=int, default=5, help='Timed rounds per benchmark')
+    parser.add_argument('--huge', action='store_true', help='Include the 10k slices archive')
+    parser.add_argument('--filter', default='', help='Only run the benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    # The medium archive has corrupted members, whose errors would be logged on every call
+    logging.disable(logging.ERROR)
+    presets = set(preset for _, preset in CLASSIFIER_INPUTS.values()) | {'small', 'medium'}
+    if args.huge:
+        presets.add('huge')
+    benchmarks = get_benchmarks(get_corpus(args.corpus_dir, sorted(presets)), corpus.generate_labels(N_LABELS))
+    benchmarks = {name: benchmark for name, benchmark in benchmarks.items() if args.filter in name}
+    results = {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor()},
+        'benchmarks': run(benchmarks, args.rounds),
+    }
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, sort_keys=True, indent=4)
+    print('Wrote %s' % output, file=sys.stderr)
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results['benchmarks'], baseline['benchmarks'], args.threshold)
+    if regressions:
+        print('%s benchmarks regressed by more than %d%%' % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Bulk Flywheel API I/O for batch classification
+
+Acquisition labels are prefetched for a whole batch in a few paged, filtered
+calls and cached by id. File metadata updates are coalesced per file and sent
+concurrently over a single pooled HTTP session, with retries and exponential
+backoff on throttling and server errors.
+"""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 200
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 0.5
+TIMEOUT_SECONDS = 30
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class BulkClient:
+    """Pooled, retrying client of the Flywheel endpoints used in batch mode
+
+    Args:
+        api_url (str): Base URL of the API, e.g. https://flywheel.example.com/api
+        api_key (str): API key, if any
+        page_size (int): Number of acquisitions fetched per call
+        max_workers (int): Maximum number of concurrent requests (and pooled connections)
+        max_retries (int): Retries of a request on connection errors and RETRY_STATUS_CODES
+        backoff (float): Seconds before the first retry, doubled on each retry
+        timeout (float): Seconds before a request times out
+    """
+
+    def __init__(self, api_url, api_key=None, page_size=PAGE_SIZE, max_workers=MAX_WORKERS,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF_SECONDS, timeout=TIMEOUT_SECONDS):
+        self.api_url = api_url.rstrip('/')
+        self.page_size = page_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = 'scitran-user %s' % api_key
+        self.labels = {}
+
+    def request(self, method, path, **kwargs):
+        """Send a request, retrying with exponential backoff, and return the decoded JSON response"""
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, self.api_url + path, timeout=self.timeout, **kwargs)
+            except requests.ConnectionError:
+                if attempt == self.max_retries:
+                    raise
+                log.warning('Connection error on %s %s, retrying in %.1fs', method, path, delay)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response.json() if response.content else None
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                log.warning('%s on %s %s, retrying in %.1fs', response.status_code, method, path, delay)
+            time.sleep(delay)
+            delay *= 2
+
+    def _fetch_labels(self, acquisition_ids):
+        acquisitions = self.request('GET', '/acquisitions', params={
+            'filter': '_id=|[%s]' % ','.join(acquisition_ids), 'limit': len(acquisition_ids)})
+        return {acquisition['_id']: acquisition.get('label') for acquisition in acquisitions}
+
+    def prefetch_labels(self, acquisition_ids):
+        """Fetch the labels of the acquisitions not cached yet, page_size acquisitions per call
+
+        Returns:
+            dict: The cached labels by acquisition id
+        """
+        missing = sorted(set(acquisition_ids) - set(self.labels))
+        pages = [missing[start:start + self.page_size] for start in range(0, len(missing), self.page_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for labels in executor.map(self._fetch_labels, pages):
+                self.labels.update(labels)
+        log.info('Prefetched %s acquisition labels in %s calls', len(missing), len(pages))
+        return self.labels
+
+    def get_label(self, acquisition_id):
+        """Return the label of an acquisition, fetched on its own if it is not cached"""
+        if acquisition_id not in self.labels:
+            self.labels[acquisition_id] = self.request('GET', '/acquisitions/%s' % acquisition_id).get('label')
+        return self.labels[acquisition_id]
+
+    def _update_file(self, update):
+        (acquisition_id, name), file_metadata = update
+        path = '/acquisitions/%s/files/%s' % (acquisition_id, quote(name, safe=''))
+        if 'classification' in file_metadata:
+            self.request('POST', path + '/classification', json={'replace': file_metadata['classification']})
+        if file_metadata.get('info'):
+            self.request('POST', path + '/info', json={'set': file_metadata['info']})
+        if 'modality' in file_metadata:
+            self.request('PUT', path, json={'modality': file_metadata['modality']})
+
+    def update_files(self, updates):
+        """Write file metadata updates, coalesced per file
+
+        Updates of the same file are merged (later classification and
+        modality win, info keys are merged), so each file gets at most one
+        request per kind of update. Requests are sent max_workers at a time.
+
+        Args:
+            updates (list): (acquisition_id, file_metadata) tuples, file_metadata
+                being a run.update_metadata file entry ({} is skipped)
+
+        Returns:
+            int: Number of files updated
+        """
+        coalesced = {}
+        for acquisition_id, file_metadata in updates:
+            if not file_metadata:
+                continue
+            file_update = coalesced.setdefault((acquisition_id, file_metadata['name']), {})
+            for key, value in file_metadata.items():
+                if key == 'info':
+                    file_update.setdefault('info', {}).update(value)
+                elif key != 'name':
+                    file_update[key] = value
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self._update_file, coalesced.items()))
+        log.info('Updated %s files from %s updates', len(coalesced), len(updates))
+        return len(coalesced)
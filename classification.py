@@ -0,0 +1,89 @@
+"""Classification of processed dicom series, usable as a library
+
+Unlike run, the gear entrypoint, importing this module neither configures
+logging nor imports the Flywheel SDK.
+"""
+import copy
+from collections import namedtuple
+
+import CT_classifier
+import MR_classifier
+import OPHTHA_classifier
+import PT_classifier
+import common_utils
+import dicom_processor
+
+
+# Stand-in for flywheel.Acquisition, the classifiers only read its label
+Acquisition = namedtuple('Acquisition', ['label'])
+
+
+def classify(df, dcm, dicom_metadata, acquisition, modality, config_file_path=MR_classifier.CONFIG_FILE):
+    if modality == "MR":
+        dicom_metadata = MR_classifier.classify_MR(df, dcm, dicom_metadata, acquisition,
+                                                   config_file=config_file_path)
+    elif modality == 'CT':
+        dicom_metadata = CT_classifier.classify_CT(df, dicom_metadata, acquisition)
+    elif modality == 'PT':
+        dicom_metadata = PT_classifier.classify_PT(df, dicom_metadata, acquisition)
+    elif modality == 'OPT' or modality == 'OP' or modality == 'OT':
+        dicom_metadata = OPHTHA_classifier.classify_OPHTHA(dicom_metadata, acquisition)
+    return dicom_metadata
+
+
+def classify_input(dicom_input, modality, label, header=None, config_file_path=None, **process_kwargs):
+    """Classify a zip archive or dicom file held in memory, without writing to disk
+
+    Concurrent calls (e.g. from the threads of an ingest service) are safe as
+    long as they are not given the same file object. They share the compiled
+    label rules and common_utils.MAX_LABEL_LENGTH, which run.main sets from the
+    gear config: set it once before starting the threads, not between calls.
+    Rule hits are only counted within MR_classifier.count_rule_hits(), for
+    the calls of the current thread or context.
+
+    Args:
+        dicom_input (bytes): The content of the zip archive or dicom file, as
+            bytes or as a seekable binary file object (e.g. BytesIO)
+        modality (str): The modality of the file
+        label (str): The acquisition label
+        header (dict): The info.header.dicom of the file, by default the
+            header of the representative dicom file
+        config_file_path (str): Gear config with the custom classifications, if any
+        **process_kwargs: Passed to dicom_processor.process_dicom
+
+    Returns:
+        dict: The file metadata with its classification and info (and the
+            modality, for ophthalmic files)
+
+    Raises:
+        dicom_processor.DicomProcessingError: If dicom_input is corrupted or
+            holds no dicom file that can be read
+    """
+    df, dcm = dicom_processor.process_dicom(dicom_input, **process_kwargs)
+    if header is None:
+        header = dicom_processor.get_pydicom_header(dcm)
+    dicom_metadata = {'modality': modality, 'info': {'header': {'dicom': copy.deepcopy(header)}}}
+    return classify(df, dcm, dicom_metadata, Acquisition(label=label), modality, config_file_path=config_file_path)
+
+
+def classify_series_groups(groups, dicom_metadata, acquisition, modality, config_file_path=MR_classifier.CONFIG_FILE):
+    """Classify each series of a multi-series archive
+
+    Each group returned by dicom_processor.process_dicom_groups is classified
+    on its own copy of dicom_metadata. The file is classified as its series
+    with the most slices, and every series classification is reported in
+    info.SeriesClassifications.
+    """
+    series_classifications = []
+    main_metadata = None
+    main_slice_count = -1
+    for key, df, dcm in groups:
+        slice_count = common_utils.get_slice_count(df)
+        series_metadata = classify(df, dcm, copy.deepcopy(dicom_metadata), acquisition, modality,
+                                   config_file_path=config_file_path)
+        series_classifications.append(dict(key, SliceCount=slice_count,
+                                           classification=series_metadata.get('classification')))
+        if slice_count > main_slice_count:
+            main_metadata, main_slice_count = series_metadata, slice_count
+    main_metadata.setdefault('info', {})['SeriesClassifications'] = series_classifications
+    return main_metadata
@@ -4,6 +4,8 @@ from pprint import pformat
 from functools import reduce
 from operator import add
 
+import rule_engine
+
 log = logging.getLogger(__name__)
 
 
@@ -118,10 +120,48 @@ def compute_scan_coverage(df):
     return (scan_coverage, max_slice_location, min_slice_location)
 
 
+def get_slice_count(df):
+    """
+    Returns the number of slices of the series described by df.
+
+    When the series was sampled (see dicom_processor.process_dicom), df only
+    holds the sampled slices and the slice count is stored in
+    df.attrs['slice_count'].
+
+    Examples/Tests
+    --------------
+    >>> import pandas as pd
+    >>> df = pd.DataFrame({'ImagePositionPatient': [[0, 0, 0.0], [0, 0, 1.0]]})
+    >>> get_slice_count(df)
+    2
+    >>> df.attrs['slice_count'] = 120
+    >>> get_slice_count(df)
+    120
+    """
+    return getattr(df, 'attrs', {}).get('slice_count', len(df))
+
+
+# Labels are matched on their first MAX_LABEL_LENGTH characters (0 for no limit),
+# which bounds the search time of the label rules
+MAX_LABEL_LENGTH = 256
+
+
+# Utility:  Return the part of a label matched by the label rules
+def truncate_label(label):
+    """
+    >>> len(truncate_label('x' * 1000)) == MAX_LABEL_LENGTH
+    True
+    """
+    if isinstance(label, str) and MAX_LABEL_LENGTH and len(label) > MAX_LABEL_LENGTH:
+        return label[:MAX_LABEL_LENGTH]
+    return label
+
+
 # Utility:  Check a list of regexes for truthyness
 def regex_search_label(regexes, label):
     found = False
     if type(label) == str:
+        label = truncate_label(label)
         if any(regex.search(label) for regex in regexes):
             found = True
     elif isinstance(label, list):
@@ -130,23 +170,33 @@ def regex_search_label(regexes, label):
     return found
 
 
+# Utility:  Check a pattern of the label rules (rule_engine.RULES) for truthyness
+def match_label(pattern, label):
+    """
+    >>> match_label('localizer', ['T1', '3-plane loc'])
+    True
+    """
+    if type(label) == str:
+        return rule_engine.RULES.matcher(label, MAX_LABEL_LENGTH).match(pattern)
+    elif isinstance(label, list):
+        return any(match_label(pattern, item) for item in label)
+    return False
+
+
+# Utility:  Outputs of the rules of a label rules table matching a label
+def get_label_outputs(table, label):
+    """
+    >>> get_label_outputs('scan_orientation', 'SAG T1')
+    [['Sagittal']]
+    """
+    if type(label) != str:
+        return []
+    return rule_engine.RULES.outputs(table, label, MAX_LABEL_LENGTH)
+
+
 # Localizer
 def is_localizer(label):
-    regexes = [
-        re.compile('localizer', re.IGNORECASE),
-        re.compile('localiser', re.IGNORECASE),
-        re.compile('survey', re.IGNORECASE),
-        re.compile('loc\.', re.IGNORECASE),
-        re.compile(r'\bscout\b', re.IGNORECASE),
-        re.compile('(?=.*plane)(?=.*loc)', re.IGNORECASE),
-        re.compile('(?=.*plane)(?=.*survey)', re.IGNORECASE),
-        re.compile('3-plane', re.IGNORECASE),
-        re.compile('^loc*', re.IGNORECASE),
-        re.compile('Scout', re.IGNORECASE),
-        re.compile('AdjGre', re.IGNORECASE),
-        re.compile('topogram', re.IGNORECASE)
-        ]
-    return regex_search_label(regexes, label)
+    return match_label('localizer', label)
 
 
 def compute_scan_coverage_if_original(header_dicom, df, info_object):
@@ -276,24 +326,12 @@ def compute_scan_coverage_if_original(header_dicom, df, info_object):
 # -----------------------------------------------------------------------------
 # Standard Scan
 def is_standard_scan(description):
-    regexes = [
-        re.compile('\\bNAC', re.IGNORECASE),
-        re.compile('NAC\\b', re.IGNORECASE),
-        re.compile('_NAC', re.IGNORECASE),
-        re.compile('NAC_', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('standard_scan', description)
 
 
 # Attenuation Corrected Scan
 def is_attn_corr_scan(description):
-    regexes = [
-        re.compile('\\bAC', re.IGNORECASE),
-        re.compile('AC\\b', re.IGNORECASE),
-        re.compile('_AC', re.IGNORECASE),
-        re.compile('^AC_', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('attn_corr_scan', description)
 
 
 # -----------------------------------------------------------------------------
@@ -301,27 +339,17 @@ def is_attn_corr_scan(description):
 # -----------------------------------------------------------------------------
 # Scan Orientation, Axial
 def is_axial(description):
-    regexes = [
-        re.compile('axial', re.IGNORECASE),
-        re.compile('trans', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('axial', description)
 
 
 # Scan Orientation, Coronal
 def is_coronal(description):
-    regexes = [
-        re.compile('cor', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('coronal', description)
 
 
 # Scan Orientation, Sagittal
 def is_sagittal(description):
-    regexes = [
-        re.compile('sag', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('sagittal', description)
 
 
 # -----------------------------------------------------------------------------
@@ -330,49 +358,27 @@ def is_sagittal(description):
 
 # Aggregate Anatomy
 def is_cap_label(description):
-    regexes = [
-        re.compile('(c.?a.?p)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('cap', description)
 
 
 def is_ncap_label(description):
-    regexes = [
-        re.compile('(n.?c.?a.?p)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('ncap', description)
 
 
 def is_hcap_label(description):
-    regexes = [
-        re.compile('(h.?c.?a.?p)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('hcap', description)
 
 
 def is_hn_label(description):
-    regexes = [
-        re.compile('(^|[^a-zA-Z])hn([^a-zA-Z]|$)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('hn', description)
 
 
 def is_neck_lower_label(description):
-    regexes = [
-        re.compile('Neck w\^IV lower', re.IGNORECASE),
-        re.compile('Neck lower', re.IGNORECASE),
-        re.compile('(neck.?lower)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('neck_lower', description)
 
 
 def is_neck_upper_label(description):
-    regexes = [
-        re.compile('Neck w\^IV upper', re.IGNORECASE),
-        re.compile('Neck upper', re.IGNORECASE),
-        re.compile('(neck.?upper)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('neck_upper', description)
 
 
 # -----------------------------------------------------------------------------
@@ -410,95 +416,47 @@ def is_multiple_occurrence(label, string):
 
 # Check 'to' in labels for ranged anatomy
 def is_to(description):
-    regexes = [
-        re.compile('(^|[^a-zA-Z])to([^a-zA-Z]|$)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('to', description)
 
 
 # Anatomy, Head
 def is_head_label(description):
-    regexes = [
-        re.compile('head', re.IGNORECASE),
-        re.compile('brain', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('head', description)
 
 
 # Anatomy, Neck
 def is_neck_label(description):
-    regexes = [
-        re.compile('neck', re.IGNORECASE),
-        re.compile('cervical', re.IGNORECASE),
-        re.compile('hals', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('neck', description)
 
 
 # Anatomy, Chest
 def is_chest_label(description):
-    regexes = [
-        re.compile('chest', re.IGNORECASE),
-        re.compile('lung', re.IGNORECASE),
-        re.compile('thorax', re.IGNORECASE),
-        re.compile('thoracic', re.IGNORECASE),
-        re.compile('thoracicspine', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('chest', description)
 
 
 # Anatomy, Abdomen
 def is_abdomen_label(description):
-    regexes = [
-        re.compile('abdomen', re.IGNORECASE),
-        re.compile('abdomenl', re.IGNORECASE),
-        re.compile('bdomen', re.IGNORECASE),
-        re.compile('abd', re.IGNORECASE),
-        re.compile('abdo', re.IGNORECASE),
-        re.compile('lumbarspine', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('abdomen', description)
 
 
 # Anatomy, Pelvis
 def is_pelvis_label(description):
-    regexes = [
-        re.compile('pel', re.IGNORECASE),
-        re.compile('(^|[^a-zA-Z])pv([^a-zA-Z]|$)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('pelvis', description)
 
 
 # Anatomy, Lower Extremities
 def is_lower_extremities(description):
-    regexes = [
-        re.compile('(^|[^a-zA-Z])le([^a-zA-Z]|$)', re.IGNORECASE),
-        re.compile('(lower.?extremity)', re.IGNORECASE),
-        re.compile('(lower.?extremities)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('lower_extremities', description)
 
 
 # Anatomy, Upper Extremities
 def is_upper_extremities(description):
-    regexes = [
-        re.compile('(^|[^a-zA-Z])ue([^a-zA-Z]|$)', re.IGNORECASE),
-        re.compile('(upper.?extremity)', re.IGNORECASE),
-        re.compile('(upper.?extremities)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('upper_extremities', description)
 
 
 # Anatomy, Whole Body
 def is_whole_body_label(description):
-    regexes = [
-        re.compile('whole', re.IGNORECASE),
-        re.compile('(^|[^a-zA-Z])wb([^a-zA-Z]|$)', re.IGNORECASE),
-        re.compile('body', re.IGNORECASE),
-        re.compile('eyes.?to.?thighs', re.IGNORECASE),
-        re.compile('eye.?to.?thigh', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('whole_body', description)
 
 
 # -----------------------------------------------------------------------------
@@ -506,33 +464,17 @@ def is_whole_body_label(description):
 # -----------------------------------------------------------------------------
 # Reconstruction Window, Bone
 def is_bone_window(description):
-    regexes = [
-        re.compile('(bone.?window)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('bone_window', description)
 
 
 # Reconstruction Window, Lung
 def is_lung_window(description):
-    regexes = [
-        re.compile('(lung.?window)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('lung_window', description)
 
 
 # No contrast
 def is_unenhanced(description):
-    regexes = [
-        re.compile('(un.?enhanced)', re.IGNORECASE),
-        re.compile('w\^.?o', re.IGNORECASE),
-        re.compile('w\/.?o', re.IGNORECASE),
-        re.compile('(^|[^a-zA-Z])wo([^a-zA-Z]|$)', re.IGNORECASE),
-        re.compile('(^|[^a-zA-Z])no([^a-zA-Z]|$)', re.IGNORECASE),
-        re.compile('(no.?IV)', re.IGNORECASE),
-        re.compile('(sans.?IV)', re.IGNORECASE),
-        re.compile('(non.?contrast)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('unenhanced', description)
 
 
 # -----------------------------------------------------------------------------
@@ -540,44 +482,22 @@ def is_unenhanced(description):
 # -----------------------------------------------------------------------------
 # Contrast
 def is_enhanced(description):
-    regexes = [
-        re.compile('enhanced', re.IGNORECASE),
-        re.compile('(w\^.?IV)', re.IGNORECASE),
-        re.compile('(w\/.?IV)', re.IGNORECASE),
-        re.compile('contrast', re.IGNORECASE),
-        re.compile('contraste', re.IGNORECASE),
-        re.compile('(with.?contrast)', re.IGNORECASE),
-        re.compile('(w\/)', re.IGNORECASE),
-        re.compile('(w.?contrast)', re.IGNORECASE),
-        re.compile('(IV.?contrast)', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('enhanced', description)
 
 
 # Contrast, Arterial Phase
 def is_arterial(description):
-    regexes = [
-        re.compile('arterial', re.IGNORECASE),
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('arterial', description)
 
 
 # Contrast, Portal Venous Phase
 def is_portal_venous(description):
-    regexes = [
-        re.compile('portal', re.IGNORECASE),
-        re.compile('venous', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('portal_venous', description)
 
 
 # Contrast, Delayed Phase
 def is_delayed_equil(description):
-    regexes = [
-        re.compile('delayed', re.IGNORECASE),
-        re.compile('equil', re.IGNORECASE)
-    ]
-    return regex_search_label(regexes, description)
+    return match_label('delayed_equil', description)
 
 
 # -----------------------------------------------------------------------------
@@ -585,54 +505,7 @@ def is_delayed_equil(description):
 # FUTURE: put these in AnatomyClassifier class
 # -----------------------------------------------------------------------------
 def get_anatomy_classification(label):
-    new_anatomy = []
-
-    ## Aggregate Anatomy
-    if is_hcap_label(label):
-        new_anatomy.append(['Head', 'Neck', 'Chest', 'Abdomen', 'Pelvis'])
-    elif is_ncap_label(label):
-        new_anatomy.append(['Neck', 'Chest', 'Abdomen', 'Pelvis'])
-    elif is_cap_label(label):
-        new_anatomy.append(['Chest', 'Abdomen', 'Pelvis'])
-
-    ## Combination Anatomy
-    if is_hn_label(label):
-        new_anatomy.append(['Head', 'Neck'])
-    if is_neck_lower_label(label):
-        new_anatomy.append(['Chest'])
-    if is_neck_upper_label(label):
-        new_anatomy.append(['Head'])
-
-    ## Multiple Anatomy occurrences
-    if is_multiple_occurrence(label, 'neck'):
-        if is_neck_lower_label(label) and is_neck_upper_label(label):
-            new_anatomy.append(['Head', 'Chest'])
-        if is_neck_lower_label(label) and not is_neck_upper_label(label):
-            new_anatomy.append(['Neck', 'Chest'])
-        if not is_neck_lower_label(label) and is_neck_upper_label(label):
-            new_anatomy.append(['Head', 'Neck'])
-    if is_multiple_occurrence(label, 'lung'):
-        new_anatomy.append(['Chest'])
-
-    ## Anatomy
-    if is_head_label(label):
-        new_anatomy.append(['Head'])
-    if is_neck_label(label) and not is_neck_lower_label(
-        label) and not is_neck_upper_label(label):
-        new_anatomy.append(['Neck'])
-    if is_chest_label(label) and not is_lung_window(label):
-        new_anatomy.append(['Chest'])
-    if is_abdomen_label(label):
-        new_anatomy.append(['Abdomen'])
-    if is_pelvis_label(label):
-        new_anatomy.append(['Pelvis'])
-    if is_lower_extremities(label):
-        new_anatomy.append(['Lower Extremities'])
-    if is_upper_extremities(label):
-        new_anatomy.append(['Upper Extremities'])
-    if is_whole_body_label(label):
-        new_anatomy.append(['Whole Body'])
-
+    new_anatomy = get_label_outputs('anatomy', label)
     if new_anatomy:
         new_anatomy = reduce(add, new_anatomy)
         new_anatomy = list(set(new_anatomy))
@@ -847,24 +720,14 @@ def get_scan_type_classification(label, single_header_object):
         new_scan_type = ['Original']
     elif single_header_object.get('ImageType', [None])[0] == 'DERIVED':
         new_scan_type = ['Derived']
-    elif is_standard_scan(label):
-        new_scan_type = ['Standard']
-    elif is_attn_corr_scan(label):
-        new_scan_type = ['AC']
+    else:
+        new_scan_type = reduce(add, get_label_outputs('scan_type', label), [])
 
     return new_scan_type
 
 
 def get_scan_orientation(label):
-    scan_orientation = []
-    if is_axial(label):
-        scan_orientation.append('Axial')
-    elif is_coronal(label):
-        scan_orientation.append('Coronal')
-    elif is_sagittal(label):
-        scan_orientation.append('Sagittal')
-
-    return scan_orientation
+    return reduce(add, get_label_outputs('scan_orientation', label), [])
 
 
 # -----------------------------------------------------------------------------
@@ -872,19 +735,7 @@ def get_scan_orientation(label):
 # FUTURE: put this in a class
 # -----------------------------------------------------------------------------
 def get_contrast_classification(label):
-    new_contrast = []
-
-    ## Contrast
-    if is_arterial(label):
-        new_contrast.append(['Arterial Phase'])
-    if is_portal_venous(label):
-        new_contrast.append(['Portal Venous Phase'])
-    if is_delayed_equil(label):
-        new_contrast.append(['Delayed/Equilibrium Phase'])
-    if is_unenhanced(label):
-        new_contrast.append(['No Contrast'])
-    elif is_enhanced(label):
-        new_contrast.append(['Contrast'])
+    new_contrast = get_label_outputs('contrast', label)
 
     if new_contrast:
         new_contrast = reduce(add, new_contrast)
@@ -897,13 +748,7 @@ def get_contrast_classification(label):
 # FUTURE: put this in a class
 # -----------------------------------------------------------------------------
 def get_reconstruction_window(label):
-    reconstruction_window = None
-    if is_bone_window(label):
-        reconstruction_window = 'Bone'
-    elif is_lung_window(label):
-        reconstruction_window = 'Lung'
-
-    if reconstruction_window:
+    for reconstruction_window in get_label_outputs('reconstruction_window', label):
         return reconstruction_window
 
 
@@ -1,25 +1,82 @@
+import abc
 import logging
 import os
-import re
 import string
-import sys
-import tempfile
+import struct
+import tarfile
+import threading
+import time
 import zipfile
-from pathlib import Path
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from gzip import GzipFile
+from io import BytesIO
+from pathlib import PurePosixPath
+from queue import Queue
 
+import numpy as np
 import pandas as pd
 import pydicom
 from pydicom.datadict import DicomDictionary, tag_for_keyword
 
+import perf_utils
+
 log = logging.getLogger(__name__)
 
+# Bounds applied when flattening sequences with get_seq_data
+SEQ_MAX_DEPTH = 8
+SEQ_MAX_ITEMS = 1000
+SEQ_MAX_VALUE_SIZE = 10240  # Max pydicom field length
+# Keywords extracted from each slice by get_dcm_record
+RECORD_KEYWORDS = ['SOPClassUID', 'SliceLocation', 'ImageType', 'ImageOrientationPatient', 'ImagePositionPatient',
+                   'SeriesInstanceUID', 'AcquisitionNumber']
+# Key of the marker replacing the content dropped by get_seq_data
+TRUNCATED_KEY = '_truncated'
+# Number of bytes needed to check the DICOM preamble and 'DICM' prefix
+DICOM_PREFIX_SIZE = 132
+# Groups a DICOM data set written without preamble (e.g. implicit VR) is expected to start with
+DICOM_FIRST_GROUPS = (0x0002, 0x0008)
+# Sampled slice geometry has to be within this fraction of a slice spacing of the linear fit
+SAMPLE_POSITION_TOLERANCE = 0.1
+# Zip member pipeline defaults (see iter_zip_data_dicts)
+DECOMPRESS_WORKERS = 2
+PARSE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 16
+# First bytes of a gzip file (e.g. a gzipped single dicom file)
+GZIP_MAGIC = b'\x1f\x8b'
+# Name of a process_dicom input given as bytes or as a file object without name
+IN_MEMORY_NAME = '<in-memory>'
+
+
+# Translation table deleting every ASCII character that is not in string.printable
+_NON_PRINTABLE_TABLE = {i: None for i in range(128) if chr(i) not in string.printable}
+
+
+class DicomProcessingError(ValueError):
+    """Raised when an input is corrupted or holds no dicom file that can be read"""
+
 
 def format_string(in_string):
-    formatted = re.sub(r'[^\x00-\x7f]',r'', str(in_string)) # Remove non-ascii characters
-    formatted = ''.join(filter(lambda x: x in string.printable, formatted))
+    """Strip non-ascii and non-printable characters from in_string.
+
+    Strings that are already printable ASCII (the vast majority of header
+    values) are returned unchanged without building a new string.
+
+    Args:
+        in_string: Value to format, converted with str() first.
+
+    Returns:
+        str: The formatted string or None if the result is a lone '?'.
+    """
+    formatted = str(in_string)
+    if not (formatted.isascii() and formatted.isprintable()):
+        # Remove non-ascii characters then the non printable ones in a single translate pass
+        formatted = formatted.encode('ascii', 'ignore').decode('ascii').translate(_NON_PRINTABLE_TABLE)
     if len(formatted) == 1 and formatted == '?':
         formatted = None
-    return formatted#.encode('utf-8').strip()
+    return formatted
 
 
 def assign_type(s):
@@ -49,38 +106,75 @@ def assign_type(s):
                 return format_string(s)
 
 
-def get_seq_data(sequence, ignore_keys):
+def get_seq_data(sequence, ignore_keys, max_depth=SEQ_MAX_DEPTH, max_items=SEQ_MAX_ITEMS,
+                 max_value_size=SEQ_MAX_VALUE_SIZE, counters=None):
     """Return list of nested dictionaries matching sequence
 
+    The sequence is flattened iteratively and bounded by max_depth, max_items
+    and max_value_size. Whatever is dropped is replaced by a
+    ``{TRUNCATED_KEY: {...}}`` marker describing what was skipped:
+
+    * items beyond max_items: a marker item ``{'items': <skipped count>}`` is
+      appended to the list
+    * sequences nested deeper than max_depth: replaced by a single marker item
+      ``{'depth': <depth>, 'items': <item count>}``
+    * values longer than max_value_size: replaced by the marker ``{'size': <length>}``
+
     Args:
         sequence (pydicom.Sequence): A pydicom sequence
         ignore_keys (list): List of keys to ignore
+        max_depth (int): Maximum sequence nesting depth, sequence being depth 1 (None for unbounded)
+        max_items (int): Maximum number of items kept per sequence (None for unbounded)
+        max_value_size (int): Maximum length of a kept value (None for unbounded)
+        counters (collections.Counter): If provided, incremented with the number
+            of skipped 'items', 'depth' (truncated sequences) and 'values'
 
     Returns:
         (list): list of nested dictionary matching sequence
     """
+    if counters is None:
+        counters = Counter()
     res = []
-    for seq in sequence:
-        seq_dict = {}
-        for k, v in seq.items():
-            if not hasattr(v, 'keyword') or \
-                    (hasattr(v, 'keyword') and v.keyword in ignore_keys) or \
-                    (hasattr(v, 'keyword') and not v.keyword):  # keyword of type "" for unknown tags
-                continue
-            kw = v.keyword
-            if isinstance(v.value, pydicom.sequence.Sequence):
-                seq_dict[kw] = get_seq_data(v, ignore_keys)
-            elif isinstance(v.value, str):
-                seq_dict[kw] = format_string(v.value)
-            else:
-                seq_dict[kw] = assign_type(v.value)
-        res.append(seq_dict)
+    stack = [(sequence, res, 1)]
+    while stack:
+        current_sequence, seq_list, depth = stack.pop()
+        for idx, seq in enumerate(current_sequence):
+            if max_items is not None and idx >= max_items:
+                skipped = len(current_sequence) - max_items
+                seq_list.append({TRUNCATED_KEY: {'items': skipped}})
+                counters['items'] += skipped
+                break
+            seq_dict = {}
+            for k, v in seq.items():
+                if not hasattr(v, 'keyword') or \
+                        (hasattr(v, 'keyword') and v.keyword in ignore_keys) or \
+                        (hasattr(v, 'keyword') and not v.keyword):  # keyword of type "" for unknown tags
+                    continue
+                kw = v.keyword
+                if isinstance(v.value, pydicom.sequence.Sequence):
+                    if max_depth is not None and depth >= max_depth:
+                        seq_dict[kw] = [{TRUNCATED_KEY: {'depth': depth + 1, 'items': len(v.value)}}]
+                        counters['depth'] += 1
+                    else:
+                        seq_dict[kw] = []
+                        stack.append((v.value, seq_dict[kw], depth + 1))
+                elif max_value_size is not None and isinstance(v.value, (str, bytes, list, pydicom.multival.MultiValue)) \
+                        and len(v.value) > max_value_size:
+                    seq_dict[kw] = {TRUNCATED_KEY: {'size': len(v.value)}}
+                    counters['values'] += 1
+                elif isinstance(v.value, str):
+                    seq_dict[kw] = format_string(v.value)
+                else:
+                    seq_dict[kw] = assign_type(v.value)
+            seq_list.append(seq_dict)
     return res
 
 
 def fix_type_based_on_dicom_vm(header):
     exc_keys = []
     for key, val in header.items():
+        if key == TRUNCATED_KEY:
+            continue
         try:
             vr, vm, _, _, _ = DicomDictionary.get(tag_for_keyword(key))
         except (ValueError, TypeError):
@@ -101,9 +195,14 @@ def fix_type_based_on_dicom_vm(header):
         log.warning('%s Dicom data elements were not type fixed based on VM', len(exc_keys))
 
 
-def get_pydicom_header(dcm):
+def get_pydicom_header(dcm, counters=None, skip_tags=None, keywords=None):
     '''
     Extract the header values
+
+    If provided, the collections.Counter counters is incremented with what
+    get_seq_data skipped while flattening the sequences. skip_tags is an
+    optional list of additional keywords to leave out of the header. If
+    keywords is provided, only these keywords are extracted.
     '''
     header = {}
     exclude_tags = ['[Unknown]',
@@ -116,7 +215,9 @@ def get_pydicom_header(dcm):
                     'ContourData',
                     'EncryptedAttributesSequence'
                     ]
-    tags = dcm.dir()
+    if skip_tags:
+        exclude_tags = exclude_tags + list(skip_tags)
+    tags = dcm.dir() if keywords is None else keywords
     for tag in tags:
         try:
             if (tag not in exclude_tags) and ( type(dcm.get(tag)) != pydicom.sequence.Sequence ):
@@ -131,7 +232,7 @@ def get_pydicom_header(dcm):
                     log.debug('No value found for tag: ' + tag)
 
             if (tag not in exclude_tags) and type(dcm.get(tag)) == pydicom.sequence.Sequence:
-                seq_data = get_seq_data(dcm.get(tag), exclude_tags)
+                seq_data = get_seq_data(dcm.get(tag), exclude_tags, counters=counters)
                 # Check that the sequence is not empty
                 if seq_data:
                     header[tag] = seq_data
@@ -144,25 +245,221 @@ def get_pydicom_header(dcm):
     return header
 
 
-def get_dcm_data_dict(dcm_path, force=False):
-    file_size = os.path.getsize(dcm_path)
+def _get_functional_group_value(functional_group, sequence_keyword, keyword):
+    """Return functional_group.<sequence_keyword>[0].<keyword> or None if missing"""
+    if functional_group is None:
+        return None
+    sequence = functional_group.get(sequence_keyword)
+    if not sequence:
+        return None
+    return sequence[0].get(keyword)
+
+
+def _fill_frame_row(array, idx, value):
+    """Set array[idx] to value if value has the expected number of numeric elements"""
+    if value is None:
+        return
+    try:
+        row = np.asarray(value, dtype=float).ravel()
+    except (TypeError, ValueError):
+        return
+    if row.shape == array[idx].shape:
+        array[idx] = row
+
+
+def get_frame_geometry(dcm):
+    """Return the per-frame geometry of an enhanced multi-frame DICOM
+
+    PlanePositionSequence/PlaneOrientationSequence are read straight from the
+    PerFrameFunctionalGroupsSequence items (falling back to the
+    SharedFunctionalGroupsSequence) into arrays with one row per frame,
+    without converting the functional groups to dictionaries.
+
+    Args:
+        dcm (pydicom.Dataset): An enhanced multi-frame dataset
+
+    Returns:
+        dict: 'ImagePositionPatient' (n_frames x 3) and 'ImageOrientationPatient'
+            (n_frames x 6) float arrays, NaN where the value is missing or invalid
+    """
+    per_frame = dcm.get('PerFrameFunctionalGroupsSequence') or []
+    shared_sequence = dcm.get('SharedFunctionalGroupsSequence')
+    shared = shared_sequence[0] if shared_sequence else None
+    shared_ipp = _get_functional_group_value(shared, 'PlanePositionSequence', 'ImagePositionPatient')
+    shared_iop = _get_functional_group_value(shared, 'PlaneOrientationSequence', 'ImageOrientationPatient')
+
+    n_frames = len(per_frame)
+    ipp = np.full((n_frames, 3), np.nan)
+    iop = np.full((n_frames, 6), np.nan)
+    for idx, frame in enumerate(per_frame):
+        frame_ipp = _get_functional_group_value(frame, 'PlanePositionSequence', 'ImagePositionPatient')
+        frame_iop = _get_functional_group_value(frame, 'PlaneOrientationSequence', 'ImageOrientationPatient')
+        _fill_frame_row(ipp, idx, frame_ipp if frame_ipp is not None else shared_ipp)
+        _fill_frame_row(iop, idx, frame_iop if frame_iop is not None else shared_iop)
+    return {'ImagePositionPatient': ipp, 'ImageOrientationPatient': iop}
+
+
+def _array_row_to_list(row):
+    """Return row as a list of float or None if any value is NaN"""
+    if np.isnan(row).any():
+        return None
+    return row.tolist()
+
+
+def get_dcm_data_dict(dcm_path, force=False, counters=None, data=None, keywords=None, keep_dataset=False):
+    """Return a dictionary with the path, size and header of a dicom file
+
+    Args:
+        dcm_path (str): Path of the dicom file, or its name when data is provided
+        force (bool): Passed to pydicom.dcmread
+        counters (collections.Counter): Passed to get_pydicom_header
+        data (bytes): The content of the file if already in memory (e.g. a zip member)
+        keywords (list): Passed to get_pydicom_header to only extract these keywords
+        keep_dataset (bool): If True, the pydicom dataset (read without pixel
+            data) is kept under the 'dataset' key
+
+    Returns:
+        dict: With keys path, size, force, pydicom_exception, header,
+            has_header (whether the file has any header value, even if not in
+            keywords), dataset if keep_dataset and frames for enhanced
+            multi-frame files
+    """
+    file_size = len(data) if data is not None else os.path.getsize(dcm_path)
     res = {
         'path': dcm_path,
         'size': file_size,
         'force': force,
         'pydicom_exception': False,
-        'header': {}
+        'header': {},
+        'has_header': False
     }
     if file_size > 0:
         try:
-            dcm = pydicom.dcmread(dcm_path, force=force, stop_before_pixels=True)
-            res['header'] = get_pydicom_header(dcm)
+            dcm = pydicom.dcmread(BytesIO(data) if data is not None else dcm_path,
+                                  force=force, stop_before_pixels=True)
+            if 'PerFrameFunctionalGroupsSequence' in dcm:
+                # Enhanced multi-frame: keep the frame geometry, not the per-frame dict tree
+                res['frames'] = get_frame_geometry(dcm)
+                res['header'] = get_pydicom_header(dcm, counters=counters, keywords=keywords,
+                                                   skip_tags=['PerFrameFunctionalGroupsSequence'])
+            else:
+                res['header'] = get_pydicom_header(dcm, counters=counters, keywords=keywords)
+            res['has_header'] = bool(res['header']) if keywords is None else bool(dcm.dir())
+            if keep_dataset:
+                res['dataset'] = dcm
         except Exception:
             log.exception('Pydicom raised exception reading dicom file %s', os.path.basename(dcm_path))
             res['pydicom_exception'] = True
     return res
 
 
+def get_dcm_record(dcm_path, force=False, counters=None, data=None):
+    """Return the minimal get_dcm_data_dict needed to describe a slice of a series
+
+    Only RECORD_KEYWORDS are extracted into the header and the dataset (without
+    pixel data) is kept so that it can be used as representative without
+    reading the file again, see get_dcm_data_dict.
+    """
+    return get_dcm_data_dict(dcm_path, force=force, counters=counters, data=data, keywords=RECORD_KEYWORDS,
+                             keep_dataset=True)
+
+
+def _to_float_array(value, size):
+    """Return value as a list of size floats or NaNs if value is not valid"""
+    if isinstance(value, list) and len(value) == size:
+        try:
+            return [float(x) for x in value]
+        except (TypeError, ValueError):
+            pass
+    return [np.nan] * size
+
+
+def _image_type_value(image_type):
+    """Return a new list from an ImageType stored as tuple, other values unchanged"""
+    return list(image_type) if isinstance(image_type, tuple) else image_type
+
+
+class SliceTable:
+    """Incremental accumulator of the slice geometry of a series
+
+    Slices are appended one record (see get_dcm_record) at a time and only
+    kept as compact numeric arrays, so that the memory used does not depend
+    on the header size. Enhanced multi-frame records contribute one row per
+    frame. Records can be appended in any order (e.g. the archive order of a
+    tar stream), the rows are returned in member path order.
+
+    Attributes:
+        counts (collections.Counter): Number of 'files', 'empty' files,
+            'pydicom_exception' and 'frames' (rows) appended
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.paths = []
+        self.slice_locations = array('d')
+        self.image_type_codes = array('l')
+        self.image_types = []
+        self._image_type_index = {}
+        self.orientations = array('d')
+        self.positions = array('d')
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _image_type_code(self, image_type):
+        key = tuple(image_type) if isinstance(image_type, list) else image_type
+        if key not in self._image_type_index:
+            self._image_type_index[key] = len(self.image_types)
+            self.image_types.append(key)
+        return self._image_type_index[key]
+
+    def _append_row(self, path, slice_location, image_type_code, orientation, position):
+        self.paths.append(path)
+        self.slice_locations.append(slice_location)
+        self.image_type_codes.append(image_type_code)
+        self.orientations.extend(orientation)
+        self.positions.extend(position)
+
+    def append(self, record):
+        """Append the slice(s) described by record"""
+        header = record['header']
+        self.counts['files'] += 1
+        if record['size'] < 1:
+            self.counts['empty'] += 1
+        if record['pydicom_exception']:
+            self.counts['pydicom_exception'] += 1
+        image_type_code = self._image_type_code(header.get('ImageType'))
+        frames = record.get('frames')
+        if frames is not None and len(frames['ImagePositionPatient']) > 0:
+            for orientation, position in zip(frames['ImageOrientationPatient'], frames['ImagePositionPatient']):
+                self.counts['frames'] += 1
+                self._append_row(record['path'], np.nan, image_type_code, orientation, position)
+            return
+        slice_location = header.get('SliceLocation')
+        self._append_row(record['path'],
+                         float(slice_location) if isinstance(slice_location, (int, float)) else np.nan,
+                         image_type_code,
+                         _to_float_array(header.get('ImageOrientationPatient'), 6),
+                         _to_float_array(header.get('ImagePositionPatient'), 3))
+
+    def to_dataframe(self):
+        """Return a DataFrame where each row is a slice (path, SliceLocation, ImageType,
+        ImageOrientationPatient and ImagePositionPatient)"""
+        n_rows = len(self)
+        # Stable sort, so that the frames of a multi-frame file stay in order
+        order = sorted(range(n_rows), key=lambda row: PurePosixPath(self.paths[row]))
+        orientations = np.frombuffer(self.orientations, dtype=float).reshape(n_rows, 6)[order]
+        positions = np.frombuffer(self.positions, dtype=float).reshape(n_rows, 3)[order]
+        slice_locations = np.frombuffer(self.slice_locations, dtype=float)[order]
+        return pd.DataFrame({
+            'path': [self.paths[row] for row in order],
+            'SliceLocation': [None if np.isnan(x) else float(x) for x in slice_locations],
+            'ImageType': [_image_type_value(self.image_types[self.image_type_codes[row]]) for row in order],
+            'ImageOrientationPatient': [_array_row_to_list(row) for row in orientations],
+            'ImagePositionPatient': [_array_row_to_list(row) for row in positions],
+        }, columns=['path', 'SliceLocation', 'ImageType', 'ImageOrientationPatient', 'ImagePositionPatient'])
+
+
 def walk_dicom(dcm, callbacks=None, recursive=True):
     """Same as pydicom.DataSet.walk but with logging the exception instead of raising.
 
@@ -222,74 +519,917 @@ def fix_VM1_callback(dataset, data_element):
             data_element._value = '\\'.join(data_element.value)
 
 
-def process_dicom(file_path, force=True):
-    '''
-    Create Pandas Dataframe where each row is a dicom image header information
-    '''
-    # Build list of dcm files
-    if zipfile.is_zipfile(file_path):
-        try:
-            log.info('Extracting %s ' % os.path.basename(file_path))
-            zip = zipfile.ZipFile(file_path)
-            tmp_dir = tempfile.TemporaryDirectory().name
-            zip.extractall(path=tmp_dir)
-            dcm_path_list = sorted(Path(tmp_dir).rglob('*'))
-            # keep only files
-            dcm_path_list = [str(path) for path in dcm_path_list if os.path.isfile(path)]
-        except Exception:
-            log.warning('Zip file %s is corrupted. Logging to error.json and Exiting.', file_path)
-            sys.exit(1)
+def sniff_dicom(prefix):
+    """Check whether prefix looks like the beginning of a DICOM file
+
+    A DICOM file either has a 128 bytes preamble followed by 'DICM' or, when
+    written without preamble (e.g. implicit VR little endian), starts with a
+    group 0002 or 0008 tag.
+
+    Args:
+        prefix (bytes): The first DICOM_PREFIX_SIZE bytes of the file (or less if shorter)
+
+    Returns:
+        str: None if prefix looks like DICOM, the reason why it does not otherwise
+    """
+    if prefix[128:132] == b'DICM':
+        return None
+    if len(prefix) >= 8:
+        group, _ = struct.unpack('<HH', prefix[:4])
+        if group in DICOM_FIRST_GROUPS:
+            return None
+    return 'no_dicom_magic'
+
+
+def get_member_skip_reason(member):
+    """Return the reason why an archive member should not be parsed based on its name only
+
+    Args:
+        member (zipfile.ZipInfo or tarfile.TarInfo): A zip or tar member
+
+    Returns:
+        str: None if the member should be parsed, the reason to skip it otherwise
+    """
+    if isinstance(member, tarfile.TarInfo):
+        if member.isdir():
+            return 'directory'
+        if not member.isfile():
+            return 'not_a_file'
+        filename = member.name
+    elif member.is_dir():
+        return 'directory'
     else:
-        log.info('Not a zip. Attempting to read %s directly' % os.path.basename(file_path))
-        dcm_path_list = [file_path]
+        filename = member.filename
+    parts = filename.split('/')
+    if '__MACOSX' in parts[:-1] or parts[-1].startswith('._'):
+        return 'macosx'
+    if parts[-1].upper() == 'DICOMDIR':
+        return 'dicomdir'
+    return None
 
-    # Get list of Dicom data dict (with keys path, size, header)
-    dcm_dict_list = []
-    for dcm_path in dcm_path_list:
-        dcm_dict_list.append(get_dcm_data_dict(dcm_path, force=force))
 
-    # Load a representative dcm file
-    # Currently: not 0-byte file and SOPClassUID not Raw Data Storage unless that the only file
-    dcm = None
-    log.info('Selecting a valid Dicom file for parsing')
-    for idx, dcm_dict_el in enumerate(dcm_dict_list):
-        if dcm_dict_el['size'] > 0 and dcm_dict_el['header'] and not dcm_dict_el['pydicom_exception']:
+def filter_dicom_members(zip_file, counters=None):
+    """Return the zip members that look like DICOM files without parsing them
+
+    Only the first DICOM_PREFIX_SIZE bytes of each member are decompressed.
+    Empty members are kept so that they are reported the same way as before.
+
+    Args:
+        zip_file (zipfile.ZipFile): An open zip file
+        counters (collections.Counter): If provided, incremented with the number
+            of skipped members per reason
+
+    Returns:
+        list: List of zipfile.ZipInfo to parse
+    """
+    if counters is None:
+        counters = Counter()
+    members = []
+    for zip_info in zip_file.infolist():
+        reason = get_member_skip_reason(zip_info)
+        if reason is None and zip_info.file_size > 0:
+            with zip_file.open(zip_info) as fp:
+                reason = sniff_dicom(fp.read(DICOM_PREFIX_SIZE))
+        if reason:
+            if reason != 'directory':
+                log.debug('Skipping %s: %s', zip_info.filename, reason)
+                counters[reason] += 1
+            continue
+        members.append(zip_info)
+    return members
+
+
+def _add_stage_stats(stats, lock, stage, n_bytes, seconds, cpu_seconds):
+    """Accumulate the file, byte, busy time and CPU time counters of a pipeline stage"""
+    with lock:
+        stage_stats = stats.setdefault(stage, {'files': 0, 'bytes': 0, 'seconds': 0.0, 'cpu_seconds': 0.0})
+        stage_stats['files'] += 1
+        stage_stats['bytes'] += n_bytes
+        stage_stats['seconds'] += seconds
+        stage_stats['cpu_seconds'] += cpu_seconds
+
+
+def iter_zip_data_dicts(zip_file, members, force=False, counters=None, decompress_workers=DECOMPRESS_WORKERS,
+                        parse_workers=PARSE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, stats=None,
+                        parse_func=get_dcm_data_dict):
+    """Yield the get_dcm_data_dict (or parse_func result) of each zip member, in members order
+
+    Members are inflated by a pool of decompression threads (zlib releases the
+    GIL) and parsed by parser threads, so that decompression and parsing
+    overlap. At most queue_size members are in flight (decompressed, parsed
+    or waiting to be yielded) at any time, which caps the memory used
+    regardless of the archive size.
+
+    Args:
+        zip_file (zipfile.ZipFile): An open zip file
+        members (list): List of zipfile.ZipInfo to process
+        force (bool): Passed to get_dcm_data_dict
+        counters (collections.Counter): Passed to get_dcm_data_dict
+        decompress_workers (int): Number of decompression threads
+        parse_workers (int): Number of parser threads
+        queue_size (int): Maximum number of members in flight
+        stats (dict): If provided, updated with 'decompress' and 'parse' stage
+            counters (files, bytes, seconds of busy time, cpu_seconds) and 'wall_seconds'
+        parse_func (callable): Called as parse_func(name, force=, counters=, data=)
+            on each member, get_dcm_data_dict by default
+
+    Yields:
+        dict: The get_dcm_data_dict of each member
+
+    Raises:
+        Exception: The first exception raised while decompressing a member
+    """
+    if stats is None:
+        stats = {}
+    n_members = len(members)
+    stop = threading.Event()
+    slots = threading.Semaphore(queue_size)
+    lock = threading.Lock()
+    next_member = iter(range(n_members))
+    data_queue = Queue()
+    result_queue = Queue()
+
+    def decompress():
+        while not stop.is_set():
+            if not slots.acquire(timeout=0.1):
+                continue
+            with lock:
+                idx = next(next_member, None)
+            if idx is None:
+                slots.release()
+                return
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                data = zip_file.read(members[idx])
+            except Exception as exc:
+                result_queue.put((idx, exc))
+                return
+            _add_stage_stats(stats, lock, 'decompress', len(data), time.perf_counter() - start,
+                             time.thread_time() - cpu_start)
+            data_queue.put((idx, data))
+
+    def parse():
+        while True:
+            item = data_queue.get()
+            if item is None:
+                return
+            idx, data = item
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                res = parse_func(members[idx].filename, force=force, counters=counters, data=data)
+            except Exception as exc:
+                result_queue.put((idx, exc))
+                continue
+            _add_stage_stats(stats, lock, 'parse', len(data), time.perf_counter() - start,
+                             time.thread_time() - cpu_start)
+            result_queue.put((idx, res))
+
+    threads = [threading.Thread(target=decompress, daemon=True) for _ in range(max(1, decompress_workers))]
+    threads += [threading.Thread(target=parse, daemon=True) for _ in range(max(1, parse_workers))]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    try:
+        pending = {}
+        for next_idx in range(n_members):
+            while next_idx not in pending:
+                idx, res = result_queue.get()
+                if isinstance(res, Exception):
+                    raise res
+                pending[idx] = res
+            yield pending.pop(next_idx)
+            slots.release()
+    finally:
+        stop.set()
+        for _ in range(max(1, parse_workers)):
+            data_queue.put(None)
+        for thread in threads:
+            thread.join()
+        stats['wall_seconds'] = time.perf_counter() - wall_start
+
+
+def sniff_stream_format(fp):
+    """Return the format of an archive that can only be read as a stream
+
+    Args:
+        fp (file): A seekable binary file object, left at its position
+
+    Returns:
+        str: 'tar' for a tar archive, compressed (e.g. tar.gz) or not,
+            'gzip' for another gzipped file (e.g. a .dcm.gz), None otherwise
+    """
+    start = fp.tell()
+    try:
+        with tarfile.open(fileobj=fp, mode='r|*'):
+            return 'tar'
+    except (tarfile.TarError, EOFError, OSError, zlib.error):
+        fp.seek(start)
+        return 'gzip' if fp.read(len(GZIP_MAGIC)) == GZIP_MAGIC else None
+    finally:
+        fp.seek(start)
+
+
+def iter_tar_data_dicts(tar_file, force=False, counters=None, prefilter=True, skipped=None, stats=None,
+                        parse_func=get_dcm_data_dict):
+    """Yield the get_dcm_data_dict (or parse_func result) of each member of a tar stream, in archive order
+
+    Members are decompressed and parsed one at a time as the stream is read,
+    so that the archive is neither seeked nor extracted to disk and a single
+    member is held in memory at a time.
+
+    Args:
+        tar_file (tarfile.TarFile): A tar file opened in stream mode (e.g. 'r|*')
+        force (bool): Passed to parse_func
+        counters (collections.Counter): Passed to parse_func
+        prefilter (bool): If True, members that do not look like DICOM files
+            are skipped without being parsed (see get_member_skip_reason and sniff_dicom)
+        skipped (collections.Counter): If provided, incremented with the number
+            of skipped members per reason
+        stats (dict): If provided, updated with 'decompress' and 'parse' stage
+            counters, see iter_zip_data_dicts
+        parse_func (callable): Called as parse_func(name, force=, counters=, data=)
+            on each member, get_dcm_data_dict by default
+
+    Yields:
+        dict: The get_dcm_data_dict of each member
+    """
+    if stats is None:
+        stats = {}
+    if skipped is None:
+        skipped = Counter()
+    lock = threading.Lock()
+    for tar_info in tar_file:
+        if not tar_info.isfile():
+            # Directories, links and other special members
+            continue
+        reason = get_member_skip_reason(tar_info) if prefilter else None
+        if reason is None:
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            data = tar_file.extractfile(tar_info).read()
+            _add_stage_stats(stats, lock, 'decompress', len(data), time.perf_counter() - start,
+                             time.thread_time() - cpu_start)
+            if prefilter and data:
+                reason = sniff_dicom(data[:DICOM_PREFIX_SIZE])
+        if reason:
+            log.debug('Skipping %s: %s', tar_info.name, reason)
+            skipped[reason] += 1
+            continue
+        start, cpu_start = time.perf_counter(), time.thread_time()
+        res = parse_func(tar_info.name, force=force, counters=counters, data=data)
+        _add_stage_stats(stats, lock, 'parse', len(data), time.perf_counter() - start,
+                         time.thread_time() - cpu_start)
+        yield res
+
+
+def _log_pipeline_stats(stats):
+    """Log the throughput of each stage of the zip member pipeline"""
+    for stage in ('decompress', 'parse'):
+        stage_stats = stats.get(stage)
+        if stage_stats and stage_stats['seconds'] > 0:
+            log.info('%s: %s files, %.1f MB in %.2fs busy (%.1f MB/s)', stage, stage_stats['files'],
+                     stage_stats['bytes'] / 1e6, stage_stats['seconds'],
+                     stage_stats['bytes'] / 1e6 / stage_stats['seconds'])
+    if 'wall_seconds' in stats:
+        log.info('Zip member pipeline took %.2fs', stats['wall_seconds'])
+
+
+def _add_pipeline_perf(perf, stats):
+    """Add the zip member pipeline stats to the 'unzip' and 'parse' stages of perf
+
+    The wall_seconds of these stages are the busy time summed over the worker threads.
+    """
+    for stage, perf_stage in (('decompress', 'unzip'), ('parse', 'parse')):
+        stage_stats = stats.get(stage)
+        if stage_stats:
+            perf.add(perf_stage, files=stage_stats['files'], bytes=stage_stats['bytes'],
+                     wall_seconds=stage_stats['seconds'], cpu_seconds=stage_stats['cpu_seconds'])
+    if 'wall_seconds' in stats:
+        perf.add('zip_pipeline', wall_seconds=stats['wall_seconds'])
+
+
+def get_sample_indices(n_members, sample_size):
+    """Return the sorted indices of the first, last and sample_size stratified members
+
+    The members in between the first and the last are split into sample_size
+    strata of equal size and the middle member of each stratum is sampled.
+
+    >>> get_sample_indices(100, 4)
+    [0, 13, 37, 62, 86, 99]
+    >>> get_sample_indices(3, 4)
+    [0, 1, 2]
+    """
+    if n_members <= sample_size + 2:
+        return list(range(n_members))
+    inner = n_members - 2
+    indices = {0, n_members - 1}
+    for stratum in range(sample_size):
+        indices.add(1 + int((stratum + 0.5) * inner / sample_size))
+    return sorted(indices)
+
+
+def _get_slice_positions(dcm_dict_list):
+    """Return the slice positions along the slice normal or None if the geometry is inconsistent
+
+    The geometry is inconsistent if any slice is missing, invalid, multi-frame
+    or if the ImageOrientationPatient or ImageType differ between slices.
+    """
+    if any(not el['has_header'] or el['pydicom_exception'] or el.get('frames') is not None for el in dcm_dict_list):
+        return None
+    headers = [el['header'] for el in dcm_dict_list]
+    if any(header.get('ImageType') != headers[0].get('ImageType') for header in headers):
+        return None
+    try:
+        iop = np.array([header['ImageOrientationPatient'] for header in headers], dtype=float)
+        ipp = np.array([header['ImagePositionPatient'] for header in headers], dtype=float)
+    except (KeyError, TypeError, ValueError):
+        return None
+    if iop.shape != (len(headers), 6) or ipp.shape != (len(headers), 3) or not np.allclose(iop, iop[0]):
+        return None
+    normal = np.cross(iop[0, :3], iop[0, 3:])
+    return ipp @ normal
+
+
+def get_sampling_confidence(dcm_dict_list, indices):
+    """Return how well the sampled slices represent the whole series
+
+    Args:
+        dcm_dict_list (list): get_dcm_data_dict of the sampled members
+        indices (list): Index of each sampled member in the series
+
+    Returns:
+        str: 'high' if the slice positions are linear in the member index,
+            'medium' if every sampled position is repeated (e.g. dynamic
+            series), None if the sampled geometry is inconsistent
+    """
+    positions = _get_slice_positions(dcm_dict_list)
+    if positions is None or len(positions) < 2:
+        return None
+    indices = np.asarray(indices, dtype=float)
+    slope = (positions[-1] - positions[0]) / (indices[-1] - indices[0])
+    if abs(slope) > 0:
+        residuals = np.abs(positions - (positions[0] + slope * (indices - indices[0])))
+        if residuals.max() <= SAMPLE_POSITION_TOLERANCE * abs(slope):
+            return 'high'
+    _, counts = np.unique(np.round(positions, 2), return_counts=True)
+    if len(counts) > 1 and counts.min() > 1:
+        return 'medium'
+    return None
+
+
+def sample_zip_data_dicts(zip_file, sample_size, force=False, counters=None, **pipeline_kwargs):
+    """Parse only a sample of the zip members
+
+    The slice count is the number of members that look like DICOM files (see
+    filter_dicom_members), so that only their first bytes are decompressed.
+    The first and last members plus sample_size stratified members are parsed.
+
+    Args:
+        zip_file (zipfile.ZipFile): An open zip file
+        sample_size (int): Number of members sampled in between the first and the last
+        force (bool): Passed to get_dcm_data_dict
+        counters (collections.Counter): Passed to get_dcm_data_dict
+        **pipeline_kwargs: Passed to iter_zip_data_dicts
+
+    Returns:
+        tuple: The list of sampled get_dcm_data_dict (None if the sampled
+            geometry is inconsistent and the whole archive must be parsed)
+            and a dict describing the sampling (slice_count, sampled, confidence)
+    """
+    members = sorted(filter_dicom_members(zip_file), key=lambda zip_info: PurePosixPath(zip_info.filename))
+    indices = get_sample_indices(len(members), sample_size)
+    sampling = {'slice_count': len(members), 'sampled': len(indices), 'confidence': None}
+    if len(indices) == len(members):
+        return None, sampling
+    sampled = [members[idx] for idx in indices]
+    dcm_dict_list = list(iter_zip_data_dicts(zip_file, sampled, force=force, counters=counters, **pipeline_kwargs))
+    sampling['confidence'] = get_sampling_confidence(dcm_dict_list, indices)
+    if sampling['confidence'] is None:
+        return None, sampling
+    return dcm_dict_list, sampling
+
+
+class RepresentativeSelector(abc.ABC):
+    """Select the representative file of a series while streaming its records
+
+    Only the candidate records are kept, so that selecting the
+    representative does not require reading any file again. Records are
+    compared by member path, so that the selected record does not depend on
+    the order they are offered in (e.g. the archive order of a tar stream).
+    A representative is a non empty file with a header that pydicom could
+    read. Files with the Raw Data Storage SOP Class are skipped, unless it is
+    the last file of the series.
+
+    Concrete selectors implement offer_valid() and selected().
+
+    Args:
+        n_records (int): Number of records that will be offered, if known.
+            Only given when the records are offered in member path order.
+
+    Attributes:
+        sort_key (tuple): Member path and offer index of the last offered
+            record, records are ordered by sort_key
+    """
+
+    def __init__(self, n_records=None):
+        self.n_records = n_records
+        self.index = -1
+        self.sort_key = None
+        self.last_raw = None
+        self._last_key = None
+
+    def offer(self, record):
+        """Offer the next record of the series"""
+        self.index += 1
+        self.sort_key = (PurePosixPath(record['path']), self.index)
+        is_last = self._last_key is None or self.sort_key > self._last_key
+        if is_last:
+            self._last_key = self.sort_key
+            self.last_raw = None
+        if record['size'] > 0 and record['has_header'] and not record['pydicom_exception']:
             # Here we check for the Raw Data Storage SOP Class, if there
             # are other pydicom files in the zip then we read the next one,
             # if this is the only class of pydicom in the file, we accept
             # our fate and move on.
-            if dcm_dict_el['header'].get('SOPClassUID') == 'Raw Data Storage' and idx < len(dcm_dict_list) - 1:
-                log.warning('SOPClassUID=Raw Data Storage for %s. Skipping', dcm_dict_el['path'])
-                continue
+            if record['header'].get('SOPClassUID') == 'Raw Data Storage':
+                log.debug('SOPClassUID=Raw Data Storage for %s. Skipping', record['path'])
+                if is_last:
+                    self.last_raw = record
             else:
-                # Note: no need to try/except, all files have already been open when calling get_dcm_data_dict
-                dcm_path = dcm_dict_el['path']
-                dcm = pydicom.dcmread(dcm_path, force=force)
-                break
-        elif dcm_dict_el['size'] < 1:
-            log.warning('%s is empty. Skipping.', os.path.basename(dcm_dict_el['path']))
-        elif dcm_dict_el['pydicom_exception']:
-            log.warning('Pydicom raised on reading %s. Skipping.', os.path.basename(dcm_dict_el['path']))
-    if not dcm:
-        log.warning('No Dicom file found to be parsed!!!')
-        sys.exit(1)
+                self.offer_valid(record)
+        elif record['size'] < 1:
+            log.debug('%s is empty. Skipping.', os.path.basename(record['path']))
+        elif record['pydicom_exception']:
+            log.debug('Pydicom raised on reading %s. Skipping.', os.path.basename(record['path']))
+
+    @abc.abstractmethod
+    def offer_valid(self, record):
+        """Offer a valid record that is not Raw Data Storage"""
+
+    @abc.abstractmethod
+    def selected(self):
+        """Return the selected valid record or None"""
+
+    def select(self):
+        """Return the representative record or None if there is none"""
+        record = self.selected()
+        if record is None:
+            record = self.last_raw
+        return record
+
+
+class FirstValidSelector(RepresentativeSelector):
+    """Select the first valid file of the series"""
+
+    def __init__(self, n_records=None):
+        super().__init__(n_records)
+        self.record = None
+        self.record_key = None
+
+    def offer_valid(self, record):
+        if self.record is None or self.sort_key < self.record_key:
+            self.record, self.record_key = record, self.sort_key
+
+    def selected(self):
+        return self.record
+
+
+class MedianSliceSelector(RepresentativeSelector):
+    """Select the valid file closest to the middle of the series (in series order)
+
+    If the number of records is unknown, the valid records are kept without
+    their dataset until the median one can be selected, and the dataset of
+    the selected file is read again (see _read_representative_datasets).
+    """
+
+    def __init__(self, n_records=None):
+        super().__init__(n_records)
+        self.record = None
+        self.distance = None
+        self.sort_keys = []
+        self.records = []
+
+    def offer(self, record):
+        super().offer(record)
+        if self.n_records is None:
+            self.sort_keys.append(self.sort_key)
+
+    def offer_valid(self, record):
+        if self.n_records is None:
+            self.records.append((self.sort_key, {key: value for key, value in record.items() if key != 'dataset'}))
+            return
+        distance = abs(self.index - (self.n_records - 1) // 2)
+        if self.distance is None or distance < self.distance:
+            self.record, self.distance = record, distance
+
+    def selected(self):
+        if self.n_records is not None or not self.records:
+            return self.record
+        sort_keys = sorted(self.sort_keys)
+        middle = (len(sort_keys) - 1) // 2
+        _, _, record = min((abs(bisect_left(sort_keys, sort_key) - middle), sort_key, record)
+                           for sort_key, record in self.records)
+        return record
+
+
+class MostCommonImageTypeSelector(RepresentativeSelector):
+    """Select the first valid file having the most common ImageType of the series"""
+
+    def __init__(self, n_records=None):
+        super().__init__(n_records)
+        self.counts = Counter()
+        self.records = {}
+
+    def offer_valid(self, record):
+        image_type = record['header'].get('ImageType')
+        key = tuple(image_type) if isinstance(image_type, list) else image_type
+        self.counts[key] += 1
+        if key not in self.records or self.sort_key < self.records[key][0]:
+            self.records[key] = (self.sort_key, record)
+
+    def selected(self):
+        if not self.counts:
+            return None
+        # The ImageType of the first file wins ties
+        key = min(self.counts, key=lambda key: (-self.counts[key], self.records[key][0]))
+        return self.records[key][1]
+
+
+REPRESENTATIVE_SELECTORS = {
+    'first': FirstValidSelector,
+    'median': MedianSliceSelector,
+    'image_type': MostCommonImageTypeSelector,
+}
+
+
+class SeriesGroup:
+    """Slices of one series: their SliceTable and representative selector
+
+    Args:
+        key (dict): Values of the grouping keywords shared by the slices
+        selector (RepresentativeSelector): The representative selector of the group
+    """
+
+    def __init__(self, key, selector):
+        self.key = key
+        self.table = SliceTable()
+        self.selector = selector
+
+    def offer(self, record):
+        self.table.append(record)
+        self.selector.offer(record)
+
+
+class SeriesGrouper:
+    """Partition records into SeriesGroup in a single pass
+
+    Records are grouped by the values of the group_by header keywords (e.g.
+    SeriesInstanceUID, AcquisitionNumber). With an empty group_by, all
+    records belong to a single group. Records without any of the group_by
+    values (e.g. empty or unreadable files) join the group of the previous
+    record.
+
+    Args:
+        selector_class (type): RepresentativeSelector class used for each group
+        group_by (tuple): Header keywords the records are grouped by
+        n_records (int): Number of records that will be offered, if known.
+            Only used when there is no group_by, since the size of each group
+            is not known in advance otherwise.
+    """
+
+    def __init__(self, selector_class, group_by=(), n_records=None):
+        self.selector_class = selector_class
+        self.group_by = tuple(group_by)
+        self.n_records = n_records
+        self.groups = {}
+        self._last_key = None
+
+    def offer(self, record):
+        key = tuple(record['header'].get(keyword) for keyword in self.group_by)
+        if self.group_by and all(value is None for value in key) and self._last_key is not None:
+            key = self._last_key
+        self._last_key = key
+        group = self.groups.get(key)
+        if group is None:
+            selector = self.selector_class(None if self.group_by else self.n_records)
+            group = self.groups[key] = SeriesGroup(dict(zip(self.group_by, key)), selector)
+        group.offer(record)
+
+
+def open_input(dicom_input):
+    """Return the name and the file path or binary file object of a process_dicom input
+
+    bytes are wrapped in a new BytesIO, so that concurrent calls on the same
+    bytes do not share a file position. File objects (e.g. BytesIO) are used
+    as is and must be seekable.
+
+    Examples
+    --------
+    >>> open_input('/flywheel/v0/input/file/series.zip')
+    ('series.zip', '/flywheel/v0/input/file/series.zip')
+    >>> name, fp = open_input(b'DICM')
+    >>> name, fp.read()
+    ('<in-memory>', b'DICM')
+    """
+    if isinstance(dicom_input, (bytes, bytearray, memoryview)):
+        return IN_MEMORY_NAME, BytesIO(dicom_input)
+    if hasattr(dicom_input, 'read'):
+        name = getattr(dicom_input, 'name', None)
+        return (os.path.basename(name) if isinstance(name, str) else IN_MEMORY_NAME), dicom_input
+    return os.path.basename(dicom_input), dicom_input
+
+
+def _stream_series(file_path, force=True, prefilter=True, decompress_workers=DECOMPRESS_WORKERS,
+                   parse_workers=PARSE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, stats=None, sample_size=None,
+                   representative='first', group_by=(), perf=None):
+    """Stream the records of file_path into a SeriesGrouper
+
+    See process_dicom for the arguments.
+
+    Returns:
+        tuple: The SeriesGrouper and the sampling dict (None if all the slices were parsed)
+    """
+    if stats is None:
+        stats = {}
+    if perf is None:
+        perf = perf_utils.PerfRecorder()
+    selector_class = REPRESENTATIVE_SELECTORS[representative]
+    seq_counters = Counter()
+    sampling = None
+    files = Counter()
+    name, file_path = open_input(file_path)
+    start = file_path.tell() if hasattr(file_path, 'read') else None
+    if zipfile.is_zipfile(file_path):
+        try:
+            log.info('Reading %s ' % name)
+            zip = zipfile.ZipFile(file_path)
+            pipeline_kwargs = {'decompress_workers': decompress_workers, 'parse_workers': parse_workers,
+                               'queue_size': queue_size, 'stats': stats, 'parse_func': get_dcm_record}
+            records = None
+            if sample_size:
+                records, sampling = sample_zip_data_dicts(zip, sample_size, force=force, counters=seq_counters,
+                                                          **pipeline_kwargs)
+                if records is None:
+                    log.info('Sampled slice geometry is not conclusive (%s). Parsing all slices.', sampling)
+                    sampling = None
+                    seq_counters.clear()
+                    stats.clear()
+                else:
+                    log.info('Estimated series geometry from %s of %s slices (confidence: %s)',
+                             sampling['sampled'], sampling['slice_count'], sampling['confidence'])
+                    grouper = SeriesGrouper(selector_class, group_by=group_by, n_records=len(records))
+            if records is None:
+                if prefilter:
+                    skipped = Counter()
+                    members = filter_dicom_members(zip, counters=skipped)
+                    if skipped:
+                        log.info('Skipped %s non-DICOM zip members: %s', sum(skipped.values()), dict(skipped))
+                else:
+                    members = [zip_info for zip_info in zip.infolist() if not zip_info.is_dir()]
+                members = sorted(members, key=lambda zip_info: PurePosixPath(zip_info.filename))
+                records = iter_zip_data_dicts(zip, members, force=force, counters=seq_counters, **pipeline_kwargs)
+                grouper = SeriesGrouper(selector_class, group_by=group_by, n_records=len(members))
+            for record in records:
+                grouper.offer(record)
+            _read_representative_datasets(grouper, lambda paths: (
+                get_dcm_record(path, force=force, data=zip.read(path)) for path in sorted(paths)))
+        except Exception as exc:
+            raise DicomProcessingError('Zip file %s is corrupted' % name) from exc
+        _log_pipeline_stats(stats)
+        _add_pipeline_perf(perf, stats)
     else:
-        log.info('%s will be used for metadata extraction', os.path.basename(dcm_path))
+        fp = file_path if start is not None else open(file_path, 'rb')
+        try:
+            # is_zipfile moved the file position
+            fp.seek(start or 0)
+            stream_format = sniff_stream_format(fp)
+            if stream_format == 'tar':
+                grouper = _stream_tar_series(fp, name, selector_class, group_by, force, prefilter, seq_counters,
+                                             stats, sample_size)
+                _log_pipeline_stats(stats)
+                _add_pipeline_perf(perf, stats)
+            else:
+                grouper = SeriesGrouper(selector_class, group_by=group_by, n_records=1)
+                with perf.stage('parse') as perf_stage:
+                    if stream_format == 'gzip':
+                        log.info('Not a zip. Attempting to read gzipped %s directly' % name)
+                        record = _read_gzip_record(fp, name, force, seq_counters)
+                    else:
+                        log.info('Not a zip. Attempting to read %s directly' % name)
+                        if start is None:
+                            record = get_dcm_record(file_path, force=force, counters=seq_counters)
+                        else:
+                            record = get_dcm_record(name, force=force, counters=seq_counters, data=fp.read())
+                    perf_stage['files'] += 1
+                    perf_stage['bytes'] += record['size']
+                grouper.offer(record)
+                _read_representative_datasets(grouper, lambda paths: [record])
+        finally:
+            if fp is not file_path:
+                fp.close()
+
+    if seq_counters:
+        log.info('Truncated sequence data while extracting headers: %s', dict(seq_counters))
+    for group in grouper.groups.values():
+        files.update(group.table.counts)
+    log.info('Parsed %s files: %s', files['files'], dict(files))
+    return grouper, sampling
+
+
+def _stream_tar_series(fp, name, selector_class, group_by, force, prefilter, seq_counters, stats, sample_size):
+    """Return the SeriesGrouper of the members of a (compressed) tar stream, see _stream_series
+
+    The records are offered as the stream is read, so that only the
+    representative candidates keep their dataset. The slices and the
+    representative are ordered by member path as in zip archives, whatever
+    order the archive was written in. Members without any of the group_by
+    values still join the group of the previous member of the stream.
+    Representatives selected without their dataset (see MedianSliceSelector)
+    are read again from a second pass over the stream.
+    """
+    log.info('Reading tar stream %s ' % name)
+    if sample_size:
+        log.info('Tar members cannot be sampled without reading the whole stream. Parsing all slices.')
+
+    def read_records(paths):
+        paths = set(paths)
+        fp.seek(start)
+        with tarfile.open(fileobj=fp, mode='r|*') as tar_file:
+            for tar_info in tar_file:
+                if tar_info.name in paths:
+                    paths.discard(tar_info.name)
+                    yield get_dcm_record(tar_info.name, force=force, data=tar_file.extractfile(tar_info).read())
+                    if not paths:
+                        break
+
+    start = fp.tell()
+    try:
+        skipped = Counter()
+        grouper = SeriesGrouper(selector_class, group_by=group_by)
+        with tarfile.open(fileobj=fp, mode='r|*') as tar_file:
+            for record in iter_tar_data_dicts(tar_file, force=force, counters=seq_counters, prefilter=prefilter,
+                                              skipped=skipped, stats=stats, parse_func=get_dcm_record):
+                grouper.offer(record)
+        if skipped:
+            log.info('Skipped %s non-DICOM tar members: %s', sum(skipped.values()), dict(skipped))
+        _read_representative_datasets(grouper, read_records)
+    except Exception as exc:
+        raise DicomProcessingError('Tar file %s is corrupted' % name) from exc
+    return grouper
+
+
+def _read_representative_datasets(grouper, read_records):
+    """Read again the dataset of the representatives selected without it
+
+    Args:
+        grouper (SeriesGrouper): The grouper the records were offered to
+        read_records (callable): Called with the set of member paths to read
+            again, returns an iterable of their get_dcm_record
+    """
+    missing = {}
+    for group in grouper.groups.values():
+        record = group.selector.select()
+        if record is not None and 'dataset' not in record:
+            missing.setdefault(record['path'], []).append(record)
+    if not missing:
+        return
+    log.info('Reading %s representative files again', len(missing))
+    for read_record in read_records(set(missing)):
+        for record in missing[read_record['path']]:
+            record['dataset'] = read_record['dataset']
+
+
+def _read_gzip_record(fp, name, force, seq_counters):
+    """Return the get_dcm_record of a gzipped dicom file, decompressed in memory"""
+    try:
+        data = GzipFile(fileobj=fp, mode='rb').read()
+    except (EOFError, OSError, zlib.error) as exc:
+        raise DicomProcessingError('Gzip file %s is corrupted' % name) from exc
+    return get_dcm_record(name[:-3] if name.lower().endswith('.gz') else name, force=force, counters=seq_counters,
+                          data=data)
+
+
+def _get_series_result(group, sampling, perf):
+    """Return the (df, dcm) of a SeriesGroup or None if it has no representative file"""
+    with perf.stage('representative'):
+        representative_record = group.selector.select()
+    if representative_record is None:
+        return None
+    dcm = representative_record['dataset']
+    log.info('%s will be used for metadata extraction', os.path.basename(representative_record['path']))
 
     # Apply fix_VM1_callback on data element
-    _ = walk_dicom(dcm, callbacks=[fix_VM1_callback], recursive=True)
+    with perf.stage('walk_dicom'):
+        _ = walk_dicom(dcm, callbacks=[fix_VM1_callback], recursive=True)
 
     # Create pandas object for comparing headers
-    data = []
-    for el in dcm_dict_list:
-        data.append({
-            'path': el['path'],
-            'SliceLocation': el['header'].get('SliceLocation'),
-            'ImageType': el['header'].get('ImageType'),
-            'ImageOrientationPatient': el['header'].get('ImageOrientationPatient'),
-            'ImagePositionPatient': el['header'].get('ImagePositionPatient'),
-        })
-    df = pd.DataFrame(data)
-
+    df = group.table.to_dataframe()
+    if sampling:
+        sampled = group.table.counts['files']
+        if sampled == sampling['sampled']:
+            df.attrs['slice_count'] = sampling['slice_count']
+        else:
+            # Sampled group of a multi-series archive: scale the slice count with the group share
+            df.attrs['slice_count'] = round(sampling['slice_count'] * sampled / sampling['sampled'])
+        df.attrs['sampling'] = sampling
     return df, dcm
 
+
+def process_dicom(file_path, force=True, prefilter=True, decompress_workers=DECOMPRESS_WORKERS,
+                  parse_workers=PARSE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, stats=None, sample_size=None,
+                  representative='first', perf=None):
+    '''
+    Create Pandas Dataframe where each row is a dicom image header information
+
+    Slices are streamed: each file is parsed into a minimal record (see
+    get_dcm_record) which is accumulated into a SliceTable and dropped, so
+    that no header is kept for the whole series.
+
+    The representative dataset (read without pixel data) is selected while
+    streaming by the representative strategy, one of
+    REPRESENTATIVE_SELECTORS ('first', 'median' or 'image_type').
+
+    If prefilter is True, zip members that do not look like DICOM files
+    (see filter_dicom_members) are skipped without being decompressed or parsed.
+    Zip members are streamed from the archive without extraction to disk
+    (see iter_zip_data_dicts for decompress_workers, parse_workers and
+    queue_size). If provided, the dict stats is updated with the pipeline
+    stage counters.
+
+    If sample_size is set, only the first, last and sample_size stratified
+    members of a zip are parsed (see sample_zip_data_dicts). The whole archive
+    is parsed if the sampled geometry is inconsistent. The DataFrame then only
+    holds the sampled slices; df.attrs['slice_count'] holds the slice count of
+    the series and df.attrs['sampling'] describes the sampling.
+
+    If provided, the perf_utils.PerfRecorder perf records the 'unzip',
+    'parse', 'representative' and 'walk_dicom' stages.
+
+    Tar archives, compressed (e.g. tar.gz) or not, and gzipped dicom files
+    (e.g. .dcm.gz) are read as streams: members are decompressed and parsed
+    one at a time, without seeking or extraction to disk (see
+    iter_tar_data_dicts), into the same slices and representative as the
+    zip archive of the same files. Tar members are not sampled. Since the
+    number of tar members is not known in advance, the 'median'
+    representative member is read again from a second pass over the stream.
+
+    file_path may also be the content of the zip, tar or dicom file, as bytes
+    or a seekable binary file object (see open_input), which is then read
+    without any disk access.
+
+    DicomProcessingError is raised if the input is corrupted or holds no
+    dicom file that can be read.
+    '''
+    if perf is None:
+        perf = perf_utils.PerfRecorder()
+    grouper, sampling = _stream_series(file_path, force=force, prefilter=prefilter,
+                                       decompress_workers=decompress_workers, parse_workers=parse_workers,
+                                       queue_size=queue_size, stats=stats, sample_size=sample_size,
+                                       representative=representative, perf=perf)
+    # Select a representative dcm file
+    # Currently: not 0-byte file and SOPClassUID not Raw Data Storage unless that the only file
+    log.info('Selecting a valid Dicom file for parsing (strategy: %s)', representative)
+    result = _get_series_result(next(iter(grouper.groups.values())), sampling, perf) if grouper.groups else None
+    if result is None:
+        raise DicomProcessingError('No Dicom file found to be parsed')
+    return result
+
+
+def process_dicom_groups(file_path, group_by=('SeriesInstanceUID',), **kwargs):
+    '''
+    Same as process_dicom but for archives bundling several series
+
+    Slices are partitioned in a single pass by the values of the group_by
+    header keywords (see SeriesGrouper), e.g. ('SeriesInstanceUID',) or
+    ('SeriesInstanceUID', 'AcquisitionNumber'). Each group gets its own
+    DataFrame and representative dataset. Groups without a valid
+    representative file are dropped. Since group sizes are not known in
+    advance, the 'median' representative of each group is kept without its
+    dataset while streaming and read again once selected (see
+    MedianSliceSelector); no other file is read twice.
+
+    Args:
+        file_path (str): Path of the zip archive or dicom file, or its content (see process_dicom)
+        group_by (tuple): Header keywords the slices are grouped by
+        **kwargs: Passed to process_dicom
+
+    Returns:
+        list: List of (key, df, dcm) tuples, key being a dict of the group_by
+            values, in the order the groups are first seen in the archive
+
+    Raises:
+        DicomProcessingError: If the input is corrupted or no group has a
+            dicom file that can be read
+    '''
+    perf = kwargs['perf'] = kwargs.get('perf') or perf_utils.PerfRecorder()
+    grouper, sampling = _stream_series(file_path, group_by=group_by, **kwargs)
+    results = []
+    for group in grouper.groups.values():
+        result = _get_series_result(group, sampling, perf)
+        if result is None:
+            log.warning('No Dicom file found to be parsed for series %s. Skipping.', group.key)
+            continue
+        results.append((group.key,) + result)
+    if not results:
+        raise DicomProcessingError('No Dicom file found to be parsed')
+    log.info('Found %s series: %s', len(results), [key for key, _, _ in results])
+    return results
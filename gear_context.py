@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+import random
+import time
+
+import flywheel
+
+
+log = logging.getLogger(__name__)
+
+# Path of a FakeGearContext JSON fixture, used instead of flywheel.GearContext when set
+FAKE_CONTEXT_ENV = 'GEAR_FAKE_CONTEXT'
+
+
+class FakeClient:
+    """Stand-in for the flywheel.Client calls made by the gear
+
+    Args:
+        acquisitions (dict): Acquisition attributes (e.g. label) by id
+        latency (float): Seconds slept on each call
+        failure_rate (float): Probability for a call to raise flywheel.ApiException
+        seed (int): Seed of the failure draws, None for a random seed
+    """
+
+    def __init__(self, acquisitions, latency=0.0, failure_rate=0.0, seed=None):
+        self.acquisitions = acquisitions
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+
+    def get(self, container_id):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            raise flywheel.ApiException(status=503, reason='Injected failure')
+        if container_id not in self.acquisitions:
+            raise flywheel.ApiException(status=404, reason='Acquisition %s not found' % container_id)
+        return flywheel.Acquisition(id=container_id, **self.acquisitions[container_id])
+
+
+class FakeGearContext:
+    """Offline stand-in for flywheel.GearContext
+
+    The fixture is a JSON object with the acquisition the gear runs on and the
+    latency and failures injected in client calls:
+
+        {
+            "acquisition": {"id": "5e...", "label": "T1 MPRAGE"},
+            "latency": 0.05,
+            "failure_rate": 0.1,
+            "seed": 0
+        }
+
+    Args:
+        fixture_path (str): Path of the JSON fixture
+    """
+
+    def __init__(self, fixture_path):
+        with open(fixture_path) as fixture_file:
+            fixture = json.load(fixture_file)
+        acquisition = dict(fixture['acquisition'])
+        acquisition_id = acquisition.pop('id')
+        self.destination = {'id': acquisition_id, 'type': 'acquisition'}
+        self.client = FakeClient({acquisition_id: acquisition}, latency=fixture.get('latency', 0.0),
+                                 failure_rate=fixture.get('failure_rate', 0.0), seed=fixture.get('seed'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def get_gear_context(fake_context_path=None):
+    """Return a FakeGearContext if a fixture is given (or set in GEAR_FAKE_CONTEXT), else a flywheel.GearContext"""
+    fake_context_path = fake_context_path or os.environ.get(FAKE_CONTEXT_ENV)
+    if fake_context_path:
+        log.info('Using fake gear context from %s', fake_context_path)
+        return FakeGearContext(fake_context_path)
+    return flywheel.GearContext()
@@ -0,0 +1,173 @@
+"""Vectorized classification of many labels at once
+
+classify_labels returns, for every label of a pandas Series, the
+classification of MR_classifier.infer_classification and the anatomy of
+common_utils.get_anatomy_from_label. Labels are deduplicated first, each
+pattern of the label rules (rule_engine.RULES) is matched once over the unique
+labels with a single str.contains, and the rule priorities are resolved with
+boolean masks.
+"""
+import logging
+import warnings
+from functools import reduce
+from operator import add
+
+import pandas as pd
+
+import common_utils
+import MR_classifier
+import rule_engine
+
+
+log = logging.getLogger(__name__)
+
+CLASSIFICATION_COLUMNS = ['Intent', 'Measurement', 'Features', 'Custom', 'Anatomy']
+# Column of the error raised classifying the anatomy of a label, if any
+ERROR_COLUMN = 'Error'
+
+
+def contains(labels, regex):
+    """Return the boolean mask of the labels matching regex, searched as regex_search_label does"""
+    if common_utils.MAX_LABEL_LENGTH:
+        labels = labels.str.slice(stop=common_utils.MAX_LABEL_LENGTH)
+    with warnings.catch_warnings():
+        # Capturing groups of the rules are irrelevant to a match
+        warnings.filterwarnings('ignore', 'This pattern is interpreted as a regular expression')
+        return labels.str.contains(regex, regex=True).astype(bool)
+
+
+def pattern_mask(labels, pattern):
+    """Return the boolean mask of the labels matching a rule_engine.Pattern, as Pattern.search"""
+    if pattern.min_count is not None:
+        return labels.str.lower().str.count(pattern.regex) >= pattern.min_count
+    return contains(labels, pattern.regex)
+
+
+def rule_masks(labels, rules):
+    """Return the boolean masks of the labels matching each of rules, each pattern being matched once"""
+    masks = {}
+    for name in {name for rule in rules for name in rule.when + rule.unless}:
+        masks[name] = pattern_mask(labels, rule_engine.RULES.patterns[name])
+    matched = []
+    for rule in rules:
+        mask = pd.Series(True, index=labels.index)
+        for name in rule.when:
+            mask &= masks[name]
+        for name in rule.unless:
+            mask &= ~masks[name]
+        matched.append(mask)
+    return matched
+
+
+def _find_matches(labels, names):
+    """Return the MR_classifier._find_matches of the labels, as a boolean matrix
+
+    The regex of a name only matches labels containing the name (T2 for T2*),
+    so it is only searched in the ASCII labels containing it, ignoring case,
+    and in the other labels.
+    """
+    lowered = labels.str.lower()
+    not_ascii = ~labels.map(str.isascii)
+    matches = pd.DataFrame(False, index=labels.index, columns=names)
+    for name in names:
+        candidates = not_ascii | lowered.str.contains('t2' if name == 'T2*' else name.lower(), regex=False)
+        matches.loc[candidates, name] = contains(labels[candidates], MR_classifier._compile_regex(name))
+    return matches.to_numpy()
+
+
+def _cascade(labels):
+    """Return the infer_classification of the labels, as a list of dicts"""
+    unmatched = pd.Series(True, index=labels.index)
+    rule_index = pd.Series(-1, index=labels.index)
+    for idx, rule in enumerate(MR_classifier.LABEL_RULES):
+        # Only the labels not matched by a higher priority rule need to be searched
+        matched, = rule_masks(labels[unmatched], [rule])
+        matched = matched[matched].index
+        rule_index[matched] = idx
+        unmatched[matched] = False
+
+    checks = [(key, names, _find_matches(labels, names))
+              for key, names in (('Features', MR_classifier.FEATURES),
+                                 ('Measurement', MR_classifier.MEASUREMENTS),
+                                 ('Intent', MR_classifier.INTENTS))]
+
+    classifications = []
+    for position, label in enumerate(labels):
+        rule = rule_index.iat[position]
+        classification = {}
+        if label and rule >= 0:
+            classification = {key: list(value) for key, value in MR_classifier.LABEL_RULES[rule].output.items()}
+        if label:
+            for key, names, matches in checks:
+                found = [name for name, match in zip(names, matches[position]) if match]
+                if found:
+                    values = classification.get(key, [])
+                    values.extend(name for name in found if name not in values)
+                    classification[key] = values
+        classifications.append(classification)
+    return classifications
+
+
+def _anatomy(labels):
+    """Return the get_anatomy_classification of the labels, as a list of lists, and the error of each label
+
+    A label whose ranged anatomy raises (e.g. out of sequence, or ending in
+    'to') gets a None anatomy and the error message, the other labels are
+    classified as usual.
+    """
+    rules = rule_engine.RULES.tables['anatomy'].rules
+    matrix = pd.concat(rule_masks(labels, rules), axis=1).to_numpy()
+
+    anatomies = []
+    errors = []
+    ranged = pattern_mask(labels.str.lower(), rule_engine.RULES.patterns['to'])
+    for position, label in enumerate(labels):
+        new_anatomy = []
+        if ranged.iat[position]:
+            try:
+                new_anatomy = common_utils.get_ranged_anatomy(label)
+            except (IndexError, ValueError) as exc:
+                log.warning('Unable to classify the ranged anatomy of %r: %s', label, exc)
+                anatomies.append(None)
+                errors.append('%s: %s' % (type(exc).__name__, exc))
+                continue
+        if not new_anatomy:
+            new_anatomy = [rule.output for rule, found in zip(rules, matrix[position]) if found]
+            if new_anatomy:
+                # Same set insertion order as get_anatomy_classification
+                new_anatomy = list(set(reduce(add, new_anatomy)))
+        anatomies.append(new_anatomy)
+        errors.append(None)
+    return anatomies, errors
+
+
+def classify_labels(labels):
+    """Classify many labels at once, as the scalar path would classify each of them
+
+    Args:
+        labels (pandas.Series): Acquisition labels or SeriesDescriptions
+
+    Returns:
+        pandas.DataFrame: One row per label, with the index of labels and the
+            CLASSIFICATION_COLUMNS columns: the Intent, Measurement, Features and
+            Custom of MR_classifier.infer_classification (NaN where the key is not
+            set) and the Anatomy of common_utils.get_anatomy_from_label. Labels that
+            are not strings are not classified. Labels whose ranged anatomy
+            raises (e.g. out of sequence) get a NaN Anatomy and the error in
+            the ERROR_COLUMN column, NaN for the other labels.
+    """
+    labels = pd.Series(labels, dtype=object)
+    is_label = labels.map(lambda label: isinstance(label, str))
+    unique = pd.Series(labels[is_label].unique(), dtype=object)
+
+    records = _cascade(unique)
+    anatomies, errors = _anatomy(unique)
+    for record, anatomy, error in zip(records, anatomies, errors):
+        record['Anatomy'] = anatomy
+        record[ERROR_COLUMN] = error
+    classified = pd.DataFrame(records, columns=CLASSIFICATION_COLUMNS + [ERROR_COLUMN], index=unique.values,
+                              dtype=object)
+
+    result = classified.reindex(labels.where(is_label).values)
+    result.index = labels.index
+    return result
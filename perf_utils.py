@@ -0,0 +1,209 @@
+import cProfile
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+
+log = logging.getLogger(__name__)
+
+STAGE_KEYS = ('wall_seconds', 'cpu_seconds', 'files', 'bytes')
+# Environment variables overriding the profiler and profiler_tracemalloc_top config options
+PROFILER_ENV = 'GEAR_PROFILER'
+TRACEMALLOC_TOP_ENV = 'GEAR_TRACEMALLOC_TOP'
+PROFILERS = ('cprofile', 'sampling')
+SAMPLING_INTERVAL = 0.005
+PSTATS_FILENAME = 'profile.pstats'
+COLLAPSED_FILENAME = 'profile.collapsed'
+TRACEMALLOC_FILENAME = 'tracemalloc_top.txt'
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of the process in MB"""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak_rss / 1e6 if sys.platform == 'darwin' else peak_rss / 1e3
+
+
+class PerfRecorder:
+    """Record wall time, CPU time, file and byte counts and peak RSS of named stages
+
+    Stages are recorded in the order they are first seen. Recording a stage
+    costs two clock reads and two getrusage calls, so a recorder can be kept
+    around for a whole job at no measurable cost.
+
+    The peak RSS is that of the whole process: peak_rss_mb_so_far is its
+    value when the stage last ended and peak_rss_growth_mb how much the
+    timed blocks of the stage raised it (0 for stages only recorded by add).
+
+    Examples
+    --------
+    >>> perf = PerfRecorder()
+    >>> with perf.stage('parse') as stage:
+    ...     stage['files'] += 1
+    >>> perf.add('unzip', files=2, bytes=1024, wall_seconds=0.5)
+    >>> list(perf.stages)
+    ['parse', 'unzip']
+    >>> perf.stages['unzip']['bytes']
+    1024
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def _get_stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = dict.fromkeys(STAGE_KEYS, 0)
+            stage['peak_rss_mb_so_far'] = 0.0
+            stage['peak_rss_growth_mb'] = 0.0
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage name, yielding the stage dict to update its counters"""
+        stage = self._get_stage(name)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        rss_start = get_peak_rss_mb()
+        try:
+            yield stage
+        finally:
+            stage['wall_seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.process_time() - cpu_start
+            stage['peak_rss_mb_so_far'] = get_peak_rss_mb()
+            stage['peak_rss_growth_mb'] += stage['peak_rss_mb_so_far'] - rss_start
+
+    def add(self, name, **values):
+        """Add values (e.g. measured by worker threads) to the counters of stage name"""
+        stage = self._get_stage(name)
+        for key, value in values.items():
+            stage[key] = stage.get(key, 0) + value
+        stage['peak_rss_mb_so_far'] = get_peak_rss_mb()
+
+    def to_dict(self):
+        return {'stages': self.stages, 'peak_rss_mb': get_peak_rss_mb()}
+
+    def log(self):
+        """Log the recorded stages as a single JSON block"""
+        log.info('Performance report: %s', json.dumps(self.to_dict(), sort_keys=True))
+
+    def write(self, file_path):
+        with open(file_path, 'w') as perf_file:
+            json.dump(self.to_dict(), perf_file, sort_keys=True, indent=4)
+
+
+class SamplingProfiler:
+    """Sample the stacks of all the threads of the process at a fixed interval
+
+    Samples are aggregated as collapsed stacks (one 'frame;frame;... count'
+    line per distinct stack, rooted at the thread name), the input format of
+    flamegraph.pl and speedscope.
+
+    Args:
+        interval (float): Seconds between two samples
+    """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def _run(self):
+        thread_names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == self._thread.ident:
+                    continue
+                if ident not in thread_names:
+                    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(thread_names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, file_path):
+        with open(file_path, 'w') as collapsed_file:
+            for stack, count in self.stacks.most_common():
+                collapsed_file.write('%s %s\n' % (stack, count))
+
+
+def get_profiler_settings(config):
+    """Return the (profiler, tracemalloc_top) settings of a job
+
+    The GEAR_PROFILER and GEAR_TRACEMALLOC_TOP environment variables take
+    precedence over the profiler and profiler_tracemalloc_top gear config options.
+
+    Args:
+        config (dict): The gear config options
+
+    Returns:
+        tuple: The profiler ('cprofile', 'sampling' or None) and the number of
+            top allocation sites to report (0 to disable tracemalloc)
+    """
+    profiler = os.environ.get(PROFILER_ENV) or config.get('profiler')
+    if profiler not in PROFILERS:
+        profiler = None
+    tracemalloc_top = int(os.environ.get(TRACEMALLOC_TOP_ENV) or config.get('profiler_tracemalloc_top') or 0)
+    return profiler, tracemalloc_top
+
+
+@contextmanager
+def profile(output_folder, profiler=None, tracemalloc_top=0):
+    """Run the enclosed block under a profiler and write its artifacts to output_folder
+
+    With profiler 'cprofile', the deterministic profile is written to
+    profile.pstats (see pstats.Stats). With profiler 'sampling', the stacks
+    sampled by SamplingProfiler are written to profile.collapsed. If
+    tracemalloc_top is greater than 0, the top allocation sites by line are
+    written to tracemalloc_top.txt. Nothing is set up when both are off.
+
+    Args:
+        output_folder (str): Folder the profile artifacts are written to
+        profiler (str): 'cprofile', 'sampling' or None
+        tracemalloc_top (int): Number of allocation sites to report
+    """
+    if profiler is None and not tracemalloc_top:
+        yield
+        return
+    if tracemalloc_top:
+        tracemalloc.start()
+    if profiler == 'cprofile':
+        active_profiler = cProfile.Profile()
+        active_profiler.enable()
+    elif profiler == 'sampling':
+        active_profiler = SamplingProfiler()
+        active_profiler.start()
+    try:
+        yield
+    finally:
+        if profiler == 'cprofile':
+            active_profiler.disable()
+            active_profiler.dump_stats(os.path.join(output_folder, PSTATS_FILENAME))
+        elif profiler == 'sampling':
+            active_profiler.stop()
+            active_profiler.write(os.path.join(output_folder, COLLAPSED_FILENAME))
+        if tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            with open(os.path.join(output_folder, TRACEMALLOC_FILENAME), 'w') as tracemalloc_file:
+                for statistic in snapshot.statistics('lineno')[:tracemalloc_top]:
+                    tracemalloc_file.write('%s\n' % statistic)
+        log.info('Wrote %s profile artifacts to %s', profiler or 'tracemalloc', output_folder)
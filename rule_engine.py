@@ -0,0 +1,301 @@
+"""Label rules loaded from a versioned rules file
+
+The rules file (label_rules.json by default, or the file named by the
+LABEL_RULES_FILE environment variable) holds:
+
+    {
+        "version": "1.0",
+        "patterns": {
+            "chest": ["chest", "lung", {"regex": "^(?=.*thorax)", "flags": "im"}],
+            "multiple_lung": {"word": "lung", "min_count": 2},
+            ...
+        },
+        "tables": {
+            "anatomy": {
+                "mode": "all",
+                "rules": [
+                    {"when": ["chest"], "unless": ["lung_window"], "output": ["Chest"]},
+                    ...
+                ]
+            },
+            ...
+        },
+        "lookups": {
+            "ophtha_protocol": {
+                "match": "prefix",
+                "entries": {"FA-4W Sweep": {"modality": "FP", ...}, ...}
+            },
+            ...
+        }
+    }
+
+A pattern is either a list of regexes matching a label if any of them is
+found in it (strings ignore case; objects give the regex flags as "i" and
+"m" letters), or a word found at least min_count times in the label, words
+being separated by anything but ASCII letters and digits.
+
+A rule of a table matches a label if all of its "when" patterns and none of
+its "unless" patterns match it. Tables in "first" mode return the first
+matching rule, tables in "all" mode every matching rule, in order.
+
+A lookup maps header values (e.g. a ProtocolName) to outputs in a dict, keys
+being normalized to their lower case words (see normalize_key). Lookups in
+"prefix" mode fall back to the longest key made of the first words of the
+value, e.g. "FA-4W Sweep OD" to "FA-4W Sweep".
+
+Each pattern is compiled into a single regex and is searched at most once
+per label, however many rules and tables refer to it. The version of the
+rules is part of the classification digest (see run.compute_classification_digest),
+so that changing the rules reclassifies the files.
+"""
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+import safe_regex
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'label_rules.json')
+# Environment variable naming a rules file to use instead of DEFAULT_RULES_FILE
+RULES_FILE_ENV = 'LABEL_RULES_FILE'
+MODES = ('first', 'all')
+LOOKUP_MODES = ('exact', 'prefix')
+FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE}
+# Labels whose pattern matches are kept, for the tables evaluated on the same label
+MATCHER_CACHE_SIZE = 256
+# Lookup values whose output is kept, e.g. the few protocol names of an archive
+LOOKUP_CACHE_SIZE = 1024
+
+Rule = namedtuple('Rule', ['name', 'when', 'unless', 'output'])
+Table = namedtuple('Table', ['name', 'mode', 'rules'])
+WORD = re.compile('[a-z0-9]+')
+
+
+def combine_regexes(regexes):
+    """Return a single regex that matches a label if any of regexes does
+
+    Examples
+    --------
+    >>> combine_regexes([re.compile('t1', re.IGNORECASE), re.compile('^REST$'),
+    ...                  re.compile('^(?=.*mm)(?=.*iso)', re.IGNORECASE | re.MULTILINE)]).pattern
+    '(?i:t1)|(?:^REST$)|(?im:^(?=.*mm)(?=.*iso))'
+    """
+    return re.compile('|'.join('(?%s:%s)' % (''.join(flag for flag, value in FLAGS.items() if regex.flags & value),
+                                             regex.pattern)
+                               for regex in regexes))
+
+
+class Pattern:
+    """A named pattern of the rules file
+
+    Attributes:
+        name (str): Pattern name
+        regexes (list): Compiled regexes, as written in the rules file
+        regex (re.Pattern): Single regex searched in the labels
+        min_count (int): For a word pattern, the occurrences of the word
+            (regex) needed in the lower case label, None otherwise
+    """
+
+    def __init__(self, name, spec):
+        self.name = name
+        if isinstance(spec, dict):
+            if set(spec) != {'word', 'min_count'}:
+                raise ValueError('Pattern %s: expected a list of regexes or a word and min_count' % name)
+            self.min_count = spec['min_count']
+            self.regexes = [re.compile(r'(?<![a-zA-Z0-9])%s(?![a-zA-Z0-9])' % re.escape(spec['word'].lower()))]
+            self.regex = self.regexes[0]
+        else:
+            self.min_count = None
+            self.regexes = [_compile(name, item) for item in spec]
+            self.regex = combine_regexes(self.regexes)
+
+    def search(self, label, max_length=0):
+        """Return True if the pattern matches label, searched on its first max_length characters"""
+        return self._search(label, _truncate(label, max_length))
+
+    def _search(self, label, truncated):
+        if self.min_count is not None:
+            return len(self.regex.findall(label.lower())) >= self.min_count
+        return self.regex.search(truncated) is not None
+
+
+def _truncate(label, max_length):
+    return label[:max_length] if max_length and len(label) > max_length else label
+
+
+def _compile(name, item):
+    if isinstance(item, str):
+        return re.compile(item, re.IGNORECASE)
+    try:
+        flags = 0
+        for flag in item.get('flags', 'i'):
+            flags |= FLAGS[flag]
+        return re.compile(item['regex'], flags)
+    except (AttributeError, KeyError) as exc:
+        raise ValueError('Pattern %s: invalid regex %r' % (name, item)) from exc
+
+
+class LabelMatcher:
+    """Pattern matches of a single label, each pattern being searched once"""
+
+    def __init__(self, rules, label, max_length):
+        self.patterns = rules.patterns
+        self.tables = rules.tables
+        self.label = label
+        self.truncated = _truncate(label, max_length)
+        self.matches = {}
+        self.evaluated = {}
+
+    def match(self, pattern):
+        """Return True if the named pattern matches the label"""
+        try:
+            return self.matches[pattern]
+        except KeyError:
+            found = self.matches[pattern] = self.patterns[pattern]._search(self.label, self.truncated)
+            return found
+
+    def matches_rule(self, rule):
+        for name in rule.when:
+            if not self.match(name):
+                return False
+        for name in rule.unless:
+            if self.match(name):
+                return False
+        return True
+
+    def evaluate(self, table):
+        """Return the rules of the named table matching the label, a single one at most in first mode"""
+        try:
+            return self.evaluated[table]
+        except KeyError:
+            pass
+        matched = []
+        mode = self.tables[table].mode
+        for rule in self.tables[table].rules:
+            if self.matches_rule(rule):
+                matched.append(rule)
+                if mode == 'first':
+                    break
+        self.evaluated[table] = matched
+        return matched
+
+
+def normalize_key(value):
+    """Return the lower case words of a lookup key, separated by single spaces
+
+    Examples
+    --------
+    >>> normalize_key(' FA: UltraWidefield')
+    'fa ultrawidefield'
+    """
+    return ' '.join(WORD.findall(str(value).lower()))
+
+
+class Lookup:
+    """A named lookup of the rules file, from normalized keys to outputs"""
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.match = spec.get('match', 'exact')
+        if self.match not in LOOKUP_MODES:
+            raise ValueError('Lookup %s: match must be one of %s' % (name, ', '.join(LOOKUP_MODES)))
+        self.entries = {}
+        for key, output in spec.get('entries', {}).items():
+            normalized = normalize_key(key)
+            if not normalized or normalized in self.entries:
+                raise ValueError('Lookup %s: key %r is empty or duplicated once normalized' % (name, key))
+            self.entries[normalized] = output
+        self.get = lru_cache(maxsize=LOOKUP_CACHE_SIZE)(self._get)
+
+    def _get(self, value):
+        """Return the output of value, None if it has none
+
+        Examples
+        --------
+        >>> lookup = Lookup('protocol', {'match': 'prefix', 'entries': {'FA': 'fa', 'FA-4W Sweep': 'sweep'}})
+        >>> lookup._get('fa-4w sweep OD'), lookup._get('FA'), lookup._get('FAF')
+        ('sweep', 'fa', None)
+        """
+        if value is None:
+            return None
+        words = normalize_key(value)
+        output = self.entries.get(words)
+        if output is None and self.match == 'prefix':
+            while ' ' in words:
+                words = words.rsplit(' ', 1)[0]
+                output = self.entries.get(words)
+                if output is not None:
+                    break
+        return output
+
+
+class RuleSet:
+    """Compiled label rules
+
+    Attributes:
+        version (str): Version of the rules
+        patterns (dict): Pattern by name
+        tables (dict): Table by name
+        lookups (dict): Lookup by name
+    """
+
+    def __init__(self, version, patterns, tables, lookups=None):
+        self.version = version
+        self.patterns = patterns
+        self.tables = tables
+        self.lookups = lookups or {}
+        self.matcher = lru_cache(maxsize=MATCHER_CACHE_SIZE)(self._matcher)
+
+    def _matcher(self, label, max_length=0):
+        return LabelMatcher(self, label, max_length)
+
+    def evaluate(self, table, label, max_length=0):
+        """Return the rules of the named table matching label (see LabelMatcher.evaluate)"""
+        return self.matcher(label, max_length).evaluate(table)
+
+    def outputs(self, table, label, max_length=0):
+        """Return the outputs of the rules of the named table matching label"""
+        return [rule.output for rule in self.evaluate(table, label, max_length)]
+
+
+def parse_rules(rules):
+    """Return the RuleSet of the content of a rules file
+
+    Raises:
+        ValueError: If the rules are malformed or refer to an unknown pattern
+    """
+    if not isinstance(rules, dict) or not rules.get('version'):
+        raise ValueError('Rules must be an object with a version')
+    patterns = {name: Pattern(name, spec) for name, spec in rules.get('patterns', {}).items()}
+    tables = {}
+    for table_name, table in rules.get('tables', {}).items():
+        if table.get('mode') not in MODES:
+            raise ValueError('Table %s: mode must be one of %s' % (table_name, ', '.join(MODES)))
+        table_rules = []
+        for spec in table.get('rules', []):
+            when, unless = tuple(spec.get('when', ())), tuple(spec.get('unless', ()))
+            unknown = [name for name in when + unless if name not in patterns]
+            if not when or unknown or 'output' not in spec:
+                raise ValueError('Table %s: rule %r needs an output and known "when" patterns' % (table_name, spec))
+            table_rules.append(Rule(spec.get('name', '+'.join(when)), when, unless, spec['output']))
+        tables[table_name] = Table(table_name, table['mode'], table_rules)
+    lookups = {name: Lookup(name, spec) for name, spec in rules.get('lookups', {}).items()}
+    safe_regex.lint_rules({name: pattern.regexes for name, pattern in patterns.items()})
+    return RuleSet(str(rules['version']), patterns, tables, lookups)
+
+
+def load_rules(path=None):
+    """Return the RuleSet of a rules file, by default that of RULES_FILE_ENV or DEFAULT_RULES_FILE"""
+    path = path or os.environ.get(RULES_FILE_ENV) or DEFAULT_RULES_FILE
+    with open(path) as rules_file:
+        rule_set = parse_rules(json.load(rules_file))
+    log.debug('Loaded label rules %s from %s', rule_set.version, path)
+    return rule_set
+
+
+RULES = load_rules()
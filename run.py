@@ -1,22 +1,82 @@
 #!/usr/bin/env python3
 
+import argparse
+import copy
+import hashlib
 import os
 import json
 import sys
 import logging
-import flywheel
 import pprint
+from collections import Counter
+import classification
 import dicom_processor
-import CT_classifier
-import MR_classifier
-import PT_classifier
-import OPHTHA_classifier
+import common_utils
+import gear_context
+import perf_utils
+import rule_engine
 
 
 logging.basicConfig()
 log = logging.getLogger()
 log.setLevel(logging.INFO)
 
+# Set paths
+INPUT_FOLDER = '/flywheel/v0/input/file/'
+OUTPUT_FOLDER = '/flywheel/v0/output/'
+CONFIG_FILE_PATH = '/flywheel/v0/config.json'
+MANIFEST_FILE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'manifest.json')
+
+# Key of the digest of the classification inputs in the file info
+DIGEST_KEY = 'ClassificationDigest'
+# Config options that do not change the classification, left out of the digest
+NON_CLASSIFYING_CONFIG = ('force_reclassify', 'perf_report', 'profiler', 'profiler_tracemalloc_top')
+# info keys written for the modalities whose output does not include the whole info
+OUTPUT_INFO_KEYS = ('SeriesClassifications', DIGEST_KEY)
+
+# Header keywords the slices are grouped by for each series_grouping config value
+SERIES_GROUP_BY = {
+    'series': ('SeriesInstanceUID',),
+    'series_and_acquisition': ('SeriesInstanceUID', 'AcquisitionNumber'),
+}
+
+
+def get_gear_version(manifest_file_path=MANIFEST_FILE_PATH):
+    try:
+        with open(manifest_file_path) as manifest_file:
+            return json.load(manifest_file).get('version')
+    except (IOError, ValueError):
+        log.warning('Unable to read the gear version from %s', manifest_file_path)
+        return None
+
+
+def compute_classification_digest(header_dicom, modality, acquisition_label, config, gear_version):
+    """Return a stable digest of the inputs of the classification of a file
+
+    The digest covers the dicom header from metadata import, the modality, the
+    acquisition label, the gear version (classifiers), the version of the
+    label rules and the config options and custom classifications that change
+    the classification. A file
+    whose stored digest matches does not need to be classified again.
+
+    Args:
+        header_dicom (dict): The info.header.dicom of the file
+        modality (str): The modality of the file
+        acquisition_label (str): The label of the parent acquisition
+        config (dict): The gear config.json
+        gear_version (str): The gear version
+
+    Returns:
+        str: The hex SHA-256 digest
+    """
+    options = {key: value for key, value in config.get('config', {}).items() if key not in NON_CLASSIFYING_CONFIG}
+    classifications = config.get('inputs', {}).get('classifications', {}).get('value')
+    payload = [header_dicom, modality, acquisition_label, options, classifications, gear_version,
+               rule_engine.RULES.version]
+    # default=str covers the few header values json cannot encode (e.g. bytes)
+    serialized = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
 
 def update_metadata(dcm_metadata, dicom_name, modality):
     
@@ -40,51 +100,155 @@ def update_metadata(dcm_metadata, dicom_name, modality):
              "modality": dcm_metadata['modality'],
              "name": dicom_name}
         ]
+    output_info = {key: dcm_metadata['info'][key] for key in OUTPUT_INFO_KEYS if key in dcm_metadata.get('info', {})}
+    # Modalities without a classifier (e.g. MG, US) have no file update
+    if output_info and modality not in ('CT', 'PT') and 'files' in output_metadata['acquisition']:
+        output_metadata['acquisition']['files'][0]['info'] = output_info
     return output_metadata
 
 
-if __name__ == '__main__':
-    # Set paths
-    input_folder = '/flywheel/v0/input/file/'
-    output_folder = '/flywheel/v0/output/'
-    config_file_path = '/flywheel/v0/config.json'
+def diff_metadata(output_metadata, previous_metadata):
+    """Return the part of output_metadata that differs from the file metadata before classification
+
+    classification and modality are compared as a whole. info is compared key
+    by key, since info updates are merged into the existing file info.
+
+    Args:
+        output_metadata (dict): The update_metadata output
+        previous_metadata (dict): The file metadata the gear was run with
+
+    Returns:
+        tuple: The output_metadata of the changed keys ({} when nothing
+            changed) and a Counter of the 'changed' and 'unchanged' keys
+    """
+    counts = Counter()
+    files = output_metadata.get('acquisition', {}).get('files')
+    if not files:
+        return output_metadata, counts
+    # Round trip through json so that tuples and lists compare equal, as they will be stored
+    file_metadata = json.loads(json.dumps(files[0]))
+    file_diff = {}
+    for key, value in file_metadata.items():
+        if key == 'name':
+            continue
+        if key == 'info':
+            previous_info = previous_metadata.get('info', {})
+            info_diff = {info_key: info_value for info_key, info_value in value.items()
+                         if info_key not in previous_info or previous_info[info_key] != info_value}
+            counts['changed'] += len(info_diff)
+            counts['unchanged'] += len(value) - len(info_diff)
+            if info_diff:
+                file_diff['info'] = info_diff
+        elif key not in previous_metadata or previous_metadata[key] != value:
+            file_diff[key] = value
+            counts['changed'] += 1
+        else:
+            counts['unchanged'] += 1
+    if not file_diff:
+        return {}, counts
+    file_diff['name'] = file_metadata['name']
+    return {'acquisition': {'files': [file_diff]}}, counts
+
+
+def main(config_file_path=CONFIG_FILE_PATH, output_folder=OUTPUT_FOLDER, fake_context_path=None):
+    """Classify the input file of the gear config and write .metadata.json
+
+    Args:
+        config_file_path (str): Path of the gear config.json
+        output_folder (str): Folder the gear outputs are written to
+        fake_context_path (str): Path of a gear_context.FakeGearContext fixture
+            to run offline, see gear_context.get_gear_context
+    """
+    perf = perf_utils.PerfRecorder()
     metadata_output_filepath = os.path.join(output_folder, '.metadata.json')
+    perf_output_filepath = os.path.join(output_folder, '.perf.json')
 
     # Load config file
-    with open(config_file_path) as config_data:
-        config = json.load(config_data)
-    # Set dicom path and name from config file
-    dicom_filepath = config['inputs']['dicom']['location']['path']
-    dicom_name = config['inputs']['dicom']['location']['name']
-    # Get the current dicom metadata
-    dicom_metadata = config['inputs']['dicom']['object']
-    # Get the modality
-    modality = config['inputs']['dicom']['object']['modality']
-    # Get Acquisition
-    with flywheel.GearContext() as gear_context:
-        acquisition = gear_context.client.get(gear_context.destination['id'])
-    df, dcm = dicom_processor.process_dicom(dicom_filepath)
-
-    # Check that metadata import ran
+    with perf.stage('config_load'):
+        with open(config_file_path) as config_data:
+            config = json.load(config_data)
+    perf_report = config.get('config', {}).get('perf_report', 'none')
+    # The report is also written when the job exits early (e.g. on an unreadable archive)
     try:
-        dicom_header = dicom_metadata['info']['header']['dicom']
-    except KeyError:
-        print('ERROR: No dicom header information found! Please run metadata import and validation.')
-        sys.exit(1)
-
-    if modality == "MR":
-        dicom_metadata = MR_classifier.classify_MR(df, dcm, dicom_metadata, acquisition)
-    elif modality == 'CT':
-        dicom_metadata = CT_classifier.classify_CT(df, dicom_metadata, acquisition)
-    elif modality == 'PT':
-        dicom_metadata = PT_classifier.classify_PT(df, dicom_metadata, acquisition)
-    elif modality == 'OPT' or modality == 'OP' or modality == 'OT':
-        dicom_metadata = OPHTHA_classifier.classify_OPHTHA(dicom_metadata, acquisition)
+        common_utils.MAX_LABEL_LENGTH = config.get('config', {}).get('max_label_length', common_utils.MAX_LABEL_LENGTH)
+        # Set dicom path and name from config file
+        dicom_filepath = config['inputs']['dicom']['location']['path']
+        dicom_name = config['inputs']['dicom']['location']['name']
+        # Get the current dicom metadata
+        dicom_metadata = config['inputs']['dicom']['object']
+        # Kept apart since the classifiers update dicom_metadata in place
+        previous_metadata = copy.deepcopy(dicom_metadata)
+        # Get the modality
+        modality = config['inputs']['dicom']['object']['modality']
+        # Get Acquisition
+        with perf.stage('acquisition_fetch'):
+            with gear_context.get_gear_context(fake_context_path) as context:
+                acquisition = context.client.get(context.destination['id'])
+
+        # Check that metadata import ran
+        try:
+            dicom_header = dicom_metadata['info']['header']['dicom']
+        except KeyError:
+            print('ERROR: No dicom header information found! Please run metadata import and validation.')
+            sys.exit(1)
+
+        digest = compute_classification_digest(dicom_header, modality, acquisition.get('label'), config,
+                                               get_gear_version())
+        unchanged = (not config.get('config', {}).get('force_reclassify', False) and 'classification' in dicom_metadata
+                     and dicom_metadata['info'].get(DIGEST_KEY) == digest)
+        if unchanged:
+            log.info('Classification inputs are unchanged since the last run (digest %s). Skipping.', digest)
+        else:
+            process_kwargs = {
+                'sample_size': config.get('config', {}).get('slice_sample_size'),
+                'representative': config.get('config', {}).get('representative_strategy', 'first'),
+                'perf': perf,
+            }
+            series_grouping = config.get('config', {}).get('series_grouping', 'none')
+            try:
+                if series_grouping in SERIES_GROUP_BY:
+                    groups = dicom_processor.process_dicom_groups(
+                        dicom_filepath, group_by=SERIES_GROUP_BY[series_grouping], **process_kwargs)
+                else:
+                    df, dcm = dicom_processor.process_dicom(dicom_filepath, **process_kwargs)
+            except dicom_processor.DicomProcessingError as exc:
+                log.warning('%s. Logging to error.json and Exiting.', exc)
+                sys.exit(1)
 
-    output_metadata = update_metadata(dicom_metadata, dicom_name, modality)
-    meta_log_string = pprint.pformat(output_metadata)
-    log.info(meta_log_string)
-    with open(metadata_output_filepath, 'w') as metafile:
-        json.dump(output_metadata, metafile, separators=(', ', ': '), sort_keys=True, indent=4)
+            with perf.stage('classifier'):
+                if series_grouping in SERIES_GROUP_BY:
+                    dicom_metadata = classification.classify_series_groups(groups, dicom_metadata, acquisition,
+                                                                           modality, config_file_path=config_file_path)
+                else:
+                    dicom_metadata = classification.classify(df, dcm, dicom_metadata, acquisition, modality,
+                                                             config_file_path=config_file_path)
+            dicom_metadata.setdefault('info', {})[DIGEST_KEY] = digest
 
+        with perf.stage('metadata_write'):
+            output_metadata = update_metadata(dicom_metadata, dicom_name, modality)
+            output_metadata, diff_counts = diff_metadata(output_metadata, previous_metadata)
+            log.info('Metadata update: %s changed keys, %s unchanged keys', diff_counts['changed'],
+                     diff_counts['unchanged'])
+            perf.add('metadata_diff', changed=diff_counts['changed'], unchanged=diff_counts['unchanged'])
+            meta_log_string = pprint.pformat(output_metadata)
+            log.info(meta_log_string)
+            with open(metadata_output_filepath, 'w') as metafile:
+                json.dump(output_metadata, metafile, separators=(', ', ': '), sort_keys=True, indent=4)
+    finally:
+        if perf_report in ('log', 'file'):
+            perf.log()
+        if perf_report == 'file':
+            perf.write(perf_output_filepath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify a DICOM file (defaults to the gear paths)')
+    parser.add_argument('--config', default=CONFIG_FILE_PATH, help='Gear config.json')
+    parser.add_argument('--output', default=OUTPUT_FOLDER, help='Output folder')
+    parser.add_argument('--fake-context', help='FakeGearContext JSON fixture, to run without a Flywheel instance')
+    args = parser.parse_args()
 
+    with open(args.config) as config_data:
+        profiler, tracemalloc_top = perf_utils.get_profiler_settings(json.load(config_data).get('config', {}))
+    with perf_utils.profile(args.output, profiler=profiler, tracemalloc_top=tracemalloc_top):
+        main(config_file_path=args.config, output_folder=args.output, fake_context_path=args.fake_context)
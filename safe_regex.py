@@ -0,0 +1,204 @@
+"""Guards against regexes taking super-linear time to search a label
+
+lint_regex reports the constructs that make a regex backtrack heavily on
+pathological labels. Rule sets are linted when they are loaded. User
+supplied regexes (custom classifications of the gear config) are also
+searched in a worker process killed past a timeout, since a search in
+the re module cannot be interrupted.
+"""
+import logging
+import multiprocessing
+import re
+import threading
+
+try:
+    from re import _parser as sre_parse  # Python >= 3.11
+except ImportError:
+    import sre_parse
+
+
+log = logging.getLogger(__name__)
+
+# Seconds a user regex may search a label before the worker is killed
+USER_REGEX_TIMEOUT = 1.0
+
+REPEATS = ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+WILDCARDS = ('ANY', 'IN', 'NOT_LITERAL')
+
+
+def _subpatterns(op, av):
+    """Yield the subpatterns of a parsed regex item"""
+    name = str(op)
+    if name in REPEATS:
+        yield av[2]
+    elif name == 'SUBPATTERN':
+        yield av[-1]
+    elif name == 'BRANCH':
+        yield from av[1]
+    elif name in ('ASSERT', 'ASSERT_NOT'):
+        yield av[1]
+    elif name == 'ATOMIC_GROUP':
+        yield av
+    elif name == 'GROUPREF_EXISTS':
+        yield av[1]
+        if av[2] is not None:
+            yield av[2]
+
+
+def _walk(subpattern):
+    """Yield every item of a parsed regex, depth first"""
+    for op, av in subpattern:
+        yield op, av
+        for child in _subpatterns(op, av):
+            yield from _walk(child)
+
+
+def _is_unbounded(op, av):
+    return str(op) in REPEATS and av[1] == sre_parse.MAXREPEAT
+
+
+def _is_wildcard(op, av):
+    """Return True for an unbounded repeat of a single character class, e.g. .* or [^_]+"""
+    return _is_unbounded(op, av) and len(av[2]) == 1 and str(av[2][0][0]) in WILDCARDS
+
+
+def _sequence(subpattern):
+    """Return the items of a parsed regex, with the groups of the sequence flattened"""
+    items = []
+    for op, av in subpattern:
+        if str(op) == 'SUBPATTERN':
+            items.extend(_sequence(av[-1]))
+        else:
+            items.append((op, av))
+    return items
+
+
+def lint_regex(regex):
+    """Return the reasons why searching regex can take super-linear time in the label length
+
+    Examples
+    --------
+    >>> lint_regex(re.compile('(?=.*plane)(?=.*loc)'))
+    ['unanchored lookahead starting with an unbounded wildcard']
+    >>> lint_regex(re.compile('^(?=.*plane)(?=.*loc)', re.MULTILINE))
+    []
+    >>> lint_regex(re.compile('(a+)+$'))
+    ['nested unbounded quantifiers']
+    >>> lint_regex(re.compile('SD.*OCT.*OP'))
+    ['several unbounded wildcards in sequence']
+    """
+    parsed = sre_parse.parse(regex.pattern, regex.flags)
+    reasons = []
+    items = list(_walk(parsed))
+    for op, av in items:
+        if _is_unbounded(op, av):
+            if any(_is_unbounded(*item) for item in _walk(av[2])):
+                reasons.append('nested unbounded quantifiers')
+            if any(str(item[0]) == 'BRANCH' for item in _walk(av[2])):
+                reasons.append('alternation under an unbounded quantifier')
+    if any(str(op) in ('GROUPREF', 'GROUPREF_EXISTS') for op, _ in items):
+        reasons.append('backreference')
+
+    sequence = _sequence(parsed)
+    anchored = bool(sequence) and str(sequence[0][0]) == 'AT' and str(sequence[0][1]).startswith('AT_BEGINNING')
+    if not anchored and sequence:
+        if _is_wildcard(*sequence[0]):
+            reasons.append('unanchored leading unbounded wildcard')
+        for op, av in sequence:
+            if str(op) != 'ASSERT' or av[0] != 1:
+                break
+            lookahead = _sequence(av[1])
+            if lookahead and _is_wildcard(*lookahead[0]):
+                reasons.append('unanchored lookahead starting with an unbounded wildcard')
+                break
+    if sum(1 for item in sequence if _is_wildcard(*item)) > 1:
+        reasons.append('several unbounded wildcards in sequence')
+    return list(dict.fromkeys(reasons))
+
+
+def lint_rules(rules):
+    """Log a warning for every regex of rules that can take super-linear time
+
+    Args:
+        rules (dict): Lists of compiled regexes by rule name
+
+    Returns:
+        dict: Reasons by (rule name, pattern), for the regexes with any
+    """
+    findings = {}
+    for name, regexes in rules.items():
+        for regex in regexes:
+            reasons = lint_regex(regex)
+            if reasons:
+                log.warning('Rule %s regex %r can be slow: %s', name, regex.pattern, ', '.join(reasons))
+                findings[name, regex.pattern] = reasons
+    return findings
+
+
+def _serve(connection):
+    """Search the (pattern, flags, label) received on connection, in a worker process"""
+    while True:
+        try:
+            pattern, flags, label = connection.recv()
+        except EOFError:
+            return
+        connection.send(re.search(pattern, label, flags) is not None)
+
+
+class RegexWorker:
+    """Worker process searching regexes, killed and restarted when a search times out"""
+
+    def __init__(self):
+        self.process = None
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def search(self, regex, label, timeout):
+        """Return True if regex matches label
+
+        Raises:
+            TimeoutError: If the search took more than timeout seconds
+        """
+        with self.lock:
+            if self.process is None or not self.process.is_alive():
+                self._start()
+            self.connection.send((regex.pattern, regex.flags, label))
+            if self.connection.poll(timeout):
+                return self.connection.recv()
+            self.process.kill()
+            self.process.join()
+            self.process = None
+            raise TimeoutError('Search of %r took more than %ss' % (regex.pattern, timeout))
+
+
+_worker = RegexWorker()
+# Whether the disabled timeout was already reported, see search_with_timeout
+_daemon_warned = False
+
+
+def search_with_timeout(regex, label, timeout=None):
+    """Return True if regex matches label, searching in a worker process killed past
+    timeout seconds (USER_REGEX_TIMEOUT by default)
+
+    Daemon processes (e.g. the workers of a multiprocessing.Pool) cannot
+    start one, so they search in-process, bounded by the label length only,
+    and a warning is logged once. Run batches of user regexes in non-daemon
+    processes instead, e.g. a concurrent.futures.ProcessPoolExecutor.
+
+    Raises:
+        TimeoutError: If the search took more than timeout seconds
+    """
+    global _daemon_warned
+    if multiprocessing.current_process().daemon:
+        if not _daemon_warned:
+            log.warning('Daemon process %s cannot start a regex worker: user regexes are searched without '
+                        'a time limit', multiprocessing.current_process().name)
+            _daemon_warned = True
+        return regex.search(label) is not None
+    return _worker.search(regex, label, USER_REGEX_TIMEOUT if timeout is None else timeout)
@@ -0,0 +1,51 @@
+"""DICOM file and zip archive factories shared by the tests"""
+import zipfile
+from io import BytesIO
+
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+
+def write_dicom(path, dataset):
+    """Write dataset as an explicit VR little endian DICOM file at path (or to a file object)"""
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = dataset.get('SOPClassUID', '1.2.840.10008.5.1.4.1.1.4')
+    file_meta.MediaStorageSOPInstanceUID = dataset.get('SOPInstanceUID', '1.2.3.4')
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_dataset = FileDataset(str(path), dataset, file_meta=file_meta, preamble=b'\0' * 128)
+    file_dataset.is_little_endian = True
+    file_dataset.is_implicit_VR = False
+    file_dataset.save_as(path if hasattr(path, 'write') else str(path), write_like_original=False)
+
+
+def slice_dataset(z, **attributes):
+    """Return the dataset of an axial CT slice at position z, with the extra attributes"""
+    dataset = Dataset()
+    dataset.Modality = 'CT'
+    dataset.SOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY', 'AXIAL']
+    dataset.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    dataset.ImagePositionPatient = [0, 0, z]
+    for keyword, value in attributes.items():
+        setattr(dataset, keyword, value)
+    return dataset
+
+
+def dicom_bytes(dataset, preamble=True):
+    """Return dataset encoded as DICOM, with preamble or as raw implicit VR data set"""
+    fp = BytesIO()
+    if preamble:
+        write_dicom(fp, dataset)
+    else:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = True
+        pydicom.dcmwrite(fp, dataset, write_like_original=True)
+    return fp.getvalue()
+
+
+def write_series_zip(zip_path, positions, **attributes):
+    """Write a zip of the slice_dataset of each position, with the extra attributes (e.g. SeriesDescription)"""
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for idx, z in enumerate(positions):
+            zf.writestr(f'{idx:04d}.dcm', dicom_bytes(slice_dataset(float(z), **attributes)))
@@ -0,0 +1,127 @@
+import json
+
+import batch_classify
+import MR_classifier
+from batch_classify import get_shard, merge, read_checkpoint, run_shards, CHECKPOINT_PATTERN
+from conftest import write_series_zip
+
+
+def _write_manifest(tmp_path, n_items):
+    items = []
+    for idx in range(n_items):
+        zip_path = tmp_path / f'series_{idx}.zip'
+        write_series_zip(zip_path, [2.0 * z for z in range(12)], SeriesDescription='HEAD WO')
+        items.append({'id': f'file-{idx}', 'path': str(zip_path), 'modality': 'CT', 'label': 'HEAD WO'})
+    items.append({'id': 'file-missing', 'path': str(tmp_path / 'missing.zip'), 'modality': 'CT', 'label': 'HEAD'})
+    manifest_path = tmp_path / 'manifest.jsonl'
+    manifest_path.write_text(''.join(json.dumps(item) + '\n' for item in items))
+    return str(manifest_path), items
+
+
+def test_classify_item_keeps_the_given_header(tmp_path, monkeypatch):
+    _, items = _write_manifest(tmp_path, 1)
+    item = dict(items[0], metadata={'info': {'header': {'dicom': {'SeriesDescription': 'HEAD WO'}}}})
+    get_pydicom_header = batch_classify.dicom_processor.get_pydicom_header
+
+    def get_record_header(dcm, counters=None, skip_tags=None, keywords=None):
+        assert keywords is not None, 'full header flattened'
+        return get_pydicom_header(dcm, counters=counters, skip_tags=skip_tags, keywords=keywords)
+    monkeypatch.setattr(batch_classify.dicom_processor, 'get_pydicom_header', get_record_header)
+
+    file_metadata = batch_classify.classify_item(item)
+
+    assert file_metadata['classification']['Anatomy'] == ['Head']
+    assert file_metadata['info']['header']['dicom'] == {'SeriesDescription': 'HEAD WO'}
+
+
+def test_run_shards_resume_and_merge(tmp_path):
+    manifest_path, items = _write_manifest(tmp_path, 5)
+    output_dir = str(tmp_path / 'output')
+
+    counts = run_shards(manifest_path, output_dir, n_shards=2, workers=2)
+    assert sum(shard_counts['done'] for shard_counts in counts) == 5
+    assert sum(shard_counts['failed'] for shard_counts in counts) == 1
+
+    # A restarted worker only retries the failed item
+    shard = get_shard('file-missing', 2)
+    counts = run_shards(manifest_path, output_dir, n_shards=2, shards=[shard])
+    assert counts[0]['failed'] == 1
+    assert counts[0]['done'] == 0
+    checkpoint = read_checkpoint(str(tmp_path / 'output' / (CHECKPOINT_PATTERN % (shard, 2))))
+    assert 'error' in checkpoint['file-missing']
+
+    merged = merge(manifest_path, output_dir)
+    assert [file_metadata['id'] for file_metadata in merged['files']] == [item['id'] for item in items[:5]]
+    assert merged['files'][0]['classification']['Anatomy'] == ['Head']
+    assert list(merged['errors']) == ['file-missing']
+    assert merged['missing'] == []
+
+
+class _FlakyClient:
+    """BulkClient stand-in failing to write the updates of the files of failing_ids"""
+
+    def __init__(self, failing_ids, labels=None):
+        self.failing_ids = failing_ids
+        self.labels = labels or {}
+        self.updated = []
+
+    def prefetch_labels(self, acquisition_ids):
+        pass
+
+    def get_label(self, acquisition_id):
+        return self.labels[acquisition_id]
+
+    def update_files(self, updates):
+        if any(acquisition_id in self.failing_ids for acquisition_id, _ in updates):
+            raise IOError('503 Service Unavailable')
+        self.updated.extend(acquisition_id for acquisition_id, _ in updates)
+        return len(updates)
+
+
+def test_run_shard_fetches_labels_missed_by_prefetch(tmp_path, monkeypatch):
+    manifest_path, items = _write_manifest(tmp_path, 2)
+    manifest = [dict(item, acquisition_id=f'acq-{idx}', label=None) for idx, item in enumerate(items[:2])]
+    (tmp_path / 'manifest.jsonl').write_text(''.join(json.dumps(item) + '\n' for item in manifest))
+    output_dir = str(tmp_path / 'output')
+    client = _FlakyClient(set(), labels={'acq-0': 'HEAD WO'})
+    monkeypatch.setattr(batch_classify.bulk_client, 'BulkClient', lambda *args, **kwargs: client)
+
+    counts = run_shards(manifest_path, output_dir, n_shards=1, api_url='https://flywheel.example.com/api')
+
+    # The label of acq-1 cannot be fetched
+    assert counts == [{'done': 1, 'failed': 1, 'skipped': 0}]
+    merged = merge(manifest_path, output_dir)
+    assert merged['files'][0]['classification']['Anatomy'] == ['Head']
+    assert list(merged['errors']) == ['file-1']
+
+
+def test_run_shard_records_failed_writes(tmp_path, monkeypatch):
+    manifest_path, items = _write_manifest(tmp_path, 3)
+    manifest = [dict(item, acquisition_id=f'acq-{idx}') for idx, item in enumerate(items[:3])]
+    (tmp_path / 'manifest.jsonl').write_text(''.join(json.dumps(item) + '\n' for item in manifest))
+    output_dir = str(tmp_path / 'output')
+    client = _FlakyClient({'acq-1'})
+    monkeypatch.setattr(batch_classify.bulk_client, 'BulkClient', lambda *args, **kwargs: client)
+    classify_item = batch_classify.classify_item
+
+    def classify_mr_label(item, config_file_path=None):
+        # One MR label rule hit per classified item
+        MR_classifier.infer_classification('T1 MPRAGE')
+        return classify_item(item, config_file_path)
+    monkeypatch.setattr(batch_classify, 'classify_item', classify_mr_label)
+
+    counts = run_shards(manifest_path, output_dir, n_shards=1, api_url='https://flywheel.example.com/api')
+
+    assert counts == [{'done': 2, 'failed': 1, 'skipped': 0}]
+    assert client.updated == ['acq-0', 'acq-2']
+    merged = merge(manifest_path, output_dir)
+    assert list(merged['errors']) == ['file-1']
+    assert sum(merged['rule_hits'].values()) == 2
+
+    # The next run only retries the failed write
+    client.failing_ids.clear()
+    counts = run_shards(manifest_path, output_dir, n_shards=1, api_url='https://flywheel.example.com/api')
+    assert counts == [{'done': 1, 'failed': 0, 'skipped': 2}]
+    assert client.updated == ['acq-0', 'acq-2', 'acq-1']
+    # The retried item is counted once
+    assert sum(merge(manifest_path, output_dir)['rule_hits'].values()) == 3
@@ -0,0 +1,109 @@
+import json
+import re
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+import pytest
+
+from bulk_client import BulkClient
+
+
+class FakeFlywheel:
+    """Minimal in-memory Flywheel API, failing the first failures requests with a 503"""
+
+    def __init__(self, labels, failures=0):
+        self.labels = labels
+        self.failures = failures
+        self.requests = Counter()
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            self.requests[method, re.sub(r'/acquisitions/[^/]+', '/acquisitions/{id}', path)] += 1
+            if self.failures:
+                self.failures -= 1
+                return 503, None
+        if method == 'GET' and path == '/api/acquisitions':
+            ids = re.match(r'_id=\|\[(.*)\]', query['filter'][0]).group(1).split(',')
+            return 200, [{'_id': id_, 'label': self.labels[id_]} for id_ in ids if id_ in self.labels]
+        match = re.match(r'/api/acquisitions/([^/]+)$', path)
+        if method == 'GET' and match and match.group(1) in self.labels:
+            return 200, {'_id': match.group(1), 'label': self.labels[match.group(1)]}
+        match = re.match(r'/api/acquisitions/([^/]+)/files/([^/]+)/(classification|info)$', path)
+        if method == 'POST' and match:
+            acquisition_id, name, kind = match.groups()
+            with self.lock:
+                file_metadata = self.files.setdefault((acquisition_id, unquote(name)), {})
+                file_metadata.setdefault(kind, {}).update(body['replace' if kind == 'classification' else 'set'])
+            return 200, {}
+        return 404, None
+
+
+@pytest.fixture
+def fake_flywheel():
+    fake = FakeFlywheel({'acq-%d' % idx: 'Label %d' % idx for idx in range(10)})
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            status, response = fake.handle(method, url.path, parse_qs(url.query), body)
+            data = json.dumps(response).encode() if response is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self._reply('GET')
+
+        def do_POST(self):
+            self._reply('POST')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.api_url = 'http://127.0.0.1:%s/api' % server.server_port
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+def test_prefetch_labels_paged_and_cached(fake_flywheel):
+    fake_flywheel.failures = 1
+    client = BulkClient(fake_flywheel.api_url, page_size=4, backoff=0.01)
+
+    labels = client.prefetch_labels(['acq-%d' % idx for idx in range(10)])
+    assert labels['acq-7'] == 'Label 7'
+    assert len(labels) == 10
+    # 3 pages and the retry of the failed call
+    assert fake_flywheel.requests['GET', '/api/acquisitions'] == 4
+
+    assert client.get_label('acq-3') == 'Label 3'
+    client.prefetch_labels(['acq-1', 'acq-2'])
+    assert fake_flywheel.requests['GET', '/api/acquisitions'] == 4
+
+    # Acquisitions missed by the prefetch are fetched on their own, once
+    fake_flywheel.labels['acq-10'] = 'Label 10'
+    assert client.get_label('acq-10') == client.get_label('acq-10') == 'Label 10'
+    assert fake_flywheel.requests['GET', '/api/acquisitions/{id}'] == 1
+
+
+def test_update_files_coalesced(fake_flywheel):
+    client = BulkClient(fake_flywheel.api_url, max_workers=4, backoff=0.01)
+    updates = [('acq-%d' % (idx % 5), {'name': 'scan %d.zip' % (idx % 5), 'classification': {'Intent': [str(idx)]},
+                                       'info': {'Key%d' % idx: idx}})
+               for idx in range(10)]
+    updates.append(('acq-9', {}))
+
+    assert client.update_files(updates) == 5
+    assert fake_flywheel.requests['POST', '/api/acquisitions/{id}/files/scan%200.zip/classification'] == 1
+    assert fake_flywheel.files['acq-0', 'scan 0.zip'] == {'classification': {'Intent': ['5']},
+                                                         'info': {'Key0': 0, 'Key5': 5}}
@@ -0,0 +1,42 @@
+import builtins
+import logging
+import os
+import subprocess
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+
+import classification
+from conftest import write_series_zip
+from dicom_processor import DicomProcessingError
+
+
+def test_classify_input_in_memory(monkeypatch):
+    zip_file = BytesIO()
+    write_series_zip(zip_file, [2.0 * idx for idx in range(20)], SeriesDescription='CHEST W CONTRAST')
+    with zipfile.ZipFile(zip_file) as zf:
+        dicom_data = zf.read('0000.dcm')
+    monkeypatch.setattr(builtins, 'open', lambda *args, **kwargs: pytest.fail('file opened'))
+
+    inputs = [zip_file.getvalue(), BytesIO(zip_file.getvalue()), dicom_data] * 4
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda data: classification.classify_input(data, 'CT', 'CHEST W CONTRAST'),
+                                    inputs))
+
+    assert results == [classification.classify_input(data, 'CT', 'CHEST W CONTRAST') for data in inputs[:3]] * 4
+    assert results[0]['classification']['Anatomy'] == results[1]['classification']['Anatomy'] == ['Chest']
+    assert results[2]['info']['header']['dicom']['SeriesDescription'] == 'CHEST W CONTRAST'
+    with pytest.raises(DicomProcessingError):
+        classification.classify_input(b'', 'CT', 'CHEST W CONTRAST')
+
+
+def test_import_has_no_side_effects():
+    code = ('import logging, sys; import classification; '
+            'print(logging.getLogger().level, logging.getLogger().handlers, "flywheel" in sys.modules)')
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+
+    assert output.split() == [str(logging.WARNING), '[]', 'False']
@@ -0,0 +1,388 @@
+import gc
+import gzip
+import tarfile
+import weakref
+import zipfile
+from collections import Counter
+from io import BytesIO
+
+import numpy as np
+import pydicom
+import pytest
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+import dicom_processor
+from common_utils import compute_scan_coverage, get_slice_count
+from conftest import dicom_bytes, slice_dataset, write_dicom, write_series_zip
+from dicom_processor import DicomProcessingError, format_string, get_seq_data, iter_zip_data_dicts, process_dicom, process_dicom_groups, \
+    sniff_dicom, FirstValidSelector, REPRESENTATIVE_SELECTORS, SliceTable, TRUNCATED_KEY
+from perf_utils import PerfRecorder
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('T1_MPRAGE_SAG', 'T1_MPRAGE_SAG'),
+    ('Müller^Jürgen', 'Mller^Jrgen'),
+    ('line1\nline2\ttab', 'line1\nline2\ttab'),
+    ('bell\x07null\x00', 'bellnull'),
+    ('?', None),
+    ('é?', None),
+    (12.5, '12.5'),
+    ('', ''),
+])
+def test_format_string(value, expected):
+    assert format_string(value) == expected
+
+
+def _nested_sequence(depth, n_items=1):
+    """Return a pydicom Sequence nested depth times through ReferencedSeriesSequence"""
+    sequence = Sequence([Dataset() for _ in range(n_items)])
+    for item in sequence:
+        item.SeriesInstanceUID = '1.2.3'
+    for _ in range(depth - 1):
+        item = Dataset()
+        item.SeriesInstanceUID = '1.2.3'
+        item.ReferencedSeriesSequence = sequence
+        sequence = Sequence([item])
+    return sequence
+
+
+def test_get_seq_data_matches_nested_structure():
+    res = get_seq_data(_nested_sequence(3, n_items=2), [])
+    assert res == [{'SeriesInstanceUID': '1.2.3', 'ReferencedSeriesSequence': [
+        {'SeriesInstanceUID': '1.2.3', 'ReferencedSeriesSequence': [
+            {'SeriesInstanceUID': '1.2.3'}, {'SeriesInstanceUID': '1.2.3'}]}]}]
+
+
+def test_get_seq_data_truncates_items():
+    counters = Counter()
+    res = get_seq_data(_nested_sequence(1, n_items=10), [], max_items=4, counters=counters)
+    assert len(res) == 5
+    assert res[-1] == {TRUNCATED_KEY: {'items': 6}}
+    assert counters['items'] == 6
+
+
+def test_get_seq_data_truncates_depth():
+    counters = Counter()
+    res = get_seq_data(_nested_sequence(2000), [], max_depth=3, counters=counters)
+    level_3 = res[0]['ReferencedSeriesSequence'][0]['ReferencedSeriesSequence']
+    assert level_3 == [{'SeriesInstanceUID': '1.2.3',
+                        'ReferencedSeriesSequence': [{TRUNCATED_KEY: {'depth': 4, 'items': 1}}]}]
+    assert counters['depth'] == 1
+
+
+def test_get_seq_data_truncates_values():
+    counters = Counter()
+    item = Dataset()
+    item.ImageComments = 'x' * 100
+    item.SeriesDescription = 'short'
+    res = get_seq_data(Sequence([item]), [], max_value_size=50, counters=counters)
+    assert res == [{'ImageComments': {TRUNCATED_KEY: {'size': 100}}, 'SeriesDescription': 'short'}]
+    assert counters['values'] == 1
+
+
+def test_process_dicom_enhanced_multiframe_one_row_per_frame(tmp_path):
+    dataset = Dataset()
+    dataset.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4.1'  # Enhanced MR Image Storage
+    dataset.Modality = 'MR'
+    dataset.ImageType = ['ORIGINAL', 'PRIMARY']
+    dataset.NumberOfFrames = 4
+    shared = Dataset()
+    orientation = Dataset()
+    orientation.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    shared.PlaneOrientationSequence = Sequence([orientation])
+    dataset.SharedFunctionalGroupsSequence = Sequence([shared])
+    frames = []
+    for z in range(4):
+        frame = Dataset()
+        position = Dataset()
+        position.ImagePositionPatient = [0.0, 0.0, z * 2.5]
+        frame.PlanePositionSequence = Sequence([position])
+        frames.append(frame)
+    dataset.PerFrameFunctionalGroupsSequence = Sequence(frames)
+    dcm_path = tmp_path / 'enhanced.dcm'
+    write_dicom(dcm_path, dataset)
+
+    df, dcm = process_dicom(str(dcm_path))
+
+    assert len(df) == 4
+    assert df['ImagePositionPatient'].tolist() == [[0.0, 0.0, z * 2.5] for z in range(4)]
+    assert df['ImageOrientationPatient'].tolist() == [[1.0, 0.0, 0.0, 0.0, 1.0, 0.0]] * 4
+    assert compute_scan_coverage(df)[0] == 7.5
+    assert dcm.Modality == 'MR'
+
+
+def test_sniff_dicom():
+    assert sniff_dicom(dicom_bytes(slice_dataset(0))[:132]) is None
+    assert sniff_dicom(dicom_bytes(slice_dataset(0), preamble=False)[:132]) is None
+    assert sniff_dicom(b'%PDF-1.4 ' + b'x' * 200) == 'no_dicom_magic'
+    assert sniff_dicom(b'') == 'no_dicom_magic'
+
+
+def test_process_dicom_skips_non_dicom_zip_members(tmp_path):
+    zip_path = tmp_path / 'series.dicom.zip'
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for z in range(3):
+            zf.writestr(f'series/{z}.dcm', dicom_bytes(slice_dataset(float(z))))
+        zf.writestr('series/raw.dcm', dicom_bytes(slice_dataset(3.0), preamble=False))
+        zf.writestr('series/DICOMDIR', dicom_bytes(Dataset()))
+        zf.writestr('__MACOSX/series/._0.dcm', b'\0\x05\x16\x07' + b'\0' * 200)
+        zf.writestr('series/report.pdf', b'%PDF-1.4 ' + b'x' * 200)
+        zf.writestr('series/notes.txt', b'scanner notes')
+
+    df, dcm = process_dicom(str(zip_path))
+
+    assert len(df) == 4
+    assert sorted(df['ImagePositionPatient'].apply(lambda x: x[2])) == [0.0, 1.0, 2.0, 3.0]
+
+
+def test_process_dicom_tar_streams_match_zip(tmp_path):
+    members = [(f'series/{idx:04d}.dcm', dicom_bytes(slice_dataset(float(z))))
+               for idx, z in enumerate([0, 1, 2, 3, 4])]
+    members.append(('series/notes.txt', b'scanner notes'))
+    zip_path = tmp_path / 'series.zip'
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for name, data in members:
+            zf.writestr(name, data)
+    tar_path = tmp_path / 'series.tar.gz'
+    with tarfile.open(tar_path, 'w:gz') as tf:
+        # Written in reverse order, the slices are still in path order
+        for name, data in reversed(members):
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tf.addfile(tar_info, BytesIO(data))
+    gzip_path = tmp_path / 'slice.dcm.gz'
+    gzip_path.write_bytes(gzip.compress(members[2][1]))
+
+    zip_df, zip_dcm = process_dicom(str(zip_path), representative='median')
+    tar_df, tar_dcm = process_dicom(str(tar_path), representative='median')
+    gzip_df, gzip_dcm = process_dicom(str(gzip_path))
+
+    assert tar_df.equals(zip_df)
+    assert tar_dcm.ImagePositionPatient == zip_dcm.ImagePositionPatient == [0, 0, 2]
+    assert gzip_df['path'].tolist() == ['slice.dcm'] and gzip_dcm.ImagePositionPatient == [0, 0, 2]
+
+
+@pytest.mark.parametrize('representative,expected', [('first', 0), ('median', 9), ('image_type', 0)])
+def test_process_dicom_tar_keeps_only_representative_datasets(tmp_path, monkeypatch, representative, expected):
+    tar_path = tmp_path / 'series.tar'
+    with tarfile.open(tar_path, 'w') as tf:
+        for idx in reversed(range(20)):
+            data = dicom_bytes(slice_dataset(float(idx)))
+            tar_info = tarfile.TarInfo(f'series/{idx:04d}.dcm')
+            tar_info.size = len(data)
+            tf.addfile(tar_info, BytesIO(data))
+    datasets = []
+    get_dcm_record = dicom_processor.get_dcm_record
+
+    def tracking_get_dcm_record(*args, **kwargs):
+        record = get_dcm_record(*args, **kwargs)
+        datasets.append(weakref.ref(record['dataset']))
+        return record
+    monkeypatch.setattr(dicom_processor, 'get_dcm_record', tracking_get_dcm_record)
+
+    alive = []
+    append = dicom_processor.SliceTable.append
+
+    def counting_append(table, record):
+        gc.collect()
+        alive.append(sum(dataset() is not None for dataset in datasets))
+        append(table, record)
+    monkeypatch.setattr(dicom_processor.SliceTable, 'append', counting_append)
+
+    df, dcm = process_dicom(str(tar_path), representative=representative)
+
+    assert df['path'].tolist() == [f'series/{idx:04d}.dcm' for idx in range(20)]
+    assert dcm.ImagePositionPatient == [0, 0, expected]
+    # The offered record and the current representative
+    assert max(alive) <= 2
+
+
+def test_iter_zip_data_dicts_keeps_member_order(tmp_path):
+    zip_path = tmp_path / 'series.zip'
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for z in range(40):
+            zf.writestr(f'{z:03d}.dcm', dicom_bytes(slice_dataset(float(z))))
+    stats = {}
+    with zipfile.ZipFile(zip_path) as zf:
+        members = zf.infolist()
+        res = list(iter_zip_data_dicts(zf, members, decompress_workers=3, parse_workers=2,
+                                       queue_size=4, stats=stats))
+    assert [el['path'] for el in res] == [member.filename for member in members]
+    assert [el['header']['ImagePositionPatient'][2] for el in res] == [float(z) for z in range(40)]
+    assert stats['decompress']['files'] == stats['parse']['files'] == 40
+    assert stats['decompress']['bytes'] == sum(member.file_size for member in members)
+
+
+def test_process_dicom_exits_on_corrupted_member(tmp_path):
+    zip_path = tmp_path / 'series.zip'
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for z in range(3):
+            zf.writestr(f'{z}.dcm', dicom_bytes(slice_dataset(float(z))) + b'\0' * 1000)
+    raw = bytearray(zip_path.read_bytes())
+    with zipfile.ZipFile(zip_path) as zf:
+        member = zf.getinfo('1.dcm')
+        data_start = member.header_offset + 30 + len(member.filename)
+    raw[data_start + member.compress_size - 8:data_start + member.compress_size] = b'\xff' * 8
+    zip_path.write_bytes(bytes(raw))
+
+    with pytest.raises(DicomProcessingError):
+        process_dicom(str(zip_path))
+
+
+def test_process_dicom_sampling_linear_series(tmp_path):
+    zip_path = tmp_path / 'series.zip'
+    write_series_zip(zip_path, [1.5 * z for z in range(60)])
+    with zipfile.ZipFile(zip_path, 'a') as zf:
+        zf.writestr('report.pdf', b'%PDF-1.4 ' + b'x' * 200)
+        zf.writestr('notes.txt', b'scanner notes')
+
+    df, _ = process_dicom(str(zip_path), sample_size=5)
+
+    assert len(df) == 7
+    assert df.attrs['sampling'] == {'slice_count': 60, 'sampled': 7, 'confidence': 'high'}
+    assert get_slice_count(df) == 60
+    assert compute_scan_coverage(df)[0] == 1.5 * 59
+
+
+def test_process_dicom_sampling_falls_back_to_full_scan(tmp_path):
+    zip_path = tmp_path / 'series.zip'
+    positions = [1.5 * z for z in range(60)]
+    positions[30], positions[0] = positions[0], positions[30]
+    write_series_zip(zip_path, positions)
+
+    df, _ = process_dicom(str(zip_path), sample_size=5)
+
+    assert len(df) == 60
+    assert 'sampling' not in df.attrs
+    assert compute_scan_coverage(df)[0] == 1.5 * 59
+
+
+def test_slice_table_to_dataframe():
+    table = SliceTable()
+    table.append({'path': 'a.dcm', 'size': 10, 'pydicom_exception': False, 'header': {
+        'SliceLocation': 1.5, 'ImageType': ['ORIGINAL', 'PRIMARY'],
+        'ImageOrientationPatient': [1.0, 0.0, 0.0, 0.0, 1.0, 0.0], 'ImagePositionPatient': [0.0, 0.0, 1.5]}})
+    table.append({'path': 'b.dcm', 'size': 0, 'pydicom_exception': False, 'header': {}})
+    table.append({'path': 'c.dcm', 'size': 10, 'pydicom_exception': False, 'header': {
+        'ImageType': ['ORIGINAL', 'PRIMARY'], 'ImagePositionPatient': [0.0, 0.0]},
+        'frames': {'ImagePositionPatient': np.array([[0.0, 0.0, 2.0], [0.0, 0.0, np.nan]]),
+                   'ImageOrientationPatient': np.array([[1.0, 0.0, 0.0, 0.0, 1.0, 0.0]] * 2)}})
+
+    df = table.to_dataframe()
+
+    assert df['path'].tolist() == ['a.dcm', 'b.dcm', 'c.dcm', 'c.dcm']
+    assert df['SliceLocation'][0] == 1.5
+    assert df['SliceLocation'][1:].isnull().all()
+    assert df['ImageType'].tolist() == [['ORIGINAL', 'PRIMARY'], None, ['ORIGINAL', 'PRIMARY'],
+                                        ['ORIGINAL', 'PRIMARY']]
+    assert df['ImagePositionPatient'].tolist() == [[0.0, 0.0, 1.5], None, [0.0, 0.0, 2.0], None]
+    assert df['ImageOrientationPatient'].tolist()[1] is None
+    assert table.counts == Counter({'files': 3, 'empty': 1, 'frames': 2})
+
+
+def _record(path, image_type=('ORIGINAL',), sop_class_uid='1.2.840.10008.5.1.4.1.1.2', size=10):
+    return {'path': path, 'size': size, 'pydicom_exception': False, 'has_header': size > 0,
+            'header': {'ImageType': list(image_type), 'SOPClassUID': sop_class_uid}}
+
+
+@pytest.mark.parametrize('representative,expected', [
+    ('first', 'b.dcm'),
+    ('median', 'c.dcm'),
+    ('image_type', 'd.dcm'),
+])
+def test_representative_selectors(representative, expected):
+    records = [
+        _record('a.dcm', size=0),
+        _record('b.dcm'),
+        _record('c.dcm'),
+        _record('d.dcm', sop_class_uid='Raw Data Storage'),
+        _record('d.dcm', image_type=('DERIVED',)),
+        _record('e.dcm', image_type=('DERIVED',)),
+        _record('f.dcm', image_type=('DERIVED',)),
+    ]
+    selector = REPRESENTATIVE_SELECTORS[representative](len(records))
+    for record in records:
+        selector.offer(record)
+    assert selector.select()['path'] == expected
+
+    # Same representative when the series size is unknown and the records are out of order
+    selector = REPRESENTATIVE_SELECTORS[representative]()
+    for record in records[5:] + records[:5]:
+        selector.offer(record)
+    assert selector.select()['path'] == expected
+
+
+def test_representative_selector_raw_data_storage_only_if_last():
+    selector = FirstValidSelector(2)
+    selector.offer(_record('a.dcm', size=0))
+    selector.offer(_record('b.dcm', sop_class_uid='Raw Data Storage'))
+    assert selector.select()['path'] == 'b.dcm'
+
+    selector = FirstValidSelector(2)
+    selector.offer(_record('a.dcm', sop_class_uid='Raw Data Storage'))
+    selector.offer(_record('b.dcm', size=0))
+    assert selector.select() is None
+
+
+def _fail_dcmread(dcmread, max_calls):
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        assert len(calls) <= max_calls, 'file read more than once'
+        return dcmread(*args, **kwargs)
+    return wrapper
+
+
+def test_process_dicom_representative_without_second_read(tmp_path, monkeypatch):
+    zip_path = tmp_path / 'series.zip'
+    write_series_zip(zip_path, range(5))
+    monkeypatch.setattr(pydicom, 'dcmread', _fail_dcmread(pydicom.dcmread, max_calls=5))
+
+    _, dcm = process_dicom(str(zip_path), representative='median')
+
+    assert dcm.ImagePositionPatient[2] == 2
+    assert 'PixelData' not in dcm
+
+
+def test_process_dicom_groups_one_pass(tmp_path, monkeypatch):
+    zip_path = tmp_path / 'series.zip'
+    series = [('1.2.3.1', 1, z) for z in range(2)] + [('1.2.3.2', 1, z) for z in range(4)] + \
+             [('1.2.3.2', 2, z) for z in range(3)]
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for idx, (uid, acquisition_number, z) in enumerate(series):
+            dataset = slice_dataset(float(z))
+            dataset.SeriesInstanceUID = uid
+            dataset.AcquisitionNumber = acquisition_number
+            zf.writestr(f'{idx:04d}.dcm', dicom_bytes(dataset))
+    dcmread = pydicom.dcmread
+    monkeypatch.setattr(pydicom, 'dcmread', _fail_dcmread(dcmread, max_calls=len(series)))
+    groups = process_dicom_groups(str(zip_path))
+    assert [(key, len(df)) for key, df, _ in groups] == [({'SeriesInstanceUID': '1.2.3.1'}, 2),
+                                                         ({'SeriesInstanceUID': '1.2.3.2'}, 7)]
+    assert groups[1][2].SeriesInstanceUID == '1.2.3.2'
+
+    monkeypatch.setattr(pydicom, 'dcmread', _fail_dcmread(dcmread, max_calls=len(series)))
+    groups = process_dicom_groups(str(zip_path), group_by=('SeriesInstanceUID', 'AcquisitionNumber'))
+    assert [len(df) for _, df, _ in groups] == [2, 4, 3]
+    assert groups[2][0] == {'SeriesInstanceUID': '1.2.3.2', 'AcquisitionNumber': 2}
+
+    # The median of each group is read again
+    monkeypatch.setattr(pydicom, 'dcmread', _fail_dcmread(dcmread, max_calls=len(series) + 3))
+    groups = process_dicom_groups(str(zip_path), group_by=('SeriesInstanceUID', 'AcquisitionNumber'),
+                                  representative='median')
+    assert [dcm.ImagePositionPatient[2] for _, _, dcm in groups] == [0, 1, 1]
+
+
+def test_process_dicom_records_perf_stages(tmp_path):
+    zip_path = tmp_path / 'series.zip'
+    write_series_zip(zip_path, range(5))
+    perf = PerfRecorder()
+
+    process_dicom(str(zip_path), perf=perf)
+
+    assert list(perf.stages) == ['unzip', 'parse', 'zip_pipeline', 'representative', 'walk_dicom']
+    assert perf.stages['unzip']['files'] == perf.stages['parse']['files'] == 5
+    assert perf.stages['parse']['bytes'] == sum(zip_info.file_size for zip_info in zipfile.ZipFile(zip_path).infolist())
+    assert all(stage['peak_rss_mb_so_far'] > 0 for stage in perf.stages.values())
@@ -0,0 +1,43 @@
+import pandas as pd
+
+import common_utils
+import MR_classifier
+from label_classifier import classify_labels, ERROR_COLUMN
+
+
+LABELS = [
+    'T1 MPRAGE SAG', 'AX T2 FLAIR', 'ep2d_bold_rest', 'DTI 64 dir', '3-plane loc', 'field_map', 'DWI_ADC',
+    'T2* GRE', 't2star', 'pd_tse', 'PD', 'coil survey', 'asl perfusion', 'mrs press', 'phase map', 'screen save',
+    'inplane T1', 'CAP W CONTRAST', 'HCAP', 'neck lower neck', 'NECK upper neck lower neck', 'lung lung window',
+    'head to pelvis', 'chest to chest', 'vertex to thighs', 'LE WB', 'unknown', 'ſwi', '',
+]
+
+
+def test_classify_labels_matches_scalar_path():
+    values = LABELS * 3 + [None]
+    labels = pd.Series(values, index=range(100, 100 + len(values)), dtype=object)
+
+    df = classify_labels(labels)
+
+    assert list(df.index) == list(labels.index)
+    for label, (_, row) in zip(values, df.iterrows()):
+        if label is None:
+            assert row.isna().all()
+            continue
+        classification = {key: row[key] for key in ('Intent', 'Measurement', 'Features', 'Custom')
+                          if isinstance(row[key], list)}
+        assert classification == MR_classifier.infer_classification(label), label
+        anatomy = common_utils.get_anatomy_from_label(label)
+        if isinstance(anatomy, list):
+            assert sorted(row['Anatomy']) == sorted(anatomy), label
+        else:
+            assert row['Anatomy'] == anatomy, label
+
+
+def test_classify_labels_reports_anatomy_errors_per_label():
+    df = classify_labels(pd.Series(['head to pelvis', 'chest to', 'pelvis to head', 'T1 MPRAGE SAG']))
+
+    assert df['Anatomy'].tolist()[0] == ['Head', 'Neck', 'Chest', 'Abdomen', 'Pelvis']
+    assert df['Anatomy'].isna().tolist() == [False, True, True, False]
+    assert df[ERROR_COLUMN].str.split(':').str[0].tolist()[:3] == [None, 'IndexError', 'ValueError']
+    assert df.loc[3, 'Features'] == MR_classifier.infer_classification('T1 MPRAGE SAG')['Features']
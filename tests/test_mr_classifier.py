@@ -1,10 +1,12 @@
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from pydicom.data import get_testdata_files
 import pydicom
 import pytest
 import flywheel
 
+import MR_classifier
 from MR_classifier import classify_MR, _find_matches, intent_check, \
     measurement_check, feature_check, iop_is_unique, infer_classification
 
@@ -113,3 +115,20 @@ def test_swi_classification(label):
     classification = infer_classification(label)
     assert classification['Intent'] == ['Structural']
     assert classification['Measurement'] == ['Susceptibility']
+
+
+def test_count_rule_hits_per_context():
+    labels = ['inplane T1 fieldmap', 'DWI_ADC', 'ep2d_bold_rest', 'T1 MPRAGE', 'unknown', 'screen save']
+
+    with MR_classifier.count_rule_hits() as hits:
+        with ThreadPoolExecutor(2) as executor:
+            # Labels classified in other threads are not counted in this context
+            list(executor.map(infer_classification, labels))
+        for label in labels:
+            infer_classification(label)
+
+    assert hits['anatomy_inplane'] == 1
+    assert hits['unknown'] == 1
+    assert sum(hits.values()) == len(labels)
+    infer_classification('T1 MPRAGE')
+    assert sum(hits.values()) == len(labels)
@@ -0,0 +1,42 @@
+import flywheel
+
+import OPHTHA_classifier
+
+
+def _metadata(**header):
+    return {'modality': 'OPHTHA', 'info': {'header': {'dicom': dict(Columns=512, **header)}}}
+
+
+def test_protocol_lookup_matches_normalized_prefix():
+    acquisition = flywheel.Acquisition(label='Fundus')
+
+    exact = OPHTHA_classifier.classify_OPHTHA(_metadata(ProtocolName='FA-4W Sweep'), acquisition)
+    prefix = OPHTHA_classifier.classify_OPHTHA(_metadata(ProtocolName='fa-4w sweep (2)'), acquisition)
+    unknown = OPHTHA_classifier.classify_OPHTHA(_metadata(ProtocolName='FAX'), acquisition)
+
+    assert exact['modality'] == prefix['modality'] == 'FP'
+    assert exact['classification'] == prefix['classification'] == {
+        'Type': ['Fluorescein Angiography'], 'Sub-Type': ['Wide Field']}
+    assert 'classification' not in unknown and unknown['modality'] == 'OPHTHA'
+
+
+def test_device_code_and_laterality_from_header():
+    metadata = _metadata(AcquisitionDeviceTypeCodeSequence=[{'CodeValue': 'A-00FBE'}], ImageLaterality='OS')
+
+    metadata = OPHTHA_classifier.classify_OPHTHA(metadata, flywheel.Acquisition(label='right eye'))
+
+    assert metadata['modality'] == 'OCT'
+    assert metadata['classification'] == {'Laterality': ['LEFT'], 'OCT Type': ['Standard']}
+
+
+def test_batch_matches_single_file_classification():
+    headers = [{'ProtocolName': 'UWF-C'}, {'ProtocolName': 'SD-OCT'}, {}, {'ImageLaterality': ['L', 'R']}] * 3
+    labels = ['OD', 'OS', 'SD OCT OP', 'OCT'] * 3
+
+    batch = OPHTHA_classifier.classify_OPHTHA_batch([_metadata(**header) for header in headers], labels)
+
+    assert batch == [OPHTHA_classifier.classify_OPHTHA(_metadata(**header), flywheel.Acquisition(label=label))
+                     for header, label in zip(headers, labels)]
+    # Files sharing their fields do not share their classification
+    batch[0]['classification']['Laterality'].append('LEFT')
+    assert batch[4]['classification']['Laterality'] == ['RIGHT']
@@ -0,0 +1,48 @@
+import pstats
+import time
+
+import pytest
+
+from perf_utils import get_profiler_settings, profile, COLLAPSED_FILENAME, PSTATS_FILENAME, PROFILER_ENV, \
+    TRACEMALLOC_FILENAME
+
+
+def _busy_loop(seconds):
+    end = time.perf_counter() + seconds
+    values = []
+    while time.perf_counter() < end:
+        values.append(str(len(values)))
+    return values
+
+
+def test_profile_off_writes_nothing(tmp_path):
+    with profile(str(tmp_path)):
+        _busy_loop(0.01)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profile_cprofile_with_tracemalloc(tmp_path):
+    with profile(str(tmp_path), profiler='cprofile', tracemalloc_top=5):
+        _busy_loop(0.01)
+
+    stats = pstats.Stats(str(tmp_path / PSTATS_FILENAME))
+    assert any(func_name == '_busy_loop' for _, _, func_name in stats.stats)
+    assert len((tmp_path / TRACEMALLOC_FILENAME).read_text().splitlines()) == 5
+
+
+def test_profile_sampling_writes_collapsed_stacks(tmp_path):
+    with pytest.raises(SystemExit):
+        with profile(str(tmp_path), profiler='sampling'):
+            _busy_loop(0.2)
+            raise SystemExit(1)
+
+    lines = (tmp_path / COLLAPSED_FILENAME).read_text().splitlines()
+    assert any('test_perf_utils.py:_busy_loop' in line for line in lines)
+    assert all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+
+
+def test_get_profiler_settings(monkeypatch):
+    assert get_profiler_settings({}) == (None, 0)
+    assert get_profiler_settings({'profiler': 'none', 'profiler_tracemalloc_top': 10}) == (None, 10)
+    monkeypatch.setenv(PROFILER_ENV, 'sampling')
+    assert get_profiler_settings({'profiler': 'cprofile'}) == ('sampling', 0)
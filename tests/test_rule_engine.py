@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+import rule_engine
+
+
+RULES = {
+    'version': 'test-1',
+    'patterns': {
+        'chest': ['chest', 'lung'],
+        'lung_window': ['lung.?window'],
+        'rest': [{'regex': '^REST$', 'flags': ''}],
+        'multiple_lung': {'word': 'lung', 'min_count': 2},
+    },
+    'tables': {
+        'anatomy': {'mode': 'all', 'rules': [
+            {'when': ['multiple_lung'], 'output': ['Chest']},
+            {'when': ['chest'], 'unless': ['lung_window'], 'output': ['Chest']},
+            {'when': ['lung_window'], 'output': ['Lung Window']},
+        ]},
+        'intent': {'mode': 'first', 'rules': [
+            {'name': 'functional', 'when': ['rest'], 'output': 'Functional'},
+            {'name': 'structural', 'when': ['chest'], 'output': 'Structural'},
+        ]},
+    },
+}
+
+
+def test_parse_rules_modes_and_exclusions():
+    rules = rule_engine.parse_rules(RULES)
+
+    assert rules.version == 'test-1'
+    assert rules.outputs('anatomy', 'CHEST') == [['Chest']]
+    assert rules.outputs('anatomy', 'chest lung_window') == [['Lung Window']]
+    assert rules.outputs('anatomy', 'lung-lung window') == [['Chest'], ['Lung Window']]
+    assert [rule.name for rule in rules.evaluate('intent', 'REST')] == ['functional']
+    assert [rule.name for rule in rules.evaluate('intent', 'rest chest')] == ['structural']
+    assert rules.evaluate('intent', 'unknown') == []
+
+
+def test_patterns_are_searched_once_per_label():
+    rules = rule_engine.parse_rules(RULES)
+    matcher = rules.matcher('lung', 0)
+
+    matcher.evaluate('anatomy')
+    matcher.evaluate('intent')
+
+    assert matcher.matches == {'multiple_lung': False, 'chest': True, 'lung_window': False, 'rest': False}
+    assert rules.matcher('lung', 0) is matcher
+
+
+@pytest.mark.parametrize('change', [
+    {'version': ''},
+    {'tables': {'bad': {'mode': 'any', 'rules': []}}},
+    {'tables': {'bad': {'mode': 'first', 'rules': [{'when': ['missing'], 'output': 'X'}]}}},
+    {'patterns': {'bad': [{'flags': 'i'}]}},
+])
+def test_parse_rules_rejects_malformed_rules(change):
+    with pytest.raises(ValueError):
+        rule_engine.parse_rules(dict(RULES, **change))
+
+
+def test_load_rules_from_environment(tmp_path, monkeypatch):
+    rules_file = tmp_path / 'rules.json'
+    rules_file.write_text(json.dumps(RULES))
+    monkeypatch.setenv(rule_engine.RULES_FILE_ENV, str(rules_file))
+
+    assert rule_engine.load_rules().version == 'test-1'
+    assert rule_engine.load_rules(rule_engine.DEFAULT_RULES_FILE).version == rule_engine.RULES.version
@@ -0,0 +1,120 @@
+import json
+
+import flywheel
+import pytest
+
+import run
+from conftest import write_series_zip
+from gear_context import FakeGearContext
+
+
+def _write_job(tmp_path, failure_rate=0.0):
+    zip_path = tmp_path / 'series.zip'
+    write_series_zip(zip_path, [2.0 * idx for idx in range(20)], SeriesDescription='CHEST W CONTRAST')
+    config = {
+        'config': {},
+        'inputs': {'dicom': {
+            'location': {'path': str(zip_path), 'name': 'series.zip'},
+            'object': {'modality': 'CT', 'info': {'header': {'dicom': {'SeriesDescription': 'CHEST W CONTRAST'}}}},
+        }},
+    }
+    fixture = {'acquisition': {'id': 'acq-id', 'label': 'CHEST W CONTRAST'}, 'latency': 0.01,
+               'failure_rate': failure_rate, 'seed': 0}
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    (tmp_path / 'context.json').write_text(json.dumps(fixture))
+    (tmp_path / 'output').mkdir()
+
+
+def test_main_offline_with_fake_context(tmp_path):
+    _write_job(tmp_path)
+
+    run.main(config_file_path=str(tmp_path / 'config.json'), output_folder=str(tmp_path / 'output'),
+             fake_context_path=str(tmp_path / 'context.json'))
+
+    metadata = json.loads((tmp_path / 'output' / '.metadata.json').read_text())
+    file_metadata = metadata['acquisition']['files'][0]
+    assert file_metadata['name'] == 'series.zip'
+    assert file_metadata['classification']['Anatomy'] == ['Chest']
+    assert file_metadata['classification']['Contrast'] == ['Contrast']
+
+
+def test_main_writes_perf_report_on_exit(tmp_path):
+    _write_job(tmp_path)
+    config = json.loads((tmp_path / 'config.json').read_text())
+    config['config']['perf_report'] = 'file'
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    (tmp_path / 'series.zip').write_bytes(b'not a dicom file')
+
+    with pytest.raises(SystemExit):
+        run.main(config_file_path=str(tmp_path / 'config.json'), output_folder=str(tmp_path / 'output'),
+                 fake_context_path=str(tmp_path / 'context.json'))
+
+    stages = json.loads((tmp_path / 'output' / '.perf.json').read_text())['stages']
+    assert stages['parse']['files'] == 1 and stages['parse']['peak_rss_mb_so_far'] > 0
+
+
+def test_main_without_classifier_for_modality(tmp_path):
+    _write_job(tmp_path)
+    config = json.loads((tmp_path / 'config.json').read_text())
+    config['inputs']['dicom']['object']['modality'] = 'MG'
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+
+    run.main(config_file_path=str(tmp_path / 'config.json'), output_folder=str(tmp_path / 'output'),
+             fake_context_path=str(tmp_path / 'context.json'))
+
+    assert json.loads((tmp_path / 'output' / '.metadata.json').read_text()) == {'acquisition': {}}
+
+
+def test_fake_context_injects_failures(tmp_path):
+    _write_job(tmp_path, failure_rate=1.0)
+
+    with FakeGearContext(str(tmp_path / 'context.json')) as context:
+        assert context.destination == {'id': 'acq-id', 'type': 'acquisition'}
+        with pytest.raises(flywheel.ApiException):
+            context.client.get(context.destination['id'])
+
+
+def test_main_skips_unchanged_file(tmp_path, monkeypatch):
+    _write_job(tmp_path)
+    job_kwargs = {'config_file_path': str(tmp_path / 'config.json'), 'output_folder': str(tmp_path / 'output'),
+                  'fake_context_path': str(tmp_path / 'context.json')}
+    run.main(**job_kwargs)
+    file_metadata = json.loads((tmp_path / 'output' / '.metadata.json').read_text())['acquisition']['files'][0]
+    assert file_metadata['info'][run.DIGEST_KEY]
+
+    # Apply the update to the file metadata, as the next run would see it
+    config = json.loads((tmp_path / 'config.json').read_text())
+    config['inputs']['dicom']['object']['classification'] = file_metadata['classification']
+    config['inputs']['dicom']['object']['info'].update(file_metadata['info'])
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    monkeypatch.setattr(run.dicom_processor, 'process_dicom', lambda *args, **kwargs: pytest.fail('archive read'))
+    run.main(**job_kwargs)
+    assert json.loads((tmp_path / 'output' / '.metadata.json').read_text()) == {}
+
+    config['config']['force_reclassify'] = True
+    (tmp_path / 'config.json').write_text(json.dumps(config))
+    with pytest.raises(pytest.fail.Exception):
+        run.main(**job_kwargs)
+
+
+def test_digest_covers_rules_version(monkeypatch):
+    args = ({'SeriesDescription': 'T1'}, 'MR', 'T1', {'config': {}}, '1.0.0')
+    digest = run.compute_classification_digest(*args)
+
+    monkeypatch.setattr(run.rule_engine.RULES, 'version', 'tuned')
+
+    assert run.compute_classification_digest(*args) != digest
+
+
+def test_diff_metadata():
+    output_metadata = {'acquisition': {'files': [{
+        'name': 'series.zip', 'classification': {'Anatomy': ['Chest']},
+        'info': {'header': {'dicom': {}}, 'ScanCoverage': 300.0, 'ClassificationDigest': 'new'},
+    }]}}
+    previous_metadata = {'classification': {'Anatomy': ['Chest']},
+                         'info': {'header': {'dicom': {}}, 'ScanCoverage': 300.0, 'ClassificationDigest': 'old'}}
+
+    diff, counts = run.diff_metadata(output_metadata, previous_metadata)
+
+    assert diff == {'acquisition': {'files': [{'name': 'series.zip', 'info': {'ClassificationDigest': 'new'}}]}}
+    assert counts == {'changed': 1, 'unchanged': 3}
@@ -0,0 +1,60 @@
+import json
+import re
+
+import pytest
+
+import MR_classifier
+import common_utils
+import rule_engine
+import safe_regex
+
+
+def test_builtin_rules_lint_clean():
+    rules = {name: pattern.regexes for name, pattern in rule_engine.RULES.patterns.items()}
+    assert rules
+    assert safe_regex.lint_rules(rules) == {}
+
+
+def test_search_with_timeout_kills_runaway_search():
+    catastrophic = re.compile('(a+)+$')
+
+    with pytest.raises(TimeoutError):
+        safe_regex.search_with_timeout(catastrophic, 'a' * 40 + '!', timeout=0.2)
+    # The worker is restarted for the next search
+    assert safe_regex.search_with_timeout(catastrophic, 'aaa', timeout=5)
+
+
+def test_custom_classification_timeout_falls_back(tmp_path, monkeypatch):
+    monkeypatch.setattr(safe_regex, 'USER_REGEX_TIMEOUT', 0.2)
+    config_file = tmp_path / 'config.json'
+    config_file.write_text(json.dumps({'inputs': {'classifications': {'value': {
+        '/(a+)+$/': 'Intent: Structural',
+        '/^a+!$/': 'Intent: Localizer',
+    }}}}))
+
+    classification = MR_classifier.get_custom_classification('a' * 40 + '!', str(config_file))
+
+    assert classification == {'Intent': ['Localizer']}
+
+
+def test_search_without_timeout_in_daemon_process(monkeypatch, caplog):
+    monkeypatch.setattr(safe_regex.multiprocessing, 'current_process', lambda: _DaemonProcess())
+    monkeypatch.setattr(safe_regex, '_daemon_warned', False)
+
+    assert safe_regex.search_with_timeout(re.compile('^a+!$'), 'aaa!', timeout=0.2)
+    assert not safe_regex.search_with_timeout(re.compile('b'), 'aaa!', timeout=0.2)
+
+    warnings = [record for record in caplog.records if 'without a time limit' in record.getMessage()]
+    assert len(warnings) == 1
+
+
+class _DaemonProcess:
+    daemon = True
+    name = 'ForkPoolWorker-1'
+
+
+def test_max_label_length(monkeypatch):
+    label = 'x' * 300 + ' localizer'
+    assert not common_utils.is_localizer(label)
+    monkeypatch.setattr(common_utils, 'MAX_LABEL_LENGTH', 0)
+    assert common_utils.is_localizer(label)